@@ -0,0 +1,107 @@
+"""
+Seeded synthetic data for the benchmarks.
+
+Creates shelters, animals spread over them and advertisements through the repositories, so the
+same seed always produces the same rows. Runs against the database of DB_URL:
+
+    python -m src.benchmarks.seed --shelters 50 --animals 20000 --ads 5000 --create-tables
+"""
+import argparse
+import asyncio
+import json
+import random
+from datetime import datetime, timedelta
+from src.db_handlers.core.models import Base, SexEnum, SpeciesEnum
+from src.db_handlers.core.orm import AdvertisementRepository, AnimalRepository, ShelterRepository
+from src.db_handlers.db_manage import get_engine
+
+
+WORDS = ("calm", "playful", "shy", "friendly", "young", "old", "fluffy", "healthy", "vaccinated", "home",
+         "kitten", "puppy", "cat", "dog", "family", "garden", "flat", "walks", "toys", "care")
+SYLLABLES = ("ba", "ri", "mo", "ka", "to", "sha", "li", "ne", "ru", "zo", "pi", "da")
+START = datetime(2023, 1, 1)
+
+
+def words(rnd, count):
+    return " ".join(rnd.choice(WORDS) for _ in range(count))
+
+
+def name(rnd):
+    return "".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 3))).capitalize()
+
+
+def generate(shelters, animals, ads, seed=0):
+    """
+    Generate the rows of every table, shelters of animals are referenced by position.
+
+    :return: Tuple of shelter, animal and advertisement rows.
+    """
+    rnd = random.Random(seed)
+    shelter_rows = [
+        {"title": f"Shelter {i} {name(rnd)}", "address": f"{rnd.randint(1, 200)} {name(rnd)} street",
+         "phone_number": f"+7700{rnd.randint(1000000, 9999999)}"}
+        for i in range(shelters)
+    ]
+    animal_rows = [
+        {"name": name(rnd), "sex": rnd.choice(list(SexEnum)), "age": rnd.randint(0, 15),
+         "image_path": f"static/animals-images/{i}.jpg", "species": rnd.choice(list(SpeciesEnum)),
+         "since_time": START + timedelta(minutes=rnd.randint(0, 900000)),
+         "shelter_id": rnd.randrange(shelters) if shelters and rnd.random() < 0.9 else None}
+        for i in range(animals)
+    ]
+    ad_rows = [
+        {"title": words(rnd, 4).capitalize(), "body": words(rnd, 40), "image_path": f"static/ads-images/{i}.jpg",
+         "published_time": START + timedelta(minutes=rnd.randint(0, 900000))}
+        for i in range(ads)
+    ]
+    return shelter_rows, animal_rows, ad_rows
+
+
+async def create_many(repository, rows, batch_size):
+    pks = []
+    for start in range(0, len(rows), batch_size):
+        created = await repository.create_many(rows[start:start + batch_size])
+        if "error" in created:
+            raise RuntimeError(created["error"])
+        pks += created["pks"]
+    return pks
+
+
+async def seed(shelters, animals, ads, seed=0, create_tables=False, batch_size=5000):
+    """
+    Insert a generated data set.
+
+    :param create_tables: Create missing tables first, for an empty SQLite file.
+    :return: Dictionary with the identifiers of the created shelters, animals and advertisements.
+    """
+    if create_tables:
+        async with get_engine().begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+
+    shelter_rows, animal_rows, ad_rows = generate(shelters, animals, ads, seed)
+    shelter_pks = await create_many(ShelterRepository(), shelter_rows, batch_size)
+    for row in animal_rows:
+        if row["shelter_id"] is not None:
+            row["shelter_id"] = shelter_pks[row["shelter_id"]]
+    return {
+        "shelters": shelter_pks,
+        "animals": await create_many(AnimalRepository(), animal_rows, batch_size),
+        "advertisements": await create_many(AdvertisementRepository(), ad_rows, batch_size),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shelters", type=int, default=50)
+    parser.add_argument("--animals", type=int, default=20000)
+    parser.add_argument("--ads", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--create-tables", action="store_true")
+    args = parser.parse_args()
+
+    created = asyncio.run(seed(args.shelters, args.animals, args.ads, args.seed, args.create_tables))
+    print(json.dumps({table: len(pks) for table, pks in created.items()}))
+
+
+if __name__ == "__main__":
+    main()
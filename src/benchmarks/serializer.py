@@ -0,0 +1,83 @@
+"""
+Microbenchmark of the row serialization of `GET /animals`.
+
+Compares the previous per-value conversion followed by FastAPI's `jsonable_encoder` and
+`json.dumps` with the compiled table serializer followed by `orjson.dumps`.
+
+    python -m src.benchmarks.serializer --rows 10000 --repeat 20
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from enum import Enum
+import orjson
+from fastapi.encoders import jsonable_encoder
+from src.db_handlers.core.models import Animal, SexEnum, SpeciesEnum
+from src.db_handlers.core.services import format_records
+
+
+def generate_rows(count, seed=0):
+    rnd = random.Random(seed)
+    start = datetime(2023, 1, 1)
+    return [
+        (pk, f"Animal {pk}", rnd.choice(list(SexEnum)), rnd.randint(0, 15), f"static/animals-images/{pk}.jpg",
+         rnd.choice(list(SpeciesEnum)), start + timedelta(minutes=rnd.randint(0, 500000)), rnd.randint(1, 50))
+        for pk in range(1, count + 1)
+    ]
+
+
+def legacy_serialize(column_names, rows):
+    # Conversion as done before the compiled serializers, with FastAPI's default rendering
+    records = [
+        {
+            key: value.value if isinstance(value, Enum) else (
+                value.strftime("%Y-%m-%d %I:%M %p") if isinstance(value, datetime) else value
+            )
+            for key, value in zip(column_names, row)
+        }
+        for row in rows
+    ]
+    return json.dumps(jsonable_encoder(records), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+
+def compiled_serialize(column_names, rows):
+    return orjson.dumps(format_records(column_names, rows, Animal.__table__))
+
+
+def measure(func, column_names, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(column_names, rows)
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    return {"best_s": round(best, 6), "us_per_row": round(best / len(rows) * 1e6, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    column_names = [column.name for column in Animal.__table__.columns]
+    rows = generate_rows(args.rows)
+    compiled_records = orjson.loads(compiled_serialize(column_names, rows))
+    for record in compiled_records:
+        del record["thumbnail_url"]
+    assert orjson.loads(legacy_serialize(column_names, rows)) == compiled_records
+
+    legacy = measure(legacy_serialize, column_names, rows, args.repeat)
+    compiled = measure(compiled_serialize, column_names, rows, args.repeat)
+    print(json.dumps({
+        "rows": args.rows,
+        "legacy": legacy,
+        "compiled": compiled,
+        "speedup": round(legacy["best_s"] / compiled["best_s"], 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Import time of the application, checked against a budget.
+
+Imports the module in a fresh interpreter with `python -X importtime`, without DB_URL so nothing
+may connect or need a database on import, and reports the total and the slowest modules. The
+exit status is 1 when the fastest of `--repeat` runs is over `--budget-ms`, or when a module that
+should load lazily was imported:
+
+    python -m src.benchmarks.startup --budget-ms 1000
+    python -m src.benchmarks.startup --ready  # also time the lifespan startup, needs DB_URL
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+MODULE = "src.upha_site.main"
+IMPORT_BUDGET_MS = 1000
+# Loaded on first use: database drivers with the engine, image processing with the first derivative
+LAZY_MODULES = ("sqlalchemy.dialects.postgresql.asyncpg", "sqlalchemy.dialects.sqlite.aiosqlite", "asyncpg",
+                "aiosqlite", "PIL")
+READY = """
+import asyncio, time
+started = time.perf_counter()
+from src.upha_site.main import app, lifespan
+imported = time.perf_counter()
+
+async def start():
+    async with lifespan(app):
+        return time.perf_counter()
+
+ready = asyncio.run(start())
+print((imported - started) * 1000, (ready - started) * 1000)
+"""
+
+
+def python_env(database=False):
+    env = dict(os.environ)
+    if not database:
+        env.pop("DB_URL", None)
+    return env
+
+
+def import_profile(module=MODULE):
+    """
+    Import a module in a new interpreter.
+
+    :return: Dictionary of the total import time in milliseconds and of the modules mapped to
+        their own and cumulative import times in milliseconds.
+    :raises RuntimeError: If the import fails.
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True, env=python_env())
+    if process.returncode:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+
+    modules = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(own) / 1000, int(cumulative) / 1000)
+    return {"total_ms": modules[module][1], "modules": modules}
+
+
+def ready_time():
+    """
+    Time the import of the application and the startup of its lifespan in a new interpreter.
+
+    :return: Tuple of milliseconds until imported and until ready.
+    """
+    process = subprocess.run([sys.executable, "-c", READY], capture_output=True, text=True,
+                             env=python_env(database=True))
+    if process.returncode:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    imported, ready = process.stdout.split()
+    return float(imported), float(ready)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default=MODULE)
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15, help="number of slowest modules to list")
+    parser.add_argument("--ready", action="store_true", help="also time the lifespan startup")
+    args = parser.parse_args()
+
+    profiles = [import_profile(args.module) for _ in range(args.repeat)]
+    fastest = min(profiles, key=lambda profile: profile["total_ms"])
+    eager = [name for name in LAZY_MODULES if name in fastest["modules"]]
+    report = {
+        "module": args.module,
+        "import_ms": round(fastest["total_ms"], 1),
+        "budget_ms": args.budget_ms,
+        "eagerly_imported": eager,
+        "slowest_modules": {
+            name: round(own, 1) for name, (own, _) in
+            sorted(fastest["modules"].items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+        },
+    }
+    if args.ready:
+        imported, ready = ready_time()
+        report["ready"] = {"imported_ms": round(imported, 1), "ready_ms": round(ready, 1)}
+    print(json.dumps(report, indent=2))
+    if fastest["total_ms"] > args.budget_ms or eager:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Throughput and latency of the repositories and the HTTP routes.
+
+Every scenario runs a fixed number of operations on `--concurrency` concurrent tasks and
+reports operations per second and latency percentiles as JSON. Operations pick their
+arguments from a random generator seeded per scenario, so runs of two releases against the
+same data set are comparable. Routes are called in process through `httpx.AsyncClient`,
+or against a running server with `--base-url`.
+
+    python -m src.benchmarks.seed --create-tables
+    python -m src.benchmarks.suite --requests 500 --concurrency 16 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import time
+import httpx
+from sqlalchemy import select
+from src.db_handlers.core.cache import repository_cache
+from src.db_handlers.core.models import Advertisement, Animal, SpeciesEnum
+from src.db_handlers.core.orm import (AdvertisementRepository, AnimalRepository, ShelterRepository,
+                                      StatisticRepository)
+from src.db_handlers.db_manage import AsyncSessionLocal, get_engine
+from src.upha_site.main import app
+from src.benchmarks.seed import WORDS, seed
+
+
+def repository_scenarios(data):
+    species = [item.value for item in SpeciesEnum]
+    return {
+        "repository.animals.retrieve_all": lambda rnd: AnimalRepository().retrieve_all(limit=50),
+        "repository.animals.retrieve_one": lambda rnd: AnimalRepository().retrieve_one(rnd.choice(data["animals"])),
+        "repository.animals.filter_species": lambda rnd: AnimalRepository().filter_all(
+            {"species": rnd.choice(species)}, limit=50),
+        "repository.animals.filter_range": lambda rnd: AnimalRepository().filter_all(
+            {"age": {"gte": 1, "lte": 3}, "order_by": "-since_time"}, limit=50),
+        "repository.ads.filter_by_time": lambda rnd: AdvertisementRepository().filter_by_time(
+            rnd.randint(30, 700), limit=50),
+        "repository.ads.search": lambda rnd: AdvertisementRepository().search(rnd.choice(WORDS), limit=20),
+        "repository.shelters.include_animals": lambda rnd: include_animals(rnd.choice(data["shelter_pages"])),
+        "repository.stats.summary": lambda rnd: StatisticRepository().summary(),
+    }
+
+
+async def include_animals(after):
+    repository = ShelterRepository()
+    page = await repository.retrieve_all(limit=20, after=after)
+    return await repository.include_animals(page["items"], 10)
+
+
+def http_scenarios(client, data):
+    return {
+        "http.animals.list": lambda rnd: client.get("/animals", params={"limit": 50}),
+        "http.animals.detail": lambda rnd: client.get(f"/animals/{rnd.choice(data['animals'])}"),
+        "http.animals.filter": lambda rnd: client.post(
+            "/animals/filter", params={"limit": 50}, json={"species": rnd.choice(["cat", "dog"])}),
+        "http.ads.list_fields": lambda rnd: client.get("/ads", params={"limit": 50, "fields": "title,image_path"}),
+        "http.ads.search": lambda rnd: client.get("/ads/search", params={"q": rnd.choice(WORDS)}),
+        "http.shelters.include_animals": lambda rnd: client.get("/shelters", params={"include": "animals"}),
+        "http.stats": lambda rnd: client.get("/stats"),
+    }
+
+
+def failed(result):
+    if isinstance(result, httpx.Response):
+        return result.status_code >= 400
+    return isinstance(result, dict) and "error" in result
+
+
+def percentile(ordered, fraction):
+    # Nearest rank
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+async def run_scenario(name, operation, requests, concurrency, warmup, seed_value):
+    rnd = random.Random(f"{seed_value}-{name}")
+    for _ in range(warmup):
+        await operation(rnd)
+
+    latencies, errors = [], [0]
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                if failed(await operation(rnd)):
+                    errors[0] += 1
+            except Exception:
+                errors[0] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+    }
+
+
+async def load_data():
+    """
+    Identifiers of the rows the operations pick from, and shelter page cursors.
+    """
+    async with AsyncSessionLocal() as ss:
+        animals = (await ss.execute(select(Animal.pk).order_by(Animal.pk).limit(10000))).scalars().all()
+        ads = (await ss.execute(select(Advertisement.pk).order_by(Advertisement.pk).limit(10000))).scalars().all()
+    pages, after = [None], None
+    while len(pages) < 20:
+        page = await ShelterRepository().retrieve_all(limit=20, after=after)
+        after = page.get("next_cursor")
+        if after is None:
+            break
+        pages.append(after)
+    return {"animals": animals, "advertisements": ads, "shelter_pages": pages}
+
+
+async def run(args):
+    repository_cache.enabled = not args.no_cache
+    if args.seed_data:
+        shelters, animals, ads = args.seed_data
+        await seed(shelters, animals, ads, args.seed, create_tables=True)
+    data = await load_data()
+    if not data["animals"]:
+        raise SystemExit("No data, seed the database first (--seed-data or python -m src.benchmarks.seed).")
+
+    if args.base_url:
+        client = httpx.AsyncClient(base_url=args.base_url)
+    else:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark")
+
+    results = {}
+    async with client:
+        scenarios = {**repository_scenarios(data), **http_scenarios(client, data)}
+        for name, operation in scenarios.items():
+            if args.only and not any(part in name for part in args.only):
+                continue
+            results[name] = await run_scenario(name, operation, args.requests, args.concurrency, args.warmup,
+                                               args.seed)
+
+    return {
+        "meta": {
+            "database": get_engine().dialect.name,
+            "python": platform.python_version(),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "cache": repository_cache.enabled,
+            "seed": args.seed,
+            "rows": {"animals": len(data["animals"]), "advertisements": len(data["advertisements"])},
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="operations per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--seed-data", type=int, nargs=3, metavar=("SHELTERS", "ANIMALS", "ADS"),
+                        help="insert a generated data set before running")
+    parser.add_argument("--no-cache", action="store_true", help="disable the repository cache")
+    parser.add_argument("--only", nargs="*", help="run the scenarios whose names contain one of these")
+    parser.add_argument("--base-url", help="call a running server instead of the app in process")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
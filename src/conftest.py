@@ -0,0 +1,66 @@
+"""
+Test configuration.
+
+Jobs queued by the code under test go to a temporary JOBS_DB of their own. Cooperative tests
+marked `serial` run after every other cooperative test is done, one at a time, for tests that
+read models no concurrent test may write meanwhile.
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import pytest
+from src.db_handlers.db_manage import dispose_engine
+
+
+_jobs_directory = None
+# Cooperative tests not marked `serial` that did not finish yet
+_unfinished = set()
+_others_done = asyncio.Event()
+_serial_lock = asyncio.Lock()
+
+
+def pytest_configure(config):
+    global _jobs_directory
+    config.addinivalue_line(
+        "markers", "serial: run a cooperative test alone, after every other cooperative test is done.")
+    # Before the site is imported, so the job queue never opens the JOBS_DB of the working directory
+    _jobs_directory = tempfile.mkdtemp()
+    os.environ["JOBS_DB"] = os.path.join(_jobs_directory, "jobs.sqlite3")
+
+
+def pytest_unconfigure(config):
+    if _jobs_directory is not None:
+        shutil.rmtree(_jobs_directory, ignore_errors=True)
+
+
+def pytest_collection_finish(session):
+    # Skipped tests never finish, the serial ones would wait for them forever
+    _unfinished.update(
+        item.nodeid for item in session.items
+        if item.get_closest_marker("asyncio_cooperative") and not item.get_closest_marker("serial")
+        and not item.get_closest_marker("skip") and not item.get_closest_marker("skipif"))
+    if not _unfinished:
+        _others_done.set()
+
+
+@pytest.fixture(autouse=True)
+async def serialize(request):
+    """
+    Hold tests marked `serial` back until the other cooperative tests are done and run them one at a time.
+
+    The pooled connections are closed after each of them, on the event loop they belong to.
+    """
+    if request.node.get_closest_marker("serial") is None:
+        yield
+        _unfinished.discard(request.node.nodeid)
+        if not _unfinished:
+            _others_done.set()
+        return
+
+    await _others_done.wait()
+    async with _serial_lock:
+        try:
+            yield
+        finally:
+            await dispose_engine()
@@ -0,0 +1,54 @@
+"""add full text search
+
+Revision ID: 8b3e94c2d1a6
+Revises: 5d2c81f0a7e4
+Create Date: 2026-10-18 15:45:13.207951
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b3e94c2d1a6'
+down_revision: Union[str, None] = '5d2c81f0a7e4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SEARCH_COLUMNS = {'advertisement': ('title', 'body'), 'animals': ('name',)}
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    for table, columns in SEARCH_COLUMNS.items():
+        if dialect == 'postgresql':
+            document = " || ' ' || ".join(f"coalesce({column}, '')" for column in columns)
+            op.execute(f"ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+                       f"GENERATED ALWAYS AS (to_tsvector('simple', {document})) STORED")
+            op.execute(f"CREATE INDEX ix_{table}_search_vector ON {table} USING gin (search_vector)")
+        elif dialect == 'sqlite':
+            column_list = ", ".join(columns)
+            new_values = ", ".join(f"new.{column}" for column in columns)
+            old_values = ", ".join(f"old.{column}" for column in columns)
+            op.execute(f"CREATE VIRTUAL TABLE {table}_fts USING fts5({column_list}, content='{table}', content_rowid='pk')")
+            op.execute(f"CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+                       f"INSERT INTO {table}_fts (rowid, {column_list}) VALUES (new.pk, {new_values}); END")
+            op.execute(f"CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+                       f"INSERT INTO {table}_fts ({table}_fts, rowid, {column_list}) VALUES ('delete', old.pk, {old_values}); END")
+            op.execute(f"CREATE TRIGGER {table}_fts_update AFTER UPDATE ON {table} BEGIN "
+                       f"INSERT INTO {table}_fts ({table}_fts, rowid, {column_list}) VALUES ('delete', old.pk, {old_values}); "
+                       f"INSERT INTO {table}_fts (rowid, {column_list}) VALUES (new.pk, {new_values}); END")
+            op.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    for table in SEARCH_COLUMNS:
+        if dialect == 'postgresql':
+            op.drop_index(f'ix_{table}_search_vector', table_name=table)
+            op.drop_column(table, 'search_vector')
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f"DROP TRIGGER {table}_fts_{trigger}")
+            op.execute(f"DROP TABLE {table}_fts")
@@ -1,5 +1,52 @@
-from decouple import config
+from decouple import config, Csv
 
 
-DB_URL = config("DB_URL")
+# Read when the engine is first used, so the application imports without it
+DB_URL = config("DB_URL", default=None)
 
+# Read-only replicas of the database, the repositories send their read transactions to them
+DB_REPLICA_URLS = config("DB_REPLICA_URLS", default="", cast=Csv())
+# "round_robin" or "least_connections"
+DB_REPLICA_POLICY = config("DB_REPLICA_POLICY", default="round_robin")
+# Reads of a client go to the primary for this many seconds after its last write, 0 turns it off
+DB_READ_YOUR_WRITES_SECONDS = config("DB_READ_YOUR_WRITES_SECONDS", default=5, cast=float)
+
+# Connection pool, ignored for SQLite which does not pool file connections
+DB_POOL_SIZE = config("DB_POOL_SIZE", default=10, cast=int)
+DB_MAX_OVERFLOW = config("DB_MAX_OVERFLOW", default=10, cast=int)
+DB_POOL_TIMEOUT = config("DB_POOL_TIMEOUT", default=30, cast=float)
+DB_POOL_RECYCLE = config("DB_POOL_RECYCLE", default=1800, cast=int)
+DB_POOL_PRE_PING = config("DB_POOL_PRE_PING", default=True, cast=bool)
+# Connections the application may open over all workers, 0 reads max_connections from PostgreSQL and
+# keeps DB_RESERVED_CONNECTIONS of them for migrations, maintenance and other clients
+DB_MAX_CONNECTIONS = config("DB_MAX_CONNECTIONS", default=0, cast=int)
+DB_RESERVED_CONNECTIONS = config("DB_RESERVED_CONNECTIONS", default=10, cast=int)
+# Connections opened at startup, before the application accepts requests
+DB_POOL_PREWARM = config("DB_POOL_PREWARM", default=1, cast=int)
+
+# asyncpg prepared statement cache per connection, 0 disables it (e.g. behind pgbouncer)
+DB_STATEMENT_CACHE_SIZE = config("DB_STATEMENT_CACHE_SIZE", default=100, cast=int)
+
+# Bulk creations of at least this many rows go through COPY on PostgreSQL
+BULK_COPY_THRESHOLD = config("BULK_COPY_THRESHOLD", default=1000, cast=int)
+
+# What filter_all does with filter keys no index starts with: "off", "warn" or "reject"
+FILTER_INDEX_POLICY = config("FILTER_INDEX_POLICY", default="warn")
+
+# Statements slower than this many seconds are logged and kept for /admin/slow-queries, 0 disables it
+SLOW_QUERY_SECONDS = config("SLOW_QUERY_SECONDS", default=0.5, cast=float)
+SLOW_QUERY_LOG_SIZE = config("SLOW_QUERY_LOG_SIZE", default=200, cast=int)
+# Capture the plans of slow SELECT statements, at most one every SLOW_QUERY_EXPLAIN_INTERVAL seconds
+SLOW_QUERY_EXPLAIN = config("SLOW_QUERY_EXPLAIN", default=False, cast=bool)
+SLOW_QUERY_EXPLAIN_INTERVAL = config("SLOW_QUERY_EXPLAIN_INTERVAL", default=60, cast=float)
+
+# Read-through cache of repository results
+CACHE_ENABLED = config("CACHE_ENABLED", default=True, cast=bool)
+CACHE_TTL = config("CACHE_TTL", default=30, cast=float)
+CACHE_MAX_ENTRIES = config("CACHE_MAX_ENTRIES", default=10000, cast=int)
+# "memory" keeps entries and change counters per process, "sqlite" shares them between the workers of a host
+CACHE_BACKEND = config("CACHE_BACKEND", default="memory")
+CACHE_DB = config("CACHE_DB", default="cache.sqlite3")
+
+# Thumbnail URL added to serialized objects that have an image
+THUMBNAIL_URL_TEMPLATE = config("THUMBNAIL_URL_TEMPLATE", default="/thumbnails/200/{image_path}")
@@ -0,0 +1,341 @@
+import asyncio
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import orjson
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from email.utils import formatdate
+from uuid import uuid4
+from typing import Any, Optional, Tuple
+from src.db_handlers.config import (CACHE_ENABLED, CACHE_TTL, CACHE_MAX_ENTRIES, CACHE_BACKEND, CACHE_DB, DB_REPLICA_URLS,
+                                    DB_READ_YOUR_WRITES_SECONDS)
+
+
+class CacheBackend(ABC):
+    """
+    Storage interface of the repository cache.
+
+    The in-process `LRUCache` implements it for a single worker. A backend whose entries and
+    counters are seen by every worker process is `shared`, like the `SQLiteCache` file or a
+    Redis store implementing the same coroutines. Backends start their "started" counter at
+    their creation time in milliseconds.
+    """
+
+    shared = False
+
+    @abstractmethod
+    async def get(self, key: str) -> Tuple[bool, Any]:
+        """
+        Get a value.
+
+        :param key: Cache key.
+        :return: Tuple of a hit flag and the cached value.
+        """
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float):
+        """
+        Store a value for `ttl` seconds.
+        """
+
+    @abstractmethod
+    async def delete(self, key: str):
+        """
+        Remove a value if it is cached.
+        """
+
+    @abstractmethod
+    async def get_counter(self, key: str) -> int:
+        """
+        Get a counter, 0 if it was never incremented. Counters are never evicted.
+        """
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        """
+        Increment a counter and return its new value.
+        """
+
+    @abstractmethod
+    async def raise_counter(self, key: str, value: int) -> int:
+        """
+        Raise a counter to at least `value` and return its new value.
+        """
+
+    @abstractmethod
+    async def instance(self) -> str:
+        """
+        Identifier of the counters, changed whenever they may have started over from 0.
+        """
+
+
+class LRUCache(CacheBackend):
+    """
+    In-process backend evicting the least recently used entry once `max_entries` is reached.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {"started": int(time.time() * 1000)}
+        # Counters start over with every process
+        self._instance = uuid4().hex[:8]
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    async def set(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, key):
+        self._entries.pop(key, None)
+
+    async def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    async def incr(self, key):
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+    async def raise_counter(self, key, value):
+        self._counters[key] = max(self._counters.get(key, 0), value)
+        return self._counters[key]
+
+    async def instance(self):
+        return self._instance
+
+
+class SQLiteCache(CacheBackend):
+    """
+    Backend in a local SQLite file, shared by the worker processes of one host.
+
+    Entries are pickled and the oldest stored ones are evicted once `max_entries` is reached.
+    Counters live as long as the file, which records its own identifier and creation time when it
+    is created.
+    """
+
+    shared = True
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL,
+                                        stored_at REAL NOT NULL);
+    CREATE INDEX IF NOT EXISTS entries_stored ON entries (stored_at);
+    CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    """
+    # Sets between two evictions
+    EVICT_EVERY = 100
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._connection = None
+        self._lock = threading.Lock()
+        self._sets = 0
+
+    def _execute(self, statement, parameters=()):
+        # One connection per process, opened on first use and used from worker threads
+        with self._lock:
+            if self._connection is None:
+                connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(self.SCHEMA)
+                connection.execute("INSERT OR IGNORE INTO counters VALUES ('instance', ?), ('started', ?)",
+                                   (int.from_bytes(os.urandom(4), "big"), int(time.time() * 1000)))
+                self._connection = connection
+            return self._connection.execute(statement, parameters).fetchall()
+
+    async def execute(self, statement, parameters=()):
+        return await asyncio.to_thread(self._execute, statement, parameters)
+
+    async def get(self, key):
+        rows = await self.execute("SELECT value FROM entries WHERE key = ? AND expires_at >= ?", (key, time.time()))
+        return (True, pickle.loads(rows[0][0])) if rows else (False, None)
+
+    async def set(self, key, value, ttl):
+        now = time.time()
+        await self.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                           (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + ttl, now))
+        self._sets += 1
+        if self._sets % self.EVICT_EVERY == 0:
+            await self.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+            await self.execute("DELETE FROM entries WHERE key IN "
+                               "(SELECT key FROM entries ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                               (self.max_entries,))
+
+    async def delete(self, key):
+        await self.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    async def get_counter(self, key):
+        rows = await self.execute("SELECT value FROM counters WHERE key = ?", (key,))
+        return rows[0][0] if rows else 0
+
+    async def incr(self, key):
+        rows = await self.execute("INSERT INTO counters VALUES (?, 1) "
+                                  "ON CONFLICT (key) DO UPDATE SET value = value + 1 RETURNING value", (key,))
+        return rows[0][0]
+
+    async def raise_counter(self, key, value):
+        rows = await self.execute("INSERT INTO counters VALUES (?, ?) "
+                                  "ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value) RETURNING value",
+                                  (key, value))
+        return rows[0][0]
+
+    async def instance(self):
+        return f"{await self.get_counter('instance'):08x}"
+
+
+def make_backend(name: str = CACHE_BACKEND) -> CacheBackend:
+    """
+    Create the cache backend named by CACHE_BACKEND, "memory" or "sqlite".
+    """
+    if name == "memory":
+        return LRUCache(CACHE_MAX_ENTRIES)
+    if name == "sqlite":
+        return SQLiteCache(CACHE_DB, CACHE_MAX_ENTRIES)
+    raise ValueError(f"Unknown cache backend {name}.")
+
+
+class RepositoryCache:
+    """
+    Read-through cache of repository results.
+
+    Keys are versioned per model: a write drops the key of the written object and bumps the
+    list version of its model, so every cached list and filter result of the model goes stale
+    while other objects and models keep their entries. Bumping the generation of a model drops
+    all of its entries, for writes that change its rows indirectly (ON DELETE SET NULL).
+
+    The versions are kept even when caching is disabled, they also serve as change tokens for
+    conditional GETs. They are per process with `LRUCache`, so several workers need a shared
+    backend such as `SQLiteCache` for the tokens to see each other's writes.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: float, enabled: bool = True, write_window: float = 0):
+        """
+        :param write_window: Seconds a written model is reported by `recently_written` and its reads are not
+            cached, 0 to never report it.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+        self.write_window = write_window
+        self.hits = 0
+        self.misses = 0
+
+    async def versions(self, model: str) -> Tuple[int, int]:
+        """
+        Get the generation and the list version of a model.
+        """
+        return (await self.backend.get_counter(f"generation:{model}"),
+                await self.backend.get_counter(f"version:{model}"))
+
+    async def validators(self, *models: str) -> Tuple[str, str]:
+        """
+        Get the change validators of one or more models.
+
+        :param models: Names of the models a response is built from.
+        :return: Tuple of an ETag and a Last-Modified HTTP date, both changed by every write to the models.
+            The date is kept by the backend, so workers sharing it agree on it.
+        """
+        # Tokens handed out before the counters started over never match again
+        instance = await self.backend.instance()
+        tokens = []
+        for model in models:
+            generation, version = await self.versions(model)
+            tokens.append(f"{model}-{instance}-{generation}-{version}")
+        # Models never written since the counters started over date from then
+        started = await self.backend.get_counter("started")
+        last_modified = max([await self.backend.get_counter(f"modified:{model}") for model in models] + [started])
+        return f'W/"{"+".join(tokens)}"', formatdate(last_modified / 1000, usegmt=True)
+
+    @staticmethod
+    def _key(model, versions, params) -> str:
+        generation, version = versions
+        # Objects only depend on the generation, lists on every write to the model
+        parts = (model, generation, params) if params[0] == "one" else (model, generation, version, params)
+        return orjson.dumps(parts, option=orjson.OPT_SORT_KEYS, default=str).decode()
+
+    async def get(self, model: str, *params) -> Tuple[bool, Any, Tuple[int, int]]:
+        """
+        Look up a cached result.
+
+        :param model: Model name.
+        :param params: Method name and arguments identifying the result.
+        :return: Tuple of a hit flag, the cached value and the model versions to pass to `set`.
+        """
+        versions = await self.versions(model)
+        hit, value = await self.backend.get(self._key(model, versions, params))
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return hit, value, versions
+
+    async def set(self, model: str, versions: Tuple[int, int], value: Any, *params):
+        """
+        Cache a result read while the model was at `versions`.
+
+        Results read before a concurrent write committed are dropped instead of cached, and so are
+        results read within `write_window` of a write, which may come from a replica lagging behind it.
+        """
+        if await self.versions(model) != versions or await self.recently_written(model):
+            return
+        await self.backend.set(self._key(model, versions, params), value, self.ttl)
+
+    async def invalidate(self, model: str, pk: Optional[int] = None):
+        """
+        Invalidate cached lists of a model and, when given, the cached object `pk`.
+        """
+        if pk is not None:
+            await self.backend.delete(self._key(model, await self.versions(model), ("one", pk)))
+        await self.backend.incr(f"version:{model}")
+        await self._written(model)
+
+    async def invalidate_all(self, model: str):
+        """
+        Invalidate every cached result of a model.
+        """
+        await self.backend.incr(f"generation:{model}")
+        await self.backend.incr(f"version:{model}")
+        await self._written(model)
+
+    async def _written(self, model):
+        # A counter, unlike an entry, is never evicted before the window is over
+        await self.backend.raise_counter(f"modified:{model}", int(time.time() * 1000))
+
+    async def recently_written(self, *models: str) -> bool:
+        """
+        Whether one of the models was written in the last `write_window` seconds, by any process sharing the backend.
+        """
+        if self.write_window <= 0:
+            return False
+        since = int((time.time() - self.write_window) * 1000)
+        for model in models:
+            if await self.backend.get_counter(f"modified:{model}") > since:
+                return True
+        return False
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+# Replicas may lag behind recent writes for as long as a client reads its own writes from the primary
+repository_cache = RepositoryCache(make_backend(), CACHE_TTL, CACHE_ENABLED,
+                                   DB_READ_YOUR_WRITES_SECONDS if DB_REPLICA_URLS else 0)
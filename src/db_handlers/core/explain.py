@@ -0,0 +1,50 @@
+from sqlalchemy import text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN of a statement, compiled with the bind parameters of the statement itself.
+    """
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kw):
+    prefix = "EXPLAIN QUERY PLAN " if compiler.dialect.name == "sqlite" else "EXPLAIN "
+    return prefix + compiler.process(element.statement, **kw)
+
+
+async def query_plan(ss, query):
+    """
+    Get the plan the database picks for a query.
+
+    On PostgreSQL sequential scans are disabled for the transaction first, so tiny test tables
+    still show whether an index could serve the query.
+
+    :param ss: Session or connection in a transaction.
+    :param query: Select statement.
+    :return: List of plan lines.
+    """
+    if ss.bind.dialect.name == "sqlite":
+        result = await ss.execute(Explain(query))
+        return [row[-1] for row in result.fetchall()]
+    await ss.execute(text("SET LOCAL enable_seqscan = off"))
+    result = await ss.execute(Explain(query))
+    return [row[0] for row in result.fetchall()]
+
+
+def is_full_scan(plan):
+    """
+    Tell whether a plan reads a whole table without an index.
+    """
+    for line in plan:
+        line = line.strip()
+        if "Seq Scan" in line or (line.startswith("SCAN ") and " USING " not in line):
+            return True
+    return False
@@ -1,4 +1,4 @@
-from src.db_handlers.db_manage import AsyncSessionLocal, engine
+from src.db_handlers.db_manage import AsyncSessionLocal, get_engine
 from sqlalchemy import text
 from models import Base
 
@@ -11,6 +11,6 @@ async def check_connection():
 
 
 async def db_init():
-    async with engine.begin() as conn:
+    async with get_engine().begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
@@ -0,0 +1,111 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+
+# Keys of a filter condition that are not column names
+RESERVED_KEYS = ("order_by", "limit")
+OPERATORS = ("eq", "gte", "lte", "in", "ilike")
+MAX_IN_VALUES = 1000
+
+
+class FilterSpec:
+    """
+    Filter condition compiled against a table.
+
+    A condition maps column names to a value for equality or to a dictionary of operators:
+
+        {"species": "dog", "age": {"gte": 1, "lte": 3}, "shelter_id": {"in": [2, 5, 7]},
+         "name": {"ilike": "bar"}, "order_by": ["-since_time"], "limit": 20}
+
+    `ilike` matches a case-insensitive prefix, a "-" in `order_by` sorts in descending order.
+    """
+
+    def __init__(self, conditions: List[Any], columns: List[str], order_by: List[str], limit: Optional[int]):
+        self.conditions = conditions
+        self.columns = columns
+        self.order_by = order_by
+        self.limit = limit
+
+
+def coerce(column, value):
+    """
+    Convert a JSON value to the Python type of a column.
+
+    :raises ValueError: If the value does not fit the column.
+    """
+    if value is None:
+        return None
+    enum_class = getattr(column.type, "enum_class", None)
+    try:
+        if enum_class is not None:
+            return value if isinstance(value, enum_class) else enum_class(value)
+        python_type = column.type.python_type
+        if python_type is datetime:
+            return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+        if python_type is int and not isinstance(value, bool):
+            return int(value)
+        if isinstance(value, python_type):
+            return value
+    except (TypeError, ValueError, NotImplementedError):
+        pass
+    raise ValueError(f"Invalid value for {column.name}.")
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def column_condition(column, operator, value):
+    if operator == "eq":
+        value = coerce(column, value)
+        return column.is_(None) if value is None else column == value
+    if operator == "in":
+        if not isinstance(value, list) or not 0 < len(value) <= MAX_IN_VALUES:
+            raise ValueError(f"in of {column.name} takes a list of 1 to {MAX_IN_VALUES} values.")
+        return column.in_([coerce(column, item) for item in value])
+    if operator == "ilike":
+        if not isinstance(value, str) or getattr(column.type, "enum_class", None) is not None \
+                or column.type.python_type is not str:
+            raise ValueError(f"ilike of {column.name} takes a text prefix.")
+        return column.ilike(escape_like(value) + "%", escape="\\")
+    value = coerce(column, value)
+    if value is None:
+        raise ValueError(f"{operator} of {column.name} takes a value.")
+    return column >= value if operator == "gte" else column <= value
+
+
+def parse_filter(table, filter_condition: Optional[Dict]) -> FilterSpec:
+    """
+    Compile a filter condition against a table.
+
+    :param table: Table the condition applies to.
+    :param filter_condition: Filter condition, see `FilterSpec`.
+    :return: Compiled filter.
+    :raises ValueError: If the condition names unknown columns or operators or has invalid values.
+    """
+    conditions, columns, order_by, limit = [], [], [], None
+    for key, value in (filter_condition or {}).items():
+        if key == "order_by":
+            order_by = [value] if isinstance(value, str) else value
+            if not isinstance(order_by, list) or not all(isinstance(name, str) for name in order_by):
+                raise ValueError("order_by takes a column name or a list of them.")
+            for name in order_by:
+                if name.lstrip("-") not in table.c:
+                    raise ValueError(f"Unknown column {name.lstrip('-')}.")
+        elif key == "limit":
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise ValueError("limit takes a positive integer.")
+            limit = value
+        elif key not in table.c:
+            raise ValueError(f"Unknown column {key}.")
+        else:
+            column = table.c[key]
+            operators = value if isinstance(value, dict) else {"eq": value}
+            if not operators:
+                raise ValueError(f"No operator for {key}.")
+            for operator, operand in operators.items():
+                if operator not in OPERATORS:
+                    raise ValueError(f"Unknown operator {operator}.")
+                conditions.append(column_condition(column, operator, operand))
+            columns.append(key)
+    return FilterSpec(conditions, columns, order_by, limit)
@@ -0,0 +1,219 @@
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, Optional, Tuple
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    """
+    Metric in the Prometheus text exposition format, with one series per combination of label values.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    @abstractmethod
+    def samples(self) -> Iterable[str]:
+        """
+        Lines of the series of the metric.
+        """
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in sorted(self._values.items()):
+            yield f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}"
+
+
+class Gauge(Metric):
+    """
+    Gauge read when the metrics are rendered.
+
+    :param collect: Callable returning a dictionary of label value tuples to values.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), collect: Callable[[], Dict[Tuple, float]] = dict):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def samples(self):
+        for label_values, value in sorted(self.collect().items()):
+            yield f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            # Counts per bucket, the last one is +Inf, then the sum of the observed values
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for label_values, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else format_value(float(bound))
+                labels = format_labels(self.labels, label_values, f'le="{le}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+class QueryTiming:
+    """
+    Database work of one request, collected while `query_timing` holds it.
+
+    :param origin: Callable describing what runs the statements, e.g. the route of the request.
+    """
+
+    def __init__(self, origin: Optional[Callable[[], str]] = None):
+        self.origin = origin
+        self.statements = 0
+        self.seconds = 0.0
+        self.checkout_seconds = 0.0
+
+
+query_timing: ContextVar[Optional[QueryTiming]] = ContextVar("query_timing", default=None)
+
+registry = Registry()
+sql_duration = registry.add(Histogram(
+    "upha_sql_statement_duration_seconds", "Execution time of SQL statements.", ("operation",)))
+sql_errors = registry.add(Counter("upha_sql_errors_total", "SQL statements that raised an error."))
+pool_checkout_duration = registry.add(Histogram(
+    "upha_db_pool_checkout_duration_seconds", "Time spent waiting for a pooled database connection."))
+
+
+def operation(statement: str) -> str:
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else "OTHER"
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    sql_duration.observe(elapsed, operation(statement))
+    timing = query_timing.get()
+    if timing is not None:
+        timing.statements += 1
+        timing.seconds += elapsed
+
+
+def handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_started"):
+        connection.info["query_started"].pop()
+    sql_errors.inc()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Connection pool recording how long every checkout waits.
+    """
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            elapsed = time.perf_counter() - started
+            pool_checkout_duration.observe(elapsed)
+            timing = query_timing.get()
+            if timing is not None:
+                timing.checkout_seconds += elapsed
+
+
+_instrumented = {}
+
+
+def pool_connections():
+    counts = {}
+    for name, engine in _instrumented.items():
+        # The pool of an engine is replaced when the engine is disposed
+        pool = engine.sync_engine.pool
+        if hasattr(pool, "checkedout"):
+            counts[(name, "checked_out")] = pool.checkedout()
+            counts[(name, "idle")] = pool.checkedin()
+            counts[(name, "overflow")] = max(pool.overflow(), 0)
+    return counts
+
+
+registry.add(Gauge("upha_db_pool_connections", "Connections of the database pools by state.", ("database", "state"),
+                   pool_connections))
+
+
+def instrument_engine(engine, name="primary"):
+    """
+    Record the statements of an async engine and the occupancy of its pool.
+
+    :param name: Database label of the pool metrics.
+    """
+    _instrumented[name] = engine
+    sync_engine = engine.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(sync_engine, "handle_error", handle_error)
@@ -1,7 +1,8 @@
 from typing import Annotated
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import String, Text, DateTime, func, ForeignKey, Boolean
+from sqlalchemy import String, Text, DateTime, func, ForeignKey, Boolean, Index
 from enum import Enum
+from .search import full_text_search
 
 
 intpk = Annotated[int, mapped_column(primary_key=True)]
@@ -15,11 +16,14 @@ class Base(DeclarativeBase):
 
 class Advertisement(Base):
     __tablename__ = "advertisement"
+    __table_args__ = (
+        Index("ix_advertisement_published_time", "published_time"),
+    )
 
     pk: Mapped[intpk]
     title: Mapped[str128]
     body: Mapped[str] = mapped_column(Text())
-    image_path: Mapped[str] = mapped_column(Text())
+    image_path: Mapped[str] = mapped_column(Text(), info={"file": True})
     published_time: Mapped[current_time]
 
     def __repr__(self):
@@ -58,12 +62,17 @@ class SpeciesEnum(Enum):
 
 class Animal(Base):
     __tablename__ = "animals"
+    __table_args__ = (
+        Index("ix_animals_shelter_id", "shelter_id"),
+        Index("ix_animals_species_sex", "species", "sex"),
+        Index("ix_animals_since_time", "since_time"),
+    )
 
     pk: Mapped[intpk]
     name: Mapped[str128]
     sex: Mapped[SexEnum]
     age: Mapped[int]
-    image_path: Mapped[str] = mapped_column(Text())
+    image_path: Mapped[str] = mapped_column(Text(), info={"file": True})
     species: Mapped[SpeciesEnum]
     since_time: Mapped[str] = mapped_column(DateTime())
     shelter_id: Mapped[int] = mapped_column(ForeignKey('shelters.pk', ondelete='SET NULL'), nullable=True)
@@ -86,3 +95,19 @@ class User(Base):
 
     def __repr__(self):
         return str(self.first_name + self.last_name)
+
+
+class Statistic(Base):
+    __tablename__ = "statistics"
+
+    table_name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    dimension: Mapped[str] = mapped_column(String(64), primary_key=True)
+    key: Mapped[str] = mapped_column(String(128), primary_key=True)
+    count: Mapped[int] = mapped_column(default=0)
+
+    def __repr__(self):
+        return f"{self.table_name}.{self.dimension}={self.key}"
+
+
+full_text_search(Advertisement.__table__, "title", "body")
+full_text_search(Animal.__table__, "name")
@@ -1,10 +1,50 @@
+import logging
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from .models import Advertisement, Shelter, Animal, User
-from .services import retrieve_attributes, row_to_dict
+from enum import Enum
+from .models import Advertisement, Shelter, Animal, User, Statistic
+from .filters import FilterSpec, coerce, parse_filter
+from .search import search_query
+from .stats import SNAPSHOT_CHUNK, count_rows, dependent_rows, record, snapshot, stat_columns, summary
+from .services import retrieve_attributes, row_to_dict, paginate, decode_cursor, encode_cursor, format_records
+from sqlalchemy import and_, or_, false, func, tuple_, delete, insert, text, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from typing import Type, Optional, Dict
+from typing import Type, Optional, Dict, List, Sequence, Union
 from src.db_handlers.core.models import Base
-from src.db_handlers.db_manage import AsyncSessionLocal
+from src.db_handlers.core.cache import repository_cache
+from src.db_handlers.config import BULK_COPY_THRESHOLD, FILTER_INDEX_POLICY
+from src.db_handlers.db_manage import AsyncSessionLocal, note_write, read_engine
+
+
+logger = logging.getLogger("orm")
+_warned_filters = set()
+# Coroutine functions given the paths held by the file columns of deleted rows, once the deletion is committed
+file_release_hooks = []
+
+
+def file_columns(table):
+    """
+    Columns holding the path of a file, marked with `info={"file": True}`.
+    """
+    return [column for column in table.c if column.info.get("file")]
+
+
+def keyset_equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def keyset_after(column, value, descending: bool):
+    """
+    Condition of the rows after `value` in the keyset order of a column, NULL being larger than any value.
+    """
+    if descending:
+        return column.is_not(None) if value is None else column < value
+    if value is None:
+        return false()
+    return or_(column > value, column.is_(None)) if column.nullable else column > value
 
 
 class BaseRepository:
@@ -12,52 +52,353 @@ class BaseRepository:
     Generic base class for interacting with the data storage.
     """
 
-    def __init__(self,  model_type: Type[Base]):
+    # Columns the keyset pagination orders by, the last one must be unique
+    cursor_columns = ("pk",)
+
+    def __init__(self,  model_type: Type[Base], session: Optional[AsyncSession] = None):
         """
         Initialize the BaseRepository object.
 
         :param model_type: The type of the SQLAlchemy model.
+        :param session: Request-scoped session; a private one is opened when omitted.
         """
-        self.session = AsyncSessionLocal()
+        self._owns_session = session is None
+        self.session = AsyncSessionLocal() if session is None else session
         self.model_type = model_type
 
-    async def retrieve_one(self, pk: int):
+    @asynccontextmanager
+    async def _transaction(self, read: bool = False):
+        """
+        Run a transaction on the repository session.
+
+        A private session is closed afterwards, a request-scoped one is left to its provider.
+        Read transactions go to a replica when one is configured, see `read_engine`; the others
+        go to the primary and keep the reads of the client there for a while. Files released by
+        the transaction are handed to `file_release_hooks` after it commits.
+
+        :param read: The transaction only reads.
+        """
+        replica = read_engine() if read else None
+        if replica is not None:
+            self.session.info["replica"] = replica
+        try:
+            if self._owns_session:
+                async with self.session as ss:
+                    async with ss.begin():
+                        yield ss
+            else:
+                async with self.session.begin():
+                    yield self.session
+        finally:
+            self.session.info.pop("replica", None)
+            released = self.session.info.pop("released_files", None)
+        if not read:
+            note_write()
+        if released:
+            for hook in file_release_hooks:
+                await hook(released)
+
+    async def _cache_get(self, *params):
+        """
+        Look up a read result in the repository cache.
+
+        Cached values are shared between requests and must not be modified.
+
+        :param params: Method name and arguments identifying the result.
+        :return: Tuple of a hit flag, the cached value and the versions to pass to `_cache_set`.
+        """
+        if not repository_cache.enabled:
+            return False, None, None
+        return await repository_cache.get(self.model_type.__name__, *params)
+
+    async def _cache_set(self, versions, data, *params):
+        """
+        Cache a read result unless it is an error or a not-found message.
+        """
+        if not repository_cache.enabled or (isinstance(data, dict) and ("error" in data or "message" in data)):
+            return
+        await repository_cache.set(self.model_type.__name__, versions, data, *params)
+
+    async def _invalidate(self, pk: Optional[int] = None, cascade: bool = False):
+        """
+        Invalidate cached reads and bump the change tokens after a committed write.
+
+        :param pk: Identifier of the written object, None for writes that only change lists.
+        :param cascade: Also drop models whose foreign keys react to a deletion of this model.
+        """
+        await repository_cache.invalidate(self.model_type.__name__, pk)
+        if cascade:
+            for mapper in Base.registry.mappers:
+                if any(fk.column.table is self.model_type.__table__ and fk.ondelete
+                       for fk in mapper.local_table.foreign_keys):
+                    await repository_cache.invalidate_all(mapper.class_.__name__)
+
+    def _unindexed_keys(self, keys):
+        """
+        Find filter keys no index can serve.
+
+        A key is served by an index when it is one of the index columns and every column
+        before it is filtered on as well.
+
+        :param keys: Filtered column names.
+        :return: Sorted list of the keys without an index.
+        """
+        table = self.model_type.__table__
+        indexes = [list(table.primary_key.columns)] + [list(index.columns) for index in table.indexes]
+        served = set()
+        for columns in indexes:
+            for column in columns:
+                if column.name not in keys:
+                    break
+                served.add(column.name)
+        return sorted(set(keys) - served)
+
+    def _columns(self, fields: Optional[Sequence[str]] = None, required: Sequence[str] = ()):
+        """
+        Columns to select for the requested fields.
+
+        :param fields: Requested column names, every column when omitted.
+        :param required: Columns the query needs besides the fields, e.g. its ordering.
+            The primary key is always selected.
+        :return: List of columns or the table itself.
+        :raises ValueError: If a field is not a column of the table.
+        """
+        table = self.model_type.__table__
+        if not fields:
+            return [table]
+        unknown = sorted(set(fields) - set(table.c.keys()))
+        if unknown:
+            raise ValueError(f"Unknown {self.model_type.__name__} fields: {', '.join(unknown)}.")
+        names = dict.fromkeys(["pk", *(name.lstrip("-") for name in required), *fields])
+        return [table.c[name] for name in names]
+
+    def _filter_query(self, filter_condition: Union[Dict, FilterSpec, None] = None, columns=None):
+        """
+        Build the filtered query of `filter_all`, checking its columns against FILTER_INDEX_POLICY.
+
+        Ordering and limit of the condition are left to the caller.
+
+        :param filter_condition: Filter condition or one already compiled with `parse_filter`.
+        :param columns: Selected columns, as returned by `_columns`.
+        :raises ValueError: If the condition is invalid or the policy rejects filters without an index.
+        """
+        spec = filter_condition
+        if not isinstance(spec, FilterSpec):
+            spec = parse_filter(self.model_type.__table__, filter_condition)
+        query = select(*(columns or [self.model_type.__table__]))
+        if not spec.conditions:
+            return query
+        if FILTER_INDEX_POLICY != "off":
+            unindexed = self._unindexed_keys(spec.columns)
+            if unindexed and FILTER_INDEX_POLICY == "reject":
+                raise ValueError(f"Filtering by {', '.join(unindexed)} is not supported.")
+            if unindexed and (self.model_type, tuple(unindexed)) not in _warned_filters:
+                # Once per key set, the same filter usually comes back on every request
+                _warned_filters.add((self.model_type, tuple(unindexed)))
+                logger.warning("%s filtered by unindexed %s", self.model_type.__name__, ", ".join(unindexed))
+        return query.where(*spec.conditions)
+
+    async def _stats_record(self, ss, rows):
+        """
+        Add created rows to the statistics, in the write transaction, see `core/stats.py`.
+
+        :param rows: Dictionary of tracked tables to the primary keys of the created rows.
+        """
+        await ss.flush()
+        await record(ss, Counter(), await snapshot(ss, rows))
+
+    async def retrieve_one(self, pk: int, fields: Optional[Sequence[str]] = None):
         """
         Retrieve one object by its identifier.
 
         :param pk: Object identifier.
+        :param fields: Columns to retrieve, all of them when omitted.
         :return: Dictionary with object data or a message indicating that the object was not found.
         """
-        async with self.session as ss:
-            async with ss.begin():
+        try:
+            columns = self._columns(fields)
+        except ValueError as ex:
+            return {"error": str(ex)}
+        # Projections are dropped by any write to the model, like lists, full objects only by their own
+        params = ("one", pk) if not fields else ("one_fields", pk, fields)
+        hit, data, versions = await self._cache_get(*params)
+        if hit:
+            return data
+        async with self._transaction(read=True) as ss:
+            if fields:
+                result = await ss.execute(select(*columns).where(self.model_type.__table__.c.pk == pk))
+                records = await row_to_dict(result, self.model_type.__table__)
+                result = records[0] if records else None
+            else:
                 result = await ss.get(self.model_type, pk)
-                return await retrieve_attributes(result) if result else {"message": f"{self.model_type.__name__} not found."}
+                result = await retrieve_attributes(result) if result else None
+            data = result if result else {"message": f"{self.model_type.__name__} not found."}
+        await self._cache_set(versions, data, *params)
+        return data
+
+    def _keyset(self, query, limit: Optional[int], after: Optional[str], cursor_columns=None):
+        """
+        Apply keyset pagination to a query.
+
+        :param query: Select statement over the model table.
+        :param limit: Page size, None keeps the query unbounded.
+        :param after: Cursor of the previous page.
+        :param cursor_columns: Ordering columns, defaults to `cursor_columns` of the repository.
+            Names starting with "-" sort in descending order.
+        :return: Ordered and limited select statement.
+        :raises ValueError: If the cursor is malformed.
+        """
+        table = self.model_type.__table__
+        names = cursor_columns or self.cursor_columns
+        columns = [table.c[name.lstrip("-")] for name in names]
+        descending = [name.startswith("-") for name in names]
+        # NULLs count as larger than any value, so that both databases page nullable columns the same way
+        query = query.order_by(*(
+            (column.desc().nulls_first() if desc else column.asc().nulls_last()) if column.nullable
+            else (column.desc() if desc else column)
+            for column, desc in zip(columns, descending)
+        ))
+        if after is not None:
+            values = decode_cursor(after, columns)
+            nullable = any(column.nullable for column in columns)
+            if len(columns) == 1 and not nullable:
+                query = query.where(columns[0] < values[0] if descending[0] else columns[0] > values[0])
+            elif not nullable and (all(descending) or not any(descending)):
+                # Row comparison, which an index on the columns can serve
+                query = query.where(tuple_(*columns) < tuple_(*values) if descending[0]
+                                    else tuple_(*columns) > tuple_(*values))
+            else:
+                conditions = []
+                for i, (column, value, desc) in enumerate(zip(columns, values, descending)):
+                    equal = [keyset_equal(columns[j], values[j]) for j in range(i)]
+                    conditions.append(and_(*equal, keyset_after(column, value, desc)))
+                query = query.where(or_(*conditions))
+        if limit is not None:
+            # One extra row tells whether there is a next page
+            query = query.limit(limit + 1)
+        return query
+
+    def _order_columns(self, order_by: List[str]):
+        """
+        Keyset columns of a requested ordering, ended by the primary key to make them unique.
+        """
+        if not order_by:
+            return self.cursor_columns
+        names = [name.lstrip("-") for name in order_by]
+        if "pk" in names:
+            return tuple(order_by[:names.index("pk") + 1])
+        return (*order_by, "-pk" if order_by[-1].startswith("-") else "pk")
 
-    async def retrieve_all(self):
+    async def retrieve_all(self, limit: Optional[int] = None, after: Optional[str] = None,
+                           fields: Optional[Sequence[str]] = None):
         """
         Retrieve all objects.
 
+        :param limit: Page size; when given, the result is a page with a `next_cursor`.
+        :param after: Cursor returned with the previous page.
+        :param fields: Columns to retrieve, all of them when omitted.
         :return: Dictionary with data of all objects or a message indicating that there are no objects.
         """
-        async with self.session as ss:
-            async with ss.begin():
-                result = await ss.execute(self.model_type.__table__.select())
-                return await row_to_dict(result) if result else {"message": f"No {self.model_type.__name__} objects."}
+        try:
+            query = self._keyset(select(*self._columns(fields, self.cursor_columns)), limit, after)
+        except ValueError as ex:
+            return {"error": str(ex)}
+        hit, data, versions = await self._cache_get("all", limit, after, fields)
+        if hit:
+            return data
+        async with self._transaction(read=True) as ss:
+            result = await ss.execute(query)
+            if limit is not None:
+                data = await paginate(result, limit, self.cursor_columns, self.model_type.__table__)
+            else:
+                data = await row_to_dict(result, self.model_type.__table__) if result else {"message": f"No {self.model_type.__name__} objects."}
+        await self._cache_set(versions, data, "all", limit, after, fields)
+        return data
 
-    async def filter_all(self, filter_condition: Optional[Dict] = None):
+    async def filter_all(self, filter_condition: Optional[Dict] = None, limit: Optional[int] = None,
+                         after: Optional[str] = None, fields: Optional[Sequence[str]] = None):
         """
         Retrieve objects based on a filter condition.
 
-        :param filter_condition: Dictionary representing the filter condition.
+        :param filter_condition: Dictionary representing the filter condition, see `FilterSpec`.
+        :param limit: Page size; when given, the result is a page with a `next_cursor`.
+            The `limit` of the condition can only lower it.
+        :param after: Cursor returned with the previous page.
+        :param fields: Columns to retrieve, all of them when omitted.
         :return: Dictionary with data of objects or a message indicating that there are no objects.
         """
-        async with self.session as ss:
-            async with ss.begin():
-                query = select(self.model_type.__table__)
-                if filter_condition:
-                    query = query.filter_by(**filter_condition)
-                result = await ss.execute(query)
-                return await row_to_dict(result) if result else {"message": f"No {self.model_type.__name__} objects."}
+        try:
+            spec = parse_filter(self.model_type.__table__, filter_condition)
+            cursor_columns = self._order_columns(spec.order_by)
+            if limit is not None and spec.limit is not None:
+                limit = min(limit, spec.limit)
+            columns = self._columns(fields, cursor_columns)
+            query = self._keyset(self._filter_query(spec, columns), limit, after, cursor_columns)
+            if limit is None and spec.limit is not None:
+                query = query.limit(spec.limit)
+        except ValueError as ex:
+            return {"error": str(ex)}
+        hit, data, versions = await self._cache_get("filter", filter_condition, limit, after, fields)
+        if hit:
+            return data
+        async with self._transaction(read=True) as ss:
+            result = await ss.execute(query)
+            if limit is not None:
+                data = await paginate(result, limit, cursor_columns, self.model_type.__table__)
+            else:
+                data = await row_to_dict(result, self.model_type.__table__) if result else {"message": f"No {self.model_type.__name__} objects."}
+        await self._cache_set(versions, data, "filter", filter_condition, limit, after, fields)
+        return data
+
+    async def search(self, text: str, limit: int = 50, after: Optional[str] = None):
+        """
+        Search objects by words in their indexed text columns, best matches first.
+
+        Only tables indexed with `full_text_search` can be searched.
+
+        :param text: Words to search for, all of them must match.
+        :param limit: Page size.
+        :param after: Cursor returned with the previous page.
+        :return: Page of objects with their `rank` and a `next_cursor`.
+        """
+        table = self.model_type.__table__
+        if not table.info.get("search_columns"):
+            return {"error": f"{self.model_type.__name__} objects cannot be searched."}
+        subquery = search_query(table, text, self.session.bind.dialect.name)
+        if subquery is None:
+            return {"items": [], "next_cursor": None}
+        columns = [subquery.c.rank, subquery.c.pk]
+        query = select(subquery).order_by(subquery.c.rank.desc(), subquery.c.pk.desc()).limit(limit + 1)
+        if after is not None:
+            try:
+                query = query.where(tuple_(*columns) < tuple_(*decode_cursor(after, columns)))
+            except ValueError as ex:
+                return {"error": str(ex)}
+        hit, data, versions = await self._cache_get("search", text, limit, after)
+        if hit:
+            return data
+        async with self._transaction(read=True) as ss:
+            result = await ss.execute(query)
+            data = await paginate(result, limit, ("-rank", "-pk"), table)
+        await self._cache_set(versions, data, "search", text, limit, after)
+        return data
+
+    async def stream_all(self, filter_condition: Optional[Dict] = None, batch_size: int = 1000):
+        """
+        Stream objects in batches through a server-side cursor.
+
+        Only one batch is held in memory at a time, so the cost does not depend on the table size.
+
+        :param filter_condition: Dictionary representing the filter condition.
+        :param batch_size: Number of rows fetched from the cursor at once.
+        :return: Async generator of lists with object data.
+        """
+        query = self._filter_query(filter_condition).order_by(self.model_type.__table__.c.pk)
+        async with self._transaction(read=True) as ss:
+            result = await ss.stream(query.execution_options(yield_per=batch_size))
+            column_names = list(result.keys())
+            async for partition in result.partitions():
+                yield format_records(column_names, partition, self.model_type.__table__)
 
     async def create(self, **kwargs):
         """
@@ -66,15 +407,161 @@ class BaseRepository:
         :param kwargs: Keyword arguments representing the object data.
         :return: Created object.
         """
-        async with self.session as ss:
-            async with ss.begin():
-                new_object = self.model_type(**kwargs)
-                try:
-                    ss.add(new_object)
-                    return {"message": f"A new {self.model_type.__name__} created: {new_object}."}
-                except Exception as e:
-                    print(e)
-                    return {"error": f"Database error!"}
+        async with self._transaction() as ss:
+            new_object = self.model_type(**kwargs)
+            try:
+                ss.add(new_object)
+                data = {"message": f"A new {self.model_type.__name__} created: {new_object}."}
+            except Exception as e:
+                print(e)
+                return {"error": f"Database error!"}
+            if "stats" in self.model_type.__table__.info:
+                await ss.flush()
+                await self._stats_record(ss, {self.model_type.__table__: [new_object.pk]})
+        await self._invalidate()
+        return data
+
+    async def create_many(self, rows: List[Dict]):
+        """
+        Create many objects with one multi-row INSERT ... RETURNING per set of given columns.
+
+        On PostgreSQL (asyncpg) large batches are copied into a temporary table with COPY and
+        moved with a single INSERT ... SELECT instead.
+
+        :param rows: Dictionaries representing the object data.
+        :return: Dictionary with the identifiers of the created objects in input order.
+        """
+        # Rows leaving out columns with server defaults are inserted separately, one statement per shape
+        groups = defaultdict(list)
+        for index, row in enumerate(rows):
+            groups[tuple(row)].append(index)
+
+        table = self.model_type.__table__
+        unknown = {column for columns in groups for column in columns if column not in table.c}
+        if unknown:
+            return {"error": f"Unknown {self.model_type.__name__} fields: {', '.join(sorted(unknown))}."}
+
+        pks = [None] * len(rows)
+        try:
+            async with self._transaction() as ss:
+                use_copy = ss.get_bind().dialect.driver == "asyncpg"
+                for columns, indexes in groups.items():
+                    batch = [rows[index] for index in indexes]
+                    if use_copy and len(batch) >= BULK_COPY_THRESHOLD:
+                        created = await self._copy_rows(ss, columns, batch)
+                    else:
+                        result = await ss.execute(insert(table).returning(table.c.pk, sort_by_parameter_order=True), batch)
+                        created = result.scalars().all()
+                    for index, pk in zip(indexes, created):
+                        pks[index] = pk
+                if "stats" in table.info:
+                    await self._stats_record(ss, {table: pks})
+        except SQLAlchemyError:
+            logger.exception(f"Bulk creation of {self.model_type.__name__} objects failed")
+            return {"error": "Database error!"}
+        await self._invalidate()
+        return {"message": f"{len(pks)} {self.model_type.__name__} objects created.", "pks": pks}
+
+    async def _copy_rows(self, ss, columns, rows):
+        """
+        Insert rows through COPY into a temporary table followed by INSERT ... SELECT ... RETURNING.
+
+        :param ss: Session with an open transaction on an asyncpg connection.
+        :param columns: Names of the given columns, the same for every row.
+        :param rows: Dictionaries representing the object data.
+        :return: Identifiers of the created objects in input order.
+        """
+        table_name = self.model_type.__tablename__
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        # The temporary table takes the column types of the target table, enums included
+        await ss.execute(text(
+            f'CREATE TEMP TABLE bulk_{table_name} ON COMMIT DROP AS '
+            f'SELECT {column_list} FROM "{table_name}" WITH NO DATA'
+        ))
+        await ss.execute(text(f"ALTER TABLE bulk_{table_name} ADD COLUMN bulk_position integer"))
+
+        connection = await ss.connection()
+        raw_connection = await connection.get_raw_connection()
+        records = [
+            tuple(value.name if isinstance(value, Enum) else value for value in row.values()) + (position,)
+            for position, row in enumerate(rows)
+        ]
+        await raw_connection.driver_connection.copy_records_to_table(
+            f"bulk_{table_name}", records=records, columns=[*columns, "bulk_position"]
+        )
+
+        result = await ss.execute(text(
+            f'INSERT INTO "{table_name}" ({column_list}) '
+            f'SELECT {column_list} FROM bulk_{table_name} ORDER BY bulk_position RETURNING pk'
+        ))
+        created = result.scalars().all()
+        await ss.execute(text(f"DROP TABLE bulk_{table_name}"))
+        return created
+
+    def _update_values(self, new_data: Dict):
+        """
+        Check and convert new column values sent by a client.
+
+        :raises ValueError: If a field is unknown, the primary key or has an invalid value.
+        """
+        table = self.model_type.__table__
+        unknown = sorted(key for key in new_data if key not in table.c or key == "pk")
+        if unknown:
+            raise ValueError(f"Unknown {self.model_type.__name__} fields: {', '.join(unknown)}.")
+        if not new_data:
+            raise ValueError("Nothing to update.")
+        return {key: coerce(table.c[key], value) for key, value in new_data.items()}
+
+    async def _update_where(self, ss, conditions, values):
+        """
+        Update the rows matching `conditions` with single UPDATE ... RETURNING statements.
+
+        When the new values move rows between statistics groups, the rows are locked and counted
+        first and updated by primary key.
+
+        :return: Identifiers of the updated objects.
+        """
+        table = self.model_type.__table__
+        columns = stat_columns(table)
+        if not any(column.name in values for column in columns):
+            statement = update(self.model_type).where(*conditions).values(**values).returning(table.c.pk)
+            return (await ss.execute(statement)).scalars().all()
+
+        result = await ss.execute(select(table.c.pk, *columns).where(*conditions).with_for_update())
+        rows = result.fetchall()
+        before = count_rows(table, [row[1:] for row in rows])
+        pks, after = [row.pk for row in rows], []
+        for start in range(0, len(pks), SNAPSHOT_CHUNK):
+            statement = (update(self.model_type).where(table.c.pk.in_(pks[start:start + SNAPSHOT_CHUNK]))
+                         .values(**values).returning(*columns))
+            after += (await ss.execute(statement)).fetchall()
+        await record(ss, before, count_rows(table, after))
+        return pks
+
+    async def _delete_where(self, ss, conditions):
+        """
+        Delete the rows matching `conditions` with a single DELETE ... RETURNING statement.
+
+        :return: Identifiers of the deleted objects.
+        """
+        table = self.model_type.__table__
+        columns = stat_columns(table)
+        files = file_columns(table)
+        # Rows whose foreign keys the database clears along with the deletion
+        dependent = await dependent_rows(ss, table, select(table.c.pk).where(*conditions))
+        dependent_before = await snapshot(ss, dependent, lock=True)
+
+        result = await ss.execute(delete(self.model_type).where(*conditions).returning(table.c.pk, *columns, *files))
+        rows = result.fetchall()
+        if columns or dependent:
+            before = (count_rows(table, [row[1:len(columns) + 1] for row in rows], dependent_before) if columns
+                      else dependent_before)
+            await record(ss, before, await snapshot(ss, dependent))
+        if files:
+            # Released once the transaction commits, see `_transaction`
+            ss.info.setdefault("released_files", []).extend(
+                path for row in rows for path in row[len(columns) + 1:] if path)
+        return [row.pk for row in rows]
 
     async def delete(self, pk: int):
         """
@@ -83,14 +570,12 @@ class BaseRepository:
         :param pk: Object identifier.
         :return: True if the object is successfully deleted, None if the object is not found.
         """
-        async with self.session as ss:
-            async with ss.begin():
-                obj = await ss.get(self.model_type, pk)
-                if obj:
-                    await ss.delete(obj)
-                    return {"message": f"The {self.model_type.__name__} with ID {pk} was deleted."}
-                else:
-                    return {"message": f"No {self.model_type.__name__} objects."}
+        async with self._transaction() as ss:
+            deleted = await self._delete_where(ss, [self.model_type.__table__.c.pk == pk])
+        if not deleted:
+            return {"message": f"No {self.model_type.__name__} objects."}
+        await self._invalidate(pk, cascade=True)
+        return {"message": f"The {self.model_type.__name__} with ID {pk} was deleted."}
 
     async def update(self, pk: int, new_data: dict):
         """
@@ -100,46 +585,185 @@ class BaseRepository:
         :param new_data: New data for updating.
         :return: True if the object is successfully updated, False if the object is not found.
         """
-        async with self.session as ss:
-            async with ss.begin():
-                obj = await ss.get(self.model_type, pk)
-                if obj:
-                    for key, value in new_data.items():
-                        setattr(obj, key, value)
-                    return {"message": f"The {self.model_type.__name__} with ID {pk} was updated."}
-                else:
-                    return {"message": f"No {self.model_type.__name__} objects."}
+        try:
+            values = self._update_values(new_data)
+        except ValueError as ex:
+            return {"error": str(ex)}
+        async with self._transaction() as ss:
+            updated = await self._update_where(ss, [self.model_type.__table__.c.pk == pk], values)
+        if not updated:
+            return {"message": f"No {self.model_type.__name__} objects."}
+        await self._invalidate(pk)
+        return {"message": f"The {self.model_type.__name__} with ID {pk} was updated."}
+
+    async def update_many(self, filter_condition: Dict, new_data: Dict):
+        """
+        Update every object matching a filter condition in one statement.
+
+        :param filter_condition: Filter condition as taken by `filter_all`, ordering and limit are ignored.
+        :param new_data: New data for updating.
+        :return: Dictionary with the number of updated objects.
+        """
+        try:
+            spec = parse_filter(self.model_type.__table__, filter_condition)
+            if not spec.conditions:
+                raise ValueError("A filter is required.")
+            values = self._update_values(new_data)
+        except ValueError as ex:
+            return {"error": str(ex)}
+        try:
+            async with self._transaction() as ss:
+                updated = await self._update_where(ss, spec.conditions, values)
+        except SQLAlchemyError:
+            logger.exception(f"Bulk update of {self.model_type.__name__} objects failed")
+            return {"error": "Database error!"}
+        if updated:
+            await repository_cache.invalidate_all(self.model_type.__name__)
+        return {"message": f"{len(updated)} {self.model_type.__name__} objects were updated.", "count": len(updated)}
+
+    async def delete_many(self, filter_condition: Dict):
+        """
+        Delete every object matching a filter condition in one statement.
+
+        :param filter_condition: Filter condition as taken by `filter_all`, ordering and limit are ignored.
+        :return: Dictionary with the number of deleted objects.
+        """
+        try:
+            spec = parse_filter(self.model_type.__table__, filter_condition)
+            if not spec.conditions:
+                raise ValueError("A filter is required.")
+        except ValueError as ex:
+            return {"error": str(ex)}
+        try:
+            async with self._transaction() as ss:
+                deleted = await self._delete_where(ss, spec.conditions)
+        except SQLAlchemyError:
+            logger.exception(f"Bulk deletion of {self.model_type.__name__} objects failed")
+            return {"error": "Database error!"}
+        if deleted:
+            await repository_cache.invalidate_all(self.model_type.__name__)
+            await self._invalidate(cascade=True)
+        return {"message": f"{len(deleted)} {self.model_type.__name__} objects were deleted.", "count": len(deleted)}
 
 
 class AdvertisementRepository(BaseRepository):
-    def __init__(self):
-        super().__init__(Advertisement)
+    def __init__(self, session: Optional[AsyncSession] = None):
+        super().__init__(Advertisement, session)
 
-    async def filter_by_time(self, days):
+    @staticmethod
+    def _by_time_query(days, columns=None):
+        time_interval = datetime.now() - timedelta(days=days)
+        return select(*(columns or [Advertisement.__table__])).where(Advertisement.published_time >= time_interval)
+
+    async def filter_by_time(self, days, limit: Optional[int] = None, after: Optional[str] = None,
+                             fields: Optional[Sequence[str]] = None):
         """
         Retrieve advertisements published in the last N days.
 
         :param days: Number of days to retrieve advertisements for.
+        :param limit: Page size; when given, the result is a page with a `next_cursor`.
+        :param after: Cursor returned with the previous page.
+        :param fields: Columns to retrieve, all of them when omitted.
         :return: Dictionary with data of advertisements or a message indicating that there are no advertisements.
         """
-        time_interval = datetime.now() - timedelta(days=days)
-        async with self.session as ss:
-            async with ss.begin():
-                result = await ss.execute(
-                    select(Advertisement.__table__).where(Advertisement.published_time >= time_interval))
-                return await row_to_dict(result) if result else {"message": "No advertisements."}
+        cursor_columns = ("published_time", "pk")
+        try:
+            columns = self._columns(fields, cursor_columns)
+            query = self._keyset(self._by_time_query(days, columns), limit, after, cursor_columns)
+        except ValueError as ex:
+            return {"error": str(ex)}
+        hit, data, versions = await self._cache_get("by_time", days, limit, after, fields)
+        if hit:
+            return data
+        async with self._transaction(read=True) as ss:
+            result = await ss.execute(query)
+            if limit is not None:
+                data = await paginate(result, limit, cursor_columns, Advertisement.__table__)
+            else:
+                data = await row_to_dict(result, self.model_type.__table__) if result else {"message": "No advertisements."}
+        await self._cache_set(versions, data, "by_time", days, limit, after, fields)
+        return data
 
 
 class ShelterRepository(BaseRepository):
-    def __init__(self):
-        super().__init__(Shelter)
+    def __init__(self, session: Optional[AsyncSession] = None):
+        super().__init__(Shelter, session)
+
+    async def include_animals(self, shelters: List[Dict], limit: int):
+        """
+        Add the first page of animals to every shelter, loaded for all of them in one query.
+
+        :param shelters: Shelters as returned by the read methods, they are not modified.
+        :param limit: Page size of animals per shelter.
+        :return: Copies of the shelters with an `animals` page.
+        """
+        animals = AnimalRepository(None if self._owns_session else self.session)
+        pages = await animals.by_shelters([shelter["pk"] for shelter in shelters], limit)
+        empty = {"items": [], "next_cursor": None}
+        return [{**shelter, "animals": pages.get(shelter["pk"], empty)} for shelter in shelters]
 
 
 class AnimalRepository(BaseRepository):
-    def __init__(self):
-        super().__init__(Animal)
+    def __init__(self, session: Optional[AsyncSession] = None):
+        super().__init__(Animal, session)
+
+    async def by_shelters(self, shelter_pks: List[int], limit: int):
+        """
+        Retrieve the first page of animals of several shelters in one query.
+
+        Every shelter gets at most `limit` animals, numbered by a window function, so the
+        cost is bounded whatever the shelters hold. The cursors continue with `filter_all`
+        on the shelter, as served by /shelters/{pk}/animals.
+
+        :param shelter_pks: Shelter identifiers.
+        :param limit: Page size per shelter.
+        :return: Dictionary of shelter identifiers to pages, shelters without animals are left out.
+        """
+        if not shelter_pks:
+            return {}
+        shelter_pks = sorted(set(shelter_pks))
+        hit, data, versions = await self._cache_get("by_shelters", shelter_pks, limit)
+        if hit:
+            return data
+        table = Animal.__table__
+        position = func.row_number().over(partition_by=table.c.shelter_id, order_by=table.c.pk)
+        numbered = select(table, position.label("position")).where(table.c.shelter_id.in_(shelter_pks)).subquery()
+        query = (select(*(numbered.c[column.name] for column in table.columns))
+                 .where(numbered.c.position <= limit + 1)
+                 .order_by(numbered.c.shelter_id, numbered.c.pk))
+        async with self._transaction(read=True) as ss:
+            result = await ss.execute(query)
+            column_names = list(result.keys())
+            rows = defaultdict(list)
+            for row in result.fetchall():
+                rows[row.shelter_id].append(row)
+        data = {}
+        for shelter_pk, animals in rows.items():
+            page = animals[:limit]
+            data[shelter_pk] = {
+                "items": format_records(column_names, page, table),
+                "next_cursor": encode_cursor([page[-1].pk]) if len(animals) > limit else None,
+            }
+        await self._cache_set(versions, data, "by_shelters", shelter_pks, limit)
+        return data
+
+
+class StatisticRepository(BaseRepository):
+    def __init__(self, session: Optional[AsyncSession] = None):
+        super().__init__(Statistic, session)
+
+    async def summary(self):
+        """
+        Retrieve the grouped counts of the tracked tables.
+
+        The counts are kept up to date by every write, so reading them costs one row per group.
+
+        :return: Dictionary of table names to dimensions to counts per value, with a `total` per table.
+        """
+        async with self._transaction(read=True) as ss:
+            return await summary(ss)
 
 
 class UserRepository(BaseRepository):
-    def __init__(self):
-        super().__init__(User)
+    def __init__(self, session: Optional[AsyncSession] = None):
+        super().__init__(User, session)
@@ -0,0 +1,76 @@
+import re
+from sqlalchemy import DDL, Float, event, func, literal_column, select, table as table_clause, column as column_clause
+
+
+# Text search configuration of the PostgreSQL search vectors, changing it needs a migration
+SEARCH_CONFIG = "simple"
+WORD = re.compile(r"\w+")
+
+
+def full_text_search(table, *columns):
+    """
+    Create the full-text index of a table along with the table.
+
+    PostgreSQL gets a generated `search_vector` column with a GIN index, SQLite an external
+    content FTS5 table kept in sync by triggers. The same objects are created by the
+    migrations of existing databases.
+
+    :param table: Indexed table.
+    :param columns: Names of the text columns to index.
+    """
+    table.info["search_columns"] = columns
+    name = table.name
+    document = " || ' ' || ".join(f"coalesce({column}, '')" for column in columns)
+    column_list = ", ".join(columns)
+    new_values = ", ".join(f"new.{column}" for column in columns)
+    old_values = ", ".join(f"old.{column}" for column in columns)
+
+    postgresql = [
+        f"ALTER TABLE {name} ADD COLUMN search_vector tsvector "
+        f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', {document})) STORED",
+        f"CREATE INDEX ix_{name}_search_vector ON {name} USING gin (search_vector)",
+    ]
+    sqlite = [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {name}_fts USING fts5({column_list}, content='{name}', content_rowid='pk')",
+        f"CREATE TRIGGER {name}_fts_insert AFTER INSERT ON {name} BEGIN "
+        f"INSERT INTO {name}_fts (rowid, {column_list}) VALUES (new.pk, {new_values}); END",
+        f"CREATE TRIGGER {name}_fts_delete AFTER DELETE ON {name} BEGIN "
+        f"INSERT INTO {name}_fts ({name}_fts, rowid, {column_list}) VALUES ('delete', old.pk, {old_values}); END",
+        f"CREATE TRIGGER {name}_fts_update AFTER UPDATE ON {name} BEGIN "
+        f"INSERT INTO {name}_fts ({name}_fts, rowid, {column_list}) VALUES ('delete', old.pk, {old_values}); "
+        f"INSERT INTO {name}_fts (rowid, {column_list}) VALUES (new.pk, {new_values}); END",
+    ]
+    for statement in postgresql:
+        event.listen(table, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+    for statement in sqlite:
+        event.listen(table, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+    event.listen(table, "after_drop", DDL(f"DROP TABLE IF EXISTS {name}_fts").execute_if(dialect="sqlite"))
+
+
+def search_query(table, text, dialect):
+    """
+    Build a ranked full-text search over a table indexed with `full_text_search`.
+
+    :param table: Searched table.
+    :param text: Words to search for, all of them must match.
+    :param dialect: Name of the database dialect.
+    :return: Subquery with the table columns and a `rank` column, higher is better;
+        None when the text has no words.
+    """
+    words = WORD.findall(text)
+    if not words:
+        return None
+    if dialect == "postgresql":
+        query = func.plainto_tsquery(SEARCH_CONFIG, " ".join(words))
+        vector = literal_column("search_vector")
+        rank = func.ts_rank_cd(vector, query, type_=Float)
+        statement = select(table, rank.label("rank")).where(vector.op("@@")(query))
+    else:
+        fts = table_clause(f"{table.name}_fts", column_clause("rowid"))
+        # Quoted words are matched literally, whatever FTS5 query syntax they contain
+        match = " ".join('"{}"'.format(word.replace('"', '""')) for word in words)
+        rank = -func.bm25(literal_column(fts.name), type_=Float)
+        statement = (select(table, rank.label("rank"))
+                     .join(fts, fts.c.rowid == table.c.pk)
+                     .where(literal_column(fts.name).op("MATCH")(match)))
+    return statement.subquery()
@@ -1,5 +1,85 @@
+import base64
+import orjson
 from datetime import datetime
-from enum import Enum
+from functools import lru_cache
+from operator import attrgetter
+from sqlalchemy import DateTime, Enum
+from src.db_handlers.config import THUMBNAIL_URL_TEMPLATE
+
+
+DATETIME_FORMAT = "%Y-%m-%d %I:%M %p"
+
+
+def format_datetime(value):
+    return value.strftime(DATETIME_FORMAT)
+
+
+def thumbnail_url(image_path):
+    return THUMBNAIL_URL_TEMPLATE.format(image_path=image_path) if image_path else None
+
+
+class TableSerializer:
+    """
+    Row serializer compiled once per table.
+
+    Converters are picked from the column types ahead of time, so rows are converted without
+    inspecting every value: enum columns are replaced by their values, datetime columns are
+    formatted and all other values are passed through as they are. Tables with images also
+    get the URL of their thumbnail.
+    """
+
+    def __init__(self, table):
+        self.with_thumbnail = "image_path" in table.c
+        self.converters = {}
+        for column in table.columns:
+            if isinstance(column.type, Enum) and column.type.enum_class is not None:
+                self.converters[column.name] = attrgetter("value")
+            elif isinstance(column.type, DateTime):
+                self.converters[column.name] = format_datetime
+
+    def records(self, column_names, rows):
+        """
+        Convert rows to a list of dictionaries.
+
+        Args:
+            column_names: Names of the selected columns.
+            rows: Sequence of rows.
+
+        Returns:
+            list: A list of dictionaries, each representing a row.
+        """
+        column_names = list(column_names)
+        converters = [(name, self.converters[name]) for name in column_names if name in self.converters]
+        records = [dict(zip(column_names, row)) for row in rows]
+        for name, convert in converters:
+            for record in records:
+                value = record[name]
+                if value is not None:
+                    record[name] = convert(value)
+        if self.with_thumbnail and "image_path" in column_names:
+            for record in records:
+                record["thumbnail_url"] = thumbnail_url(record["image_path"])
+        return records
+
+    def record(self, attributes):
+        """
+        Convert a dictionary of column values in place.
+        """
+        for name, convert in self.converters.items():
+            value = attributes.get(name)
+            if value is not None:
+                attributes[name] = convert(value)
+        if self.with_thumbnail and "image_path" in attributes:
+            attributes["thumbnail_url"] = thumbnail_url(attributes["image_path"])
+        return attributes
+
+
+@lru_cache(maxsize=None)
+def get_serializer(table):
+    """
+    Get the serializer of a table, compiling it on first use.
+    """
+    return TableSerializer(table)
 
 
 async def retrieve_attributes(obj):
@@ -12,41 +92,103 @@ async def retrieve_attributes(obj):
     Returns:
         dict: A dictionary containing user-defined attributes.
     """
-    obj_attributes = obj.__dict__
+    attributes = {key: value for key, value in obj.__dict__.items() if not key.startswith('_')}
+    return get_serializer(obj.__table__).record(attributes)
+
+
+def format_records(column_names, records, table):
+    """
+    Convert raw rows of a table to a list of dictionaries.
 
-    # Convert enum values to string
-    formatted_attributes = {
-        key: value.value if isinstance(value, Enum) else (
-            value.strftime("%Y-%m-%d %I:%M %p") if isinstance(value, datetime) else value
-        )
-        for key, value in obj_attributes.items() if not key.startswith('_')
-    }
+    Args:
+        column_names: Names of the selected columns.
+        records: Sequence of rows.
+        table: Table the rows were selected from.
 
-    return formatted_attributes
+    Returns:
+        list: A list of dictionaries, each representing a row.
+    """
+    return get_serializer(table).records(column_names, records)
 
 
-async def row_to_dict(result):
+async def row_to_dict(result, table):
     """
     Convert rows from a ResultProxy to a list of dictionaries.
 
     Args:
         result: SQLAlchemy ResultProxy.
+        table: Table the rows were selected from.
 
     Returns:
         list: A list of dictionaries, each representing a row.
     """
-    column_names = result.keys()
+    return format_records(result.keys(), result.fetchall(), table)
+
+
+def encode_cursor(values):
+    """
+    Encode the keyset values of the last row of a page into an opaque cursor.
+
+    Args:
+        values: Values of the ordering columns, datetimes included.
+
+    Returns:
+        str: URL-safe cursor string.
+    """
+    return base64.urlsafe_b64encode(orjson.dumps(list(values))).decode()
+
+
+def decode_cursor(cursor, columns):
+    """
+    Decode a cursor produced by `encode_cursor` for the given ordering columns.
+
+    Args:
+        cursor: Cursor string received from the client.
+        columns: SQLAlchemy columns the cursor was built from.
+
+    Returns:
+        list: Keyset values typed for comparison against the columns.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as ex:
+        raise ValueError("Invalid cursor.") from ex
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError("Invalid cursor.")
+
+    # Datetimes travel as ISO strings, restore them for the comparison
+    for i, column in enumerate(columns):
+        if values[i] is not None and column.type.python_type is datetime:
+            values[i] = datetime.fromisoformat(values[i])
+    return values
+
+
+async def paginate(result, limit, cursor_columns, table):
+    """
+    Convert one keyset page of rows to dictionaries along with the next cursor.
+
+    The query is expected to fetch ``limit + 1`` rows, the extra row only signals
+    that another page exists.
+
+    Args:
+        result: SQLAlchemy ResultProxy.
+        limit: Page size requested by the client.
+        cursor_columns: Names of the ordering columns, with a "-" for descending ones.
+        table: Table the rows were selected from.
+
+    Returns:
+        dict: ``items`` with the page rows and ``next_cursor`` (None on the last page).
+    """
+    column_names = list(result.keys())
     records = result.fetchall()
+    page = records[:limit]
+
+    next_cursor = None
+    if len(records) > limit:
+        last = page[-1]._mapping
+        next_cursor = encode_cursor(last[name.lstrip("-")] for name in cursor_columns)
 
-    # Convert datetime objects and Enum values to formatted strings
-    formatted_records = []
-    for record in records:
-        formatted_record = {
-            key: value.value if isinstance(value, Enum) else (
-                value.strftime("%Y-%m-%d %I:%M %p") if isinstance(value, datetime) else value
-            )
-            for key, value in zip(column_names, record)
-        }
-        formatted_records.append(formatted_record)
-
-    return formatted_records
+    return {"items": format_records(column_names, page, table), "next_cursor": next_cursor}
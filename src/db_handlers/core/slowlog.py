@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+from itertools import groupby
+from sqlalchemy import event, text
+from src.db_handlers.config import (SLOW_QUERY_SECONDS, SLOW_QUERY_LOG_SIZE, SLOW_QUERY_EXPLAIN,
+                                    SLOW_QUERY_EXPLAIN_INTERVAL)
+from .metrics import query_timing
+
+
+logger = logging.getLogger("slow_query")
+
+# Longest statement text kept, bulk INSERTs can run to megabytes
+MAX_STATEMENT_LENGTH = 4000
+EXPLAIN_TIMEOUT_MS = 30000
+
+
+def parameter_shape(parameters):
+    """
+    Describe bound parameters by their types, never their values.
+
+    Runs of the same type are collapsed, so an IN list of a thousand integers is `["int x 1000"]`.
+    """
+    if isinstance(parameters, list):
+        return {"rows": len(parameters), "row": parameter_shape(parameters[0]) if parameters else None}
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    names = [type(value).__name__ for value in parameters or ()]
+    runs = [(name, len(list(group))) for name, group in groupby(names)]
+    return [name if count == 1 else f"{name} x {count}" for name, count in runs]
+
+
+def explainable(statement: str) -> bool:
+    # EXPLAIN ANALYZE runs the statement, so only plain reads are explained
+    words = statement.lstrip().upper()
+    return words.startswith("SELECT") and "FOR UPDATE" not in words
+
+
+class SlowQueryLog:
+    """
+    Log of the statements slower than `threshold` seconds, keeping the last `size` of them.
+
+    Every entry has the statement, the shape of its parameters, its duration and the route of the
+    request that ran it. With `explain` on, the plan of a slow SELECT is captured on its own
+    connection, `EXPLAIN (ANALYZE, BUFFERS)` on PostgreSQL and `EXPLAIN QUERY PLAN` on SQLite,
+    at most once every `explain_interval` seconds.
+    """
+
+    def __init__(self, threshold: float, size: int, explain: bool, explain_interval: float):
+        self.threshold = threshold
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.entries = deque(maxlen=size)
+        self._last_explain = None
+        self._explaining = None
+        # Async engines by their sync engine, plans are captured on the database that ran the statement
+        self._engines = {}
+
+    def attach(self, engine):
+        """
+        Time the statements of an async engine.
+        """
+        self._engines[engine.sync_engine] = engine
+        event.listen(engine.sync_engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine.sync_engine, "after_cursor_execute", self.after_cursor_execute)
+        event.listen(engine.sync_engine, "handle_error", self.handle_error)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_started", []).append(time.perf_counter())
+
+    def handle_error(self, exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("slow_query_started"):
+            connection.info["slow_query_started"].pop()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["slow_query_started"].pop()
+        if self.threshold and elapsed >= self.threshold:
+            self.add(statement, parameters, elapsed, self._engines.get(conn.engine))
+
+    def add(self, statement, parameters, elapsed, engine=None):
+        timing = query_timing.get()
+        entry = {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "duration_ms": round(elapsed * 1000, 3),
+            "route": timing.origin() if timing is not None and timing.origin is not None else None,
+            "statement": statement[:MAX_STATEMENT_LENGTH],
+            "parameters": parameter_shape(parameters),
+            "plan": None,
+        }
+        self.entries.append(entry)
+        logger.warning("Slow query %.1f ms from %s: %s %s", entry["duration_ms"], entry["route"] or "no route",
+                       entry["statement"], entry["parameters"])
+
+        now = time.monotonic()
+        if (self.explain and engine is not None and self._explaining is None and explainable(statement)
+                and (self._last_explain is None or now - self._last_explain >= self.explain_interval)):
+            self._last_explain = now
+            self._explaining = asyncio.get_running_loop().create_task(
+                self.capture_plan(engine, entry, statement, parameters))
+
+    async def capture_plan(self, engine, entry, statement, parameters):
+        try:
+            async with engine.connect() as connection:
+                if connection.dialect.name == "postgresql":
+                    await connection.execute(text(f"SET LOCAL statement_timeout = {EXPLAIN_TIMEOUT_MS}"))
+                    result = await connection.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters)
+                    entry["plan"] = [row[0] for row in result.fetchall()]
+                else:
+                    result = await connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+                    entry["plan"] = [row[-1] for row in result.fetchall()]
+                # Whatever ANALYZE did is not kept
+                await connection.rollback()
+        except Exception:
+            logger.exception("EXPLAIN of a slow query failed")
+        finally:
+            self._explaining = None
+
+    def recent(self, limit=None):
+        """
+        Get the logged statements, the slowest first.
+        """
+        entries = sorted(self.entries, key=lambda entry: entry["duration_ms"], reverse=True)
+        return entries[:limit]
+
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_SECONDS, SLOW_QUERY_LOG_SIZE, SLOW_QUERY_EXPLAIN,
+                              SLOW_QUERY_EXPLAIN_INTERVAL)
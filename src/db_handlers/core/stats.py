@@ -0,0 +1,203 @@
+import asyncio
+from collections import Counter
+from enum import Enum
+from sqlalchemy import delete, func, select, text
+from .models import Advertisement, Animal, Statistic
+
+
+# Largest IN list of one snapshot query
+SNAPSHOT_CHUNK = 1000
+
+
+def month(value):
+    return value.strftime("%Y-%m")
+
+
+def track_stats(table, **dimensions):
+    """
+    Keep grouped counts of a table in the `statistics` table.
+
+    Every dimension counts the rows per value of a column, optionally transformed (e.g. `month`).
+    A `total` dimension is always added. The repositories update the counts in the transaction
+    of every write, `recompute` rebuilds them from the tables.
+
+    :param table: Tracked table.
+    :param dimensions: Dimension names mapped to a column name or a tuple of a column name and a transform.
+    """
+    table.info["stats"] = {
+        name: spec if isinstance(spec, tuple) else (spec, None) for name, spec in dimensions.items()
+    }
+
+
+def stat_key(value, transform=None):
+    if value is None:
+        return "none"
+    if transform is not None:
+        value = transform(value)
+    return str(value.value if isinstance(value, Enum) else value)
+
+
+def dependents(table):
+    """
+    Tracked tables whose foreign keys are changed by the database when a row of `table` is deleted.
+
+    :return: List of tuples of the dependent table and its foreign key column.
+    """
+    return [
+        (other, fk.parent)
+        for other in table.metadata.tables.values() if "stats" in other.info
+        for fk in other.foreign_keys if fk.column.table is table and fk.ondelete
+    ]
+
+
+def stat_columns(table):
+    """
+    Columns of the dimensions of a table, in dimension order; none for untracked tables.
+    """
+    return [table.c[column] for column, _ in table.info.get("stats", {}).values()]
+
+
+def count_rows(table, rows, counts=None):
+    """
+    Count rows per dimension value.
+
+    :param rows: Sequences of the `stat_columns` values of the rows.
+    :param counts: Counter to add to, a new one when omitted.
+    :return: Counter of (table name, dimension, key) tuples.
+    """
+    counts = Counter() if counts is None else counts
+    dimensions = table.info["stats"]
+    for row in rows:
+        counts[(table.name, "total", "all")] += 1
+        for value, (name, (_, transform)) in zip(row, dimensions.items()):
+            counts[(table.name, name, stat_key(value, transform))] += 1
+    return counts
+
+
+async def dependent_rows(ss, table, pks):
+    """
+    Collect the tracked rows referencing rows of `table` that are about to be deleted.
+
+    :param pks: Primary keys of the deleted rows, or a select of them.
+    :return: Dictionary of tracked tables to primary keys.
+    """
+    rows = {}
+    for other, column in dependents(table):
+        result = await ss.execute(select(other.c.pk).where(column.in_(pks)))
+        rows.setdefault(other, []).extend(result.scalars().all())
+    return rows
+
+
+async def snapshot(ss, rows, lock=False):
+    """
+    Count the given rows per dimension value.
+
+    :param rows: Dictionary of tracked tables to primary keys.
+    :param lock: Lock the rows until the end of the transaction, so concurrent writes to them
+        wait instead of counting from the same state.
+    :return: Counter of (table name, dimension, key) tuples.
+    """
+    counts = Counter()
+    for table, pks in rows.items():
+        for start in range(0, len(pks), SNAPSHOT_CHUNK):
+            query = select(*stat_columns(table)).where(table.c.pk.in_(pks[start:start + SNAPSHOT_CHUNK]))
+            result = await ss.execute(query.with_for_update() if lock else query)
+            count_rows(table, result.fetchall(), counts)
+    return counts
+
+
+async def record(ss, before, after):
+    """
+    Apply the difference of two snapshots to the stored counts.
+    """
+    deltas = {key: after.get(key, 0) - before.get(key, 0) for key in before.keys() | after.keys()}
+    values = [
+        {"table_name": table_name, "dimension": dimension, "key": key, "count": delta}
+        # Rows are locked in the same order by every writer
+        for (table_name, dimension, key), delta in sorted(deltas.items()) if delta
+    ]
+    if not values:
+        return
+    await ss.execute(upsert(ss, increment=True), values)
+
+
+def upsert(ss, increment):
+    """
+    INSERT of `statistics` rows that adds to or replaces the counts of existing ones.
+    """
+    table = Statistic.__table__
+    # Dialect modules are imported with the engine, not with the application
+    if ss.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    statement = insert(table)
+    count = table.c.count + statement.excluded.count if increment else statement.excluded.count
+    return statement.on_conflict_do_update(index_elements=["table_name", "dimension", "key"], set_={"count": count})
+
+
+async def summary(ss):
+    """
+    Read the stored counts.
+
+    :return: Dictionary of table names to dimensions to counts per key.
+    """
+    table = Statistic.__table__
+    result = await ss.execute(
+        select(table.c.table_name, table.c.dimension, table.c.key, table.c.count)
+        .where(table.c.count > 0)
+        .order_by(table.c.table_name, table.c.dimension, table.c.key)
+    )
+    data = {
+        tracked.name: {"total": 0, **{dimension: {} for dimension in tracked.info["stats"]}}
+        for tracked in Statistic.metadata.tables.values() if "stats" in tracked.info
+    }
+    for table_name, dimension, key, count in result.fetchall():
+        if dimension == "total":
+            data[table_name]["total"] = count
+        else:
+            data[table_name][dimension][key] = count
+    return data
+
+
+async def recompute(ss):
+    """
+    Rebuild every stored count from the tracked tables with one GROUP BY per dimension.
+    """
+    if ss.get_bind().dialect.name == "postgresql":
+        # Writers wait before adding their deltas, so no count is applied twice or lost
+        await ss.execute(text("LOCK TABLE statistics IN EXCLUSIVE MODE"))
+    await ss.execute(delete(Statistic.__table__))
+    for table in Statistic.metadata.tables.values():
+        if "stats" not in table.info:
+            continue
+        total = await ss.execute(select(func.count()).select_from(table))
+        counts = Counter({(table.name, "total", "all"): total.scalar()})
+        for name, (column, transform) in table.info["stats"].items():
+            result = await ss.execute(select(table.c[column], func.count()).group_by(table.c[column]))
+            for value, count in result.fetchall():
+                counts[(table.name, name, stat_key(value, transform))] += count
+        values = [
+            {"table_name": table_name, "dimension": dimension, "key": key, "count": count}
+            for (table_name, dimension, key), count in sorted(counts.items()) if count
+        ]
+        if values:
+            await ss.execute(upsert(ss, increment=False), values)
+
+
+track_stats(Animal.__table__, species="species", sex="sex", shelter="shelter_id", intake_month=("since_time", month))
+track_stats(Advertisement.__table__, published_month=("published_time", month))
+
+
+async def main():
+    from src.db_handlers.db_manage import AsyncSessionLocal
+
+    async with AsyncSessionLocal() as ss:
+        async with ss.begin():
+            await recompute(ss)
+            print(await summary(ss))
+
+
+if __name__ == "__main__":
+    # Repair: python -m src.db_handlers.core.stats
+    asyncio.run(main())
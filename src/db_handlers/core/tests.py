@@ -1,6 +1,20 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
 import pytest
 from datetime import datetime
-from .orm import AdvertisementRepository, ShelterRepository, AnimalRepository
+from unittest import mock
+from fastapi.concurrency import run_in_threadpool
+from .orm import AdvertisementRepository, ShelterRepository, AnimalRepository, UserRepository, StatisticRepository
+from .stats import recompute, summary as summary_of
+from src.db_handlers import db_manage
+from src.db_handlers.db_manage import AsyncSessionLocal, get_engine, get_session
+from src.db_handlers.core.cache import CacheBackend, LRUCache, RepositoryCache, SQLiteCache, repository_cache
+from src.db_handlers.core.explain import query_plan, is_full_scan
+from src.db_handlers.core.models import SexEnum, SpeciesEnum
+from src.db_handlers.core.slowlog import slow_query_log, parameter_shape
 
 
 @pytest.mark.asyncio_cooperative
@@ -114,6 +128,9 @@ async def test_shelter_repository():
 @pytest.mark.asyncio_cooperative
 async def test_animal_repository():
     repository = AnimalRepository()
+    # Foreign keys are enforced, the animal needs a shelter of its own
+    shelter = (await ShelterRepository().create_many([{"title": "Animal Shelter", "address": "Test Location",
+                                                       "phone_number": "+77005004433"}]))["pks"][0]
 
     # Create an animal for testing
     animal_data = {
@@ -123,7 +140,7 @@ async def test_animal_repository():
         "image_path": "static/free_image.jpg",
         "species": "cat",  # Replace with a valid species value
         "since_time": datetime.now(),
-        "shelter_id": 3,  # Replace with a valid shelter_id if needed
+        "shelter_id": shelter,
     }
     await repository.create(**animal_data)
 
@@ -163,6 +180,419 @@ async def test_animal_repository():
     await repository.delete(retrieved_animal['pk'])
     deleted_animal = await repository.retrieve_one(retrieved_animal['pk'])
     assert "message" in deleted_animal and "not found" in deleted_animal["message"]
+    await ShelterRepository().delete(shelter)
+
+
+@pytest.mark.asyncio_cooperative
+async def test_keyset_pagination():
+    repository = ShelterRepository()
+
+    # Create a few shelters to page through
+    for i in range(5):
+        await ShelterRepository().create(title="Paginated Shelter", address=f"Street {i}", phone_number="+77005004455")
+
+    # Walk all pages of two objects each
+    pks = []
+    page = await repository.filter_all({"title": "Paginated Shelter"}, limit=2)
+    pages = 1
+    while page["next_cursor"]:
+        assert len(page["items"]) == 2
+        pks.extend(item["pk"] for item in page["items"])
+        page = await repository.filter_all({"title": "Paginated Shelter"}, limit=2, after=page["next_cursor"])
+        pages += 1
+    pks.extend(item["pk"] for item in page["items"])
+
+    # Every object is returned exactly once, in primary key order
+    assert pages == 3
+    assert len(pks) == 5 and pks == sorted(set(pks))
+
+    # Test retrieve_all pagination and a malformed cursor
+    first_page = await repository.retrieve_all(limit=1)
+    assert len(first_page["items"]) == 1 and first_page["next_cursor"]
+    assert "error" in await repository.retrieve_all(limit=1, after="not-a-cursor")
+
+    for pk in pks:
+        await repository.delete(pk)
+
+
+@pytest.mark.asyncio_cooperative
+async def test_stream_all():
+    repository = ShelterRepository()
+
+    for i in range(3):
+        await ShelterRepository().create(title="Streamed Shelter", address=f"Street {i}", phone_number="+77005004455")
+
+    # Batches never exceed the requested size and together hold every object
+    batches = [batch async for batch in repository.stream_all({"title": "Streamed Shelter"}, batch_size=2)]
+    assert all(len(batch) <= 2 for batch in batches)
+    streamed = [item for batch in batches for item in batch]
+    assert len(streamed) == 3
+
+    for item in streamed:
+        await repository.delete(item["pk"])
+
+
+@pytest.mark.asyncio_cooperative
+async def test_request_scoped_session():
+    # Repositories of one request share the session provided by the dependency
+    async for ss in get_session():
+        shelters = ShelterRepository(ss)
+        await shelters.create(title="Shared Session Shelter", address="Test Location", phone_number="+77005004455")
+        created = await shelters.filter_all({"title": "Shared Session Shelter"})
+        assert len(created) >= 1
+
+        animals = await AnimalRepository(ss).filter_all({"shelter_id": created[-1]["pk"]})
+        assert isinstance(animals, list)
+
+        await shelters.delete(created[-1]["pk"])
+        assert "not found" in (await shelters.retrieve_one(created[-1]["pk"]))["message"]
+
+
+@pytest.mark.asyncio_cooperative
+async def test_lru_cache():
+    cache = LRUCache(max_entries=2)
+
+    await cache.set("a", 1, ttl=60)
+    await cache.set("b", 2, ttl=60)
+    assert await cache.get("a") == (True, 1)
+
+    # "b" is the least recently used entry now
+    await cache.set("c", 3, ttl=60)
+    assert await cache.get("b") == (False, None)
+
+    # Expired entries are misses
+    await cache.set("d", 4, ttl=-1)
+    assert await cache.get("d") == (False, None)
+
+    assert await cache.incr("version") == 1
+    assert await cache.get_counter("version") == 1
+    assert await cache.raise_counter("version", 5) == 5
+    assert await cache.raise_counter("version", 3) == 5
+
+    # Writes are remembered in the counters, evicting every entry leaves reads within the window uncached
+    written = RepositoryCache(LRUCache(max_entries=1), ttl=60, write_window=60)
+    await written.invalidate("Shelter")
+    await written.backend.set("other", 1, ttl=60)
+    assert await written.recently_written("Animal", "Shelter") and not await written.recently_written("Animal")
+    _, _, versions = await written.get("Shelter", "all", 10)
+    await written.set("Shelter", versions, [], "all", 10)
+    assert (await written.get("Shelter", "all", 10))[0] is False
+
+
+@pytest.mark.asyncio_cooperative
+async def test_sqlite_cache():
+    with pytest.raises(TypeError):
+        CacheBackend()
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "cache.sqlite3")
+        # Two workers on the same file
+        first = RepositoryCache(SQLiteCache(path, max_entries=100), ttl=60)
+        second = RepositoryCache(SQLiteCache(path, max_entries=100), ttl=60)
+
+        hit, _, versions = await first.get("Shelter", "all", 10)
+        assert not hit
+        await first.set("Shelter", versions, [{"pk": 1, "since": datetime(2024, 1, 1)}], "all", 10)
+        assert (await second.get("Shelter", "all", 10))[:2] == (True, [{"pk": 1, "since": datetime(2024, 1, 1)}])
+        assert await first.validators("Shelter") == await second.validators("Shelter")
+
+        # A write in one worker is seen by the other, with the same Last-Modified date
+        etag, last_modified = await second.validators("Shelter")
+        await asyncio.sleep(1)
+        await first.invalidate("Shelter")
+        assert (await second.get("Shelter", "all", 10))[0] is False
+        validators = await second.validators("Shelter")
+        assert validators[0] != etag and validators[1] != last_modified
+        assert await first.validators("Shelter") == validators
+
+        # The oldest entries are evicted, expired ones are misses
+        backend = SQLiteCache(path, max_entries=2)
+        for i in range(SQLiteCache.EVICT_EVERY):
+            await backend.set(f"key-{i}", i, ttl=60)
+        assert await backend.get(f"key-{SQLiteCache.EVICT_EVERY - 1}") == (True, SQLiteCache.EVICT_EVERY - 1)
+        assert await backend.get("key-0") == (False, None)
+        await backend.set("expired", 1, ttl=-1)
+        assert await backend.get("expired") == (False, None)
+
+
+@pytest.mark.asyncio_cooperative
+async def test_repository_cache_invalidation():
+    # Users are not written by the other tests, so no concurrent write invalidates the entries
+    repository = UserRepository()
+
+    await repository.create(first_name="Cached", last_name="User", login="cached-user", password="secret")
+    pk = (await repository.filter_all({"login": "cached-user"}))[-1]["pk"]
+
+    # The second read is served from the cache
+    first = await repository.retrieve_one(pk)
+    hits = repository_cache.hits
+    assert await repository.retrieve_one(pk) == first
+    assert repository_cache.hits > hits
+
+    # Updates invalidate the object and the lists of the model
+    await repository.update(pk, {"login": "cached-user-updated"})
+    assert (await repository.retrieve_one(pk))["login"] == "cached-user-updated"
+    assert await repository.filter_all({"login": "cached-user"}) == []
+
+    await repository.delete(pk)
+    assert "not found" in (await repository.retrieve_one(pk))["message"]
+
+
+@pytest.mark.asyncio_cooperative
+async def test_create_many():
+    repository = AdvertisementRepository()
+
+    # Rows with and without the server default column are created in input order
+    advertisements = [
+        {"title": f"Bulk Advertisement {i}", "body": "Bulk body.", "image_path": "/images/bulk.jpg"} for i in range(3)
+    ]
+    advertisements[1]["published_time"] = datetime(2024, 1, 1, 10, 30)
+    created = await repository.create_many(advertisements)
+    assert len(created["pks"]) == 3
+
+    for pk, advertisement in zip(created["pks"], advertisements):
+        retrieved = await repository.retrieve_one(pk)
+        assert retrieved["title"] == advertisement["title"]
+    assert (await repository.retrieve_one(created["pks"][1]))["published_time"] == "2024-01-01 10:30 AM"
+
+    assert "error" in await repository.create_many([{"title": "Bulk Advertisement", "unknown": 1}])
+
+    for pk in created["pks"]:
+        await repository.delete(pk)
+
+
+@pytest.mark.asyncio_cooperative
+async def test_hot_queries_use_indexes():
+    animals = AnimalRepository()
+    ads = AdvertisementRepository()
+    queries = [
+        animals._keyset(animals._filter_query({"shelter_id": 3}), 50, None),
+        animals._keyset(animals._filter_query({"species": SpeciesEnum.cat}), 50, None),
+        animals._keyset(animals._filter_query({"species": SpeciesEnum.cat, "sex": SexEnum.male}), 50, None),
+        ads._keyset(ads._by_time_query(7), 50, None, ("published_time", "pk")),
+    ]
+    async with AsyncSessionLocal() as ss:
+        async with ss.begin():
+            for query in queries:
+                plan = await query_plan(ss, query)
+                assert not is_full_scan(plan), plan
+
+            plan = await query_plan(ss, animals._filter_query({"name": "Barsik"}))
+            assert is_full_scan(plan), plan
+
+    assert animals._unindexed_keys({"species", "sex"}) == []
+    assert animals._unindexed_keys({"sex"}) == ["sex"]
+    assert animals._unindexed_keys({"pk", "name"}) == ["name"]
+
+
+@pytest.mark.asyncio_cooperative
+async def test_filter_dsl():
+    repository = AnimalRepository()
+    animals = [
+        {"name": f"Dsl {species} {age}", "sex": SexEnum.male, "age": age, "image_path": "/images/dsl.jpg",
+         "species": species, "since_time": datetime(2024, 1, age)}
+        for species in (SpeciesEnum.dog, SpeciesEnum.cat) for age in range(1, 6)
+    ]
+    created = await repository.create_many(animals)
+
+    # Dogs aged 1 to 3, newest first, two per page
+    condition = {"name": {"ilike": "dsl "}, "species": {"in": ["dog", "puppy"]}, "age": {"gte": 1, "lte": 3},
+                 "order_by": "-since_time", "limit": 2}
+    page = await repository.filter_all(condition, limit=50)
+    assert [animal["age"] for animal in page["items"]] == [3, 2]
+    page = await repository.filter_all(condition, limit=50, after=page["next_cursor"])
+    assert [animal["age"] for animal in page["items"]] == [1]
+    assert page["next_cursor"] is None
+
+    # Mixed directions page through the row order as well
+    condition = {"name": {"ilike": "Dsl"}, "order_by": ["species", "-age"]}
+    rows, after = [], None
+    while True:
+        page = await repository.filter_all(condition, limit=3, after=after)
+        rows += [(animal["species"], animal["age"]) for animal in page["items"]]
+        after = page["next_cursor"]
+        if after is None:
+            break
+    assert rows == sorted(rows, key=lambda row: (row[0], -row[1])) and len(rows) == 10
+
+    # The prefix is matched literally
+    assert await repository.filter_all({"name": {"ilike": "%"}}, limit=50) == {"items": [], "next_cursor": None}
+
+    assert "error" in await repository.filter_all({"unknown": 1})
+    assert "error" in await repository.filter_all({"age": {"between": [1, 3]}})
+    assert "error" in await repository.filter_all({"age": {"gte": "old"}})
+    assert "error" in await repository.filter_all({"species": "fish"})
+    assert "error" in await repository.filter_all({"order_by": "-unknown"})
+
+    for pk in created["pks"]:
+        await repository.delete(pk)
+
+
+@pytest.mark.asyncio_cooperative
+async def test_keyset_nulls():
+    shelter = (await ShelterRepository().create_many([{"title": "Nulls Shelter", "address": "Nulls Street",
+                                                       "phone_number": "+77005004466"}]))["pks"][0]
+    repository = AnimalRepository()
+    created = (await repository.create_many([
+        {"name": f"Nulls {i}", "sex": SexEnum.male, "age": i, "image_path": "/images/nulls.jpg",
+         "species": SpeciesEnum.cat, "since_time": datetime(2024, 2, 1), "shelter_id": shelter if i % 2 else None}
+        for i in range(1, 7)
+    ]))["pks"]
+
+    # Pages go on past the rows with NULL in the ordering column, which count as larger than any value
+    with_shelter, without = created[0::2], created[1::2]
+    for order_by in ("shelter_id", "-shelter_id"):
+        pks, after = [], None
+        while True:
+            page = await repository.filter_all({"name": {"ilike": "Nulls "}, "order_by": order_by}, limit=2,
+                                               after=after)
+            pks += [animal["pk"] for animal in page["items"]]
+            after = page["next_cursor"]
+            if after is None:
+                break
+        expected = with_shelter + without if order_by == "shelter_id" else without[::-1] + with_shelter[::-1]
+        assert pks == expected
+
+    await repository.delete_many({"pk": {"in": created}})
+    await ShelterRepository().delete(shelter)
+
+
+@pytest.mark.asyncio_cooperative
+async def test_statistics():
+    animals, stats = AnimalRepository(), StatisticRepository()
+    shelter = await ShelterRepository().create_many([
+        {"title": "Stats Shelter", "address": "Test Location", "phone_number": "+77005004455"}
+    ])
+    shelter_pk = str(shelter["pks"][0])
+    created = await animals.create_many([
+        {"name": "Stats", "sex": SexEnum.female, "age": 1, "image_path": "/images/s.jpg", "species": SpeciesEnum.dog,
+         "since_time": datetime(1991, 2, day), "shelter_id": shelter["pks"][0]}
+        for day in (1, 2)
+    ])
+    await animals.create(name="Stats", sex=SexEnum.female, age=1, image_path="/images/s.jpg",
+                         species=SpeciesEnum.dog, since_time=datetime(1991, 3, 1))
+
+    summary = (await stats.summary())["animals"]
+    assert summary["intake_month"]["1991-02"] == 2 and summary["intake_month"]["1991-03"] == 1
+    assert summary["shelter"][shelter_pk] == 2
+
+    # Updates move rows between groups, deleting the shelter moves its animals to no shelter
+    await animals.update(created["pks"][0], {"since_time": datetime(1991, 4, 1)})
+    await ShelterRepository().delete(shelter["pks"][0])
+    summary = (await stats.summary())["animals"]
+    assert summary["intake_month"]["1991-02"] == 1 and summary["intake_month"]["1991-04"] == 1
+    assert shelter_pk not in summary["shelter"]
+
+    # A recompute finds the same counts
+    async with AsyncSessionLocal() as ss:
+        async with ss.begin():
+            await recompute(ss)
+            recomputed = (await summary_of(ss))["animals"]
+            await ss.rollback()
+    for month in ("1991-02", "1991-03", "1991-04"):
+        assert recomputed["intake_month"][month] == summary["intake_month"][month]
+
+    for pk in created["pks"]:
+        await animals.delete(pk)
+    filtered = await animals.filter_all({"since_time": {"gte": "1991-01-01T00:00:00", "lte": "1991-12-31T00:00:00"}})
+    for animal in filtered:
+        await animals.delete(animal["pk"])
+    summary = (await stats.summary())["animals"]
+    assert not {"1991-02", "1991-03", "1991-04"} & set(summary["intake_month"])
+
+
+@pytest.mark.asyncio_cooperative
+async def test_slow_query_log():
+    assert parameter_shape((1, 2, 3, "a", None)) == ["int x 3", "str", "NoneType"]
+    assert parameter_shape([{"a": 1}, {"a": 2}]) == {"rows": 2, "row": {"a": "int"}}
+
+    with mock.patch.multiple(slow_query_log, threshold=1e-9, explain=True, explain_interval=0):
+        await AnimalRepository().filter_all({"age": {"in": [9001, 9002, 9003]}, "order_by": "-since_time"})
+        entries = [entry for entry in slow_query_log.recent()
+                   if "FROM animals" in entry["statement"] and "int x 3" in entry["parameters"]]
+        assert entries and entries[0]["duration_ms"] > 0 and entries[0]["route"] is None
+
+        # Plans are captured in the background, one at a time
+        for _ in range(100):
+            if any(entry["plan"] for entry in slow_query_log.recent()):
+                break
+            await asyncio.sleep(0.02)
+        assert any(entry["plan"] for entry in slow_query_log.recent())
+    while slow_query_log._explaining is not None:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio_cooperative
+async def test_engine_after_fork():
+    engine = get_engine()
+    await AnimalRepository().retrieve_all(limit=1)
+    pid = os.fork()
+    if pid == 0:
+        # The child starts without an engine and never closes the connections of the parent
+        os._exit(0 if db_manage._engine is None else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert get_engine() is engine
+    assert "error" not in await AnimalRepository().retrieve_all(limit=1)
+
+
+REPLICA_SCRIPT = """
+import asyncio
+from sqlalchemy import insert, select
+from starlette.requests import Request
+from src.db_handlers.config import DB_READ_YOUR_WRITES_SECONDS
+from src.db_handlers.db_manage import ReadConsistency, get_replicas, read_consistency
+from src.db_handlers.core.cache import repository_cache
+from src.db_handlers.core.models import Base, Shelter
+from src.db_handlers.core.orm import ShelterRepository
+from src.upha_site.services import ConditionalGet
+
+async def main():
+    replica = get_replicas()[0]
+    async with replica.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.execute(insert(Shelter).values(pk=10 ** 6, title="Replica only", address="-",
+                                                        phone_number="+77000000000"))
+    shelters = ShelterRepository()
+    # Reads go to the replica, writes to the primary
+    assert (await shelters.retrieve_one(10 ** 6))["title"] == "Replica only"
+    writer = ReadConsistency()
+    read_consistency.set(writer)
+    assert "error" not in await shelters.create(title="Primary only", address="-", phone_number="+77000000001")
+    async with replica.connect() as connection:
+        assert (await connection.execute(select(Shelter).where(Shelter.title == "Primary only"))).first() is None
+
+    # Another client still reads the lagging replica, but its stale rows are not cached for the writer to read back
+    read_consistency.set(None)
+    assert not (await shelters.filter_all({"title": "Primary only"}, limit=10))["items"]
+    read_consistency.set(writer)
+    assert (await shelters.filter_all({"title": "Primary only"}, limit=10))["items"]
+    # Nor do responses carry validators for clients or the payload cache to keep them by
+    request = Request({"type": "http", "method": "GET", "headers": [], "query_string": b""})
+    assert "ETag" not in await ConditionalGet(Shelter)(request)
+
+    # Afterwards replica reads are cached again
+    read_consistency.set(None)
+    await asyncio.sleep(DB_READ_YOUR_WRITES_SECONDS + 0.1)
+    assert "ETag" in await ConditionalGet(Shelter)(request)
+    assert not (await shelters.filter_all({"title": "Primary only"}, limit=10))["items"]
+    hits = repository_cache.hits
+    assert not (await shelters.filter_all({"title": "Primary only"}, limit=10))["items"]
+    assert repository_cache.hits == hits + 1
+    await ShelterRepository().delete_many({"title": "Primary only"})
+
+asyncio.run(main())
+"""
+
+
+@pytest.mark.asyncio_cooperative
+async def test_replica_routing():
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, CACHE_ENABLED="True", DB_REPLICA_POLICY="least_connections",
+                   DB_READ_YOUR_WRITES_SECONDS="1", DB_REPLICA_URLS=f"sqlite+aiosqlite:///{directory}/replica.db")
+        process = await run_in_threadpool(subprocess.run, [sys.executable, "-c", REPLICA_SCRIPT], env=env,
+                                          capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
 
 
 if __name__ == "__main__":
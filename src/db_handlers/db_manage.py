@@ -1,10 +1,214 @@
-from .config import DB_URL
+import asyncio
+import itertools
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+from .config import (DB_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+                     DB_STATEMENT_CACHE_SIZE, DB_REPLICA_URLS, DB_REPLICA_POLICY, DB_READ_YOUR_WRITES_SECONDS)
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from .core.metrics import TimedQueuePool, instrument_engine
+from .core.slowlog import slow_query_log
 
-engine = create_async_engine(
-    url=DB_URL,
-    echo=False,
-)
 
-AsyncSessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+def engine_options(url):
+    """
+    Build the engine keyword arguments for the given database URL.
+
+    :param url: Database URL.
+    :return: Keyword arguments for `create_async_engine`.
+    """
+    url = make_url(url)
+    options = {"echo": False}
+    if url.get_backend_name() == "sqlite":
+        return options
+
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    return options
+
+
+def enable_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores foreign keys, ON DELETE actions included, unless asked per connection
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+_engine = None
+_replicas = None
+_next_replica = itertools.count()
+
+
+def create_engine(url, name):
+    engine = create_async_engine(url=url, **engine_options(url))
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect", enable_foreign_keys)
+    instrument_engine(engine, name)
+    slow_query_log.attach(engine)
+    return engine
+
+
+def get_engine():
+    """
+    Get the engine of DB_URL, created on first use so importing the application needs no database.
+    """
+    global _engine
+    if _engine is None:
+        if not DB_URL:
+            raise RuntimeError("DB_URL is not configured.")
+        _engine = create_engine(DB_URL, "primary")
+    return _engine
+
+
+def get_replicas():
+    """
+    Get the engines of DB_REPLICA_URLS, created on first use.
+    """
+    global _replicas
+    if _replicas is None:
+        _replicas = [create_engine(url, f"replica-{i}") for i, url in enumerate(DB_REPLICA_URLS, 1)]
+    return _replicas
+
+
+def checked_out(engine):
+    pool = engine.sync_engine.pool
+    return pool.checkedout() if hasattr(pool, "checkedout") else 0
+
+
+def pick_replica():
+    """
+    Choose the replica of the next read by DB_REPLICA_POLICY, None without replicas.
+
+    `round_robin` takes the replicas in turn, `least_connections` the one with the fewest
+    checked out connections, in turn among equals.
+    """
+    replicas = get_replicas()
+    if not replicas:
+        return None
+    start = next(_next_replica) % len(replicas)
+    ordered = replicas[start:] + replicas[:start]
+    if DB_REPLICA_POLICY == "least_connections":
+        return min(ordered, key=checked_out)
+    return ordered[0]
+
+
+class ReadConsistency:
+    """
+    Read-your-writes state of one client: its reads go to the primary until `primary_until`.
+
+    :param primary_until: Unix time, carried between the requests of the client.
+    """
+
+    def __init__(self, primary_until: float = 0.0):
+        self.primary_until = primary_until
+        self.written = False
+
+
+read_consistency: ContextVar[Optional[ReadConsistency]] = ContextVar("read_consistency", default=None)
+
+
+def note_write():
+    """
+    Send the reads of the current client to the primary for DB_READ_YOUR_WRITES_SECONDS.
+    """
+    state = read_consistency.get()
+    if state is not None and DB_READ_YOUR_WRITES_SECONDS > 0:
+        state.primary_until = time.time() + DB_READ_YOUR_WRITES_SECONDS
+        state.written = True
+
+
+def read_engine():
+    """
+    Engine of the next read transaction: a replica, unless there is none or the client wrote recently.
+
+    :return: Replica engine, None for the primary.
+    """
+    state = read_consistency.get()
+    if state is not None and state.primary_until > time.time():
+        return None
+    return pick_replica()
+
+
+async def dispose_engine():
+    """
+    Close the pooled connections, the next `get_engine` creates a new engine.
+    """
+    global _engine, _replicas
+    engines = ([_engine] if _engine is not None else []) + (_replicas or [])
+    _engine, _replicas = None, None
+    for engine in engines:
+        await engine.dispose()
+
+
+def forget_engine_after_fork():
+    """
+    Drop the engines inherited by a forked process without touching the connections of the parent.
+    """
+    global _engine, _replicas
+    engines = ([_engine] if _engine is not None else []) + (_replicas or [])
+    _engine, _replicas = None, None
+    for engine in engines:
+        engine.sync_engine.dispose(close=False)
+
+
+# A forked worker builds its own engine and pool on first use
+os.register_at_fork(after_in_child=forget_engine_after_fork)
+
+
+async def warm_pool(count):
+    """
+    Open up to `count` pooled connections of the primary and of every replica ahead of the first requests.
+    """
+    if count < 1:
+        return
+    for engine in [get_engine()] + get_replicas():
+        pool = engine.sync_engine.pool
+        size = min(count, pool.size()) if hasattr(pool, "size") else count
+        connections = await asyncio.gather(*(engine.connect().start() for _ in range(size)))
+        for connection in connections:
+            await connection.close()
+
+
+class RoutingSession(Session):
+    """
+    Session sending the statements of a transaction to the engine in `info["replica"]`, when set.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = self.info.get("replica")
+        if replica is not None:
+            return replica.sync_engine
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+class LazyAsyncSession(AsyncSession):
+    """
+    Session bound to the engine of `get_engine` unless given another bind.
+    """
+    sync_session_class = RoutingSession
+
+    def __init__(self, bind=None, **kwargs):
+        super().__init__(bind=get_engine() if bind is None else bind, **kwargs)
+
+
+AsyncSessionLocal = sessionmaker(class_=LazyAsyncSession, expire_on_commit=False)
+
+
+async def get_session():
+    """
+    FastAPI dependency providing one session per request, shared by all repositories of the request.
+    """
+    async with AsyncSessionLocal() as session:
+        yield session
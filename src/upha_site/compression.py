@@ -0,0 +1,106 @@
+import zlib
+from collections import OrderedDict
+from importlib.util import find_spec
+from typing import Callable, Dict, Optional, Tuple
+
+
+# Content codings by preference, zstd and br only with their optional packages installed
+PREFERENCE = ("zstd", "br", "gzip")
+AVAILABLE = {"gzip"} | {name for name, module in (("zstd", "zstandard"), ("br", "brotli")) if find_spec(module)}
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/javascript", "image/svg+xml", "text/")
+
+
+def gzip_encoder():
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def encode(data, final):
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return encode
+
+
+def brotli_encoder():
+    import brotli
+
+    compressor = brotli.Compressor(quality=5)
+
+    def encode(data, final):
+        return compressor.process(data) + (compressor.finish() if final else compressor.flush())
+    return encode
+
+
+def zstd_encoder():
+    import zstandard
+
+    compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def encode(data, final):
+        mode = zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        return compressor.compress(data) + compressor.flush(mode)
+    return encode
+
+
+# Factories of incremental encoders: encode(data, final) returns the next compressed bytes
+ENCODERS: Dict[str, Callable[[], Callable[[bytes, bool], bytes]]] = {
+    "gzip": gzip_encoder, "br": brotli_encoder, "zstd": zstd_encoder,
+}
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """
+    Choose the content coding of a response from the Accept-Encoding header of its request.
+
+    :return: Name of an available coding, None for the identity.
+    """
+    weights = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        if name:
+            weights[name] = weight
+    accepted = [name for name in PREFERENCE if name in AVAILABLE and weights.get(name, weights.get("*", 0)) > 0]
+    return accepted[0] if accepted else None
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class PayloadCache:
+    """
+    Finished response bodies with their headers, least recently used out once `max_bytes` is reached.
+
+    Entries are keyed by path, query and content coding. They hold the ETag, the models it was
+    computed from and the route that answered; a hit is only served while the models are unchanged.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key) -> Optional[Tuple]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key, etag: str, models: Tuple[str, ...], headers: list, body: bytes, route=None):
+        if len(body) > self.max_bytes:
+            return
+        self.delete(key)
+        self._entries[key] = (etag, models, headers, body, route)
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, (_, _, _, evicted, _) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[3])
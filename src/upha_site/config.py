@@ -0,0 +1,62 @@
+import os
+from decouple import config, Csv
+
+
+DEFAULT_PAGE_SIZE = config("DEFAULT_PAGE_SIZE", default=50, cast=int)
+MAX_PAGE_SIZE = config("MAX_PAGE_SIZE", default=500, cast=int)
+STREAM_BATCH_SIZE = config("STREAM_BATCH_SIZE", default=1000, cast=int)
+BULK_MAX_ITEMS = config("BULK_MAX_ITEMS", default=10000, cast=int)
+# Page size of relations expanded with ?include=, per parent object
+INCLUDE_PAGE_SIZE = config("INCLUDE_PAGE_SIZE", default=10, cast=int)
+
+# Directory served at /static, image uploads are stored in its subfolders
+MEDIA_ROOT = config("MEDIA_ROOT", default="static")
+UPLOAD_MAX_BYTES = config("UPLOAD_MAX_BYTES", default=10 * 1024 * 1024, cast=int)
+UPLOAD_CHUNK_SIZE = config("UPLOAD_CHUNK_SIZE", default=256 * 1024, cast=int)
+
+# Resized copies of uploaded images, cached on disk by source hash and size
+DERIVATIVES_ROOT = config("DERIVATIVES_ROOT", default=os.path.join(MEDIA_ROOT, "derivatives"))
+THUMBNAIL_SIZES = config("THUMBNAIL_SIZES", default="200,600", cast=Csv(int))
+IMAGE_WORKERS = config("IMAGE_WORKERS", default=2, cast=int)
+
+# Directories GET /img serves from, and the browser cache lifetime of immutable image names
+IMAGE_ROOTS = config("IMAGE_ROOTS", default=",".join(os.path.join(MEDIA_ROOT, folder) for folder in (
+    "animals-images", "ads-images", "derivatives")), cast=Csv())
+IMAGE_MAX_AGE = config("IMAGE_MAX_AGE", default=365 * 24 * 3600, cast=int)
+
+# Request latency and SQL metrics served at /metrics, and the Server-Timing header of every response
+METRICS_ENABLED = config("METRICS_ENABLED", default=True, cast=bool)
+SERVER_TIMING = config("SERVER_TIMING", default=True, cast=bool)
+
+# Token of the /admin routes, sent in the X-Admin-Token header; the routes answer 404 while it is empty
+ADMIN_TOKEN = config("ADMIN_TOKEN", default="")
+
+# Multi-process server of python -m src.upha_site.serve
+HOST = config("HOST", default="127.0.0.1")
+PORT = config("PORT", default=8000, cast=int)
+WORKERS = config("WORKERS", default=os.cpu_count() or 1, cast=int)
+# Seconds in-flight requests get to finish on shutdown before their connections are closed
+GRACEFUL_SHUTDOWN_TIMEOUT = config("GRACEFUL_SHUTDOWN_TIMEOUT", default=30, cast=int)
+
+# Negotiated gzip, br and zstd compression of responses of at least COMPRESSION_MIN_SIZE bytes,
+# bodies from COMPRESSION_THREAD_SIZE bytes on are compressed in a worker thread
+COMPRESSION_ENABLED = config("COMPRESSION_ENABLED", default=True, cast=bool)
+COMPRESSION_MIN_SIZE = config("COMPRESSION_MIN_SIZE", default=1024, cast=int)
+COMPRESSION_THREAD_SIZE = config("COMPRESSION_THREAD_SIZE", default=64 * 1024, cast=int)
+# Finished bodies of conditional GET routes, served again while their ETag holds
+PAYLOAD_CACHE_MAX_BYTES = config("PAYLOAD_CACHE_MAX_BYTES", default=32 * 1024 * 1024, cast=int)
+
+# Durable queue of background jobs (file deletions, derivatives), a SQLite file outside MEDIA_ROOT
+JOBS_DB = config("JOBS_DB", default="jobs.sqlite3")
+JOB_WORKERS = config("JOB_WORKERS", default=2, cast=int)
+JOB_MAX_ATTEMPTS = config("JOB_MAX_ATTEMPTS", default=5, cast=int)
+# Seconds a claimed job stays with its worker before another one may retry it
+JOB_LEASE_SECONDS = config("JOB_LEASE_SECONDS", default=300, cast=int)
+JOB_POLL_INTERVAL = config("JOB_POLL_INTERVAL", default=5, cast=float)
+
+# Folders of uploaded images, files no row refers to for GC_MIN_AGE seconds are removed every GC_INTERVAL seconds
+UPLOAD_FOLDERS = config("UPLOAD_FOLDERS", default=",".join(os.path.join(MEDIA_ROOT, folder) for folder in (
+    "animals-images", "ads-images")), cast=Csv())
+GC_INTERVAL = config("GC_INTERVAL", default=3600, cast=int)
+GC_MIN_AGE = config("GC_MIN_AGE", default=3600, cast=int)
+GC_BATCH_SIZE = config("GC_BATCH_SIZE", default=500, cast=int)
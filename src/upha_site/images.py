@@ -0,0 +1,329 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+import anyio
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import Response
+from src.upha_site.config import (MEDIA_ROOT, DERIVATIVES_ROOT, THUMBNAIL_SIZES, IMAGE_WORKERS, IMAGE_ROOTS,
+                                  IMAGE_MAX_AGE)
+
+
+logger = logging.getLogger("images")
+
+# Derivative formats by file extension
+FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+
+# Derivatives are named by their source hash, uploads by a UUID: their content never changes
+IMMUTABLE_NAME = re.compile(r"^([0-9a-f]{64}_|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})")
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# Types shown inline, anything else found in the image roots (e.g. SVG markup) is only downloaded
+INLINE_MEDIA_TYPES = ("image/png", "image/jpeg", "image/webp")
+# Sent with every image response, so a file opened directly from the site's origin can never run scripts
+IMAGE_SECURITY_HEADERS = {
+    "X-Content-Type-Options": "nosniff",
+    "Content-Security-Policy": "default-src 'none'; style-src 'unsafe-inline'; sandbox",
+}
+
+_pool = None
+_image_info = {}
+_digests = {}
+_pending = {}
+_failed = set()
+
+
+def sniff_image_type(head: bytes):
+    """
+    Detect the image type from the first bytes of a file instead of trusting the client.
+
+    Returns the media type, or None if the bytes are not a supported image.
+    """
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    # SVG is markup that can carry scripts, it is never taken for an image
+    return None
+
+
+def render_derivative(source, target, size, image_format):
+    """
+    Write a copy of an image fitting in a `size` x `size` box. Runs in a worker process.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((size, size))
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        partial_target = f"{target}.{os.getpid()}.part"
+        image.save(partial_target, format=image_format, quality=80)
+        os.replace(partial_target, target)
+    return target
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        # Spawned workers do not inherit the event loop, threads and connections of the server
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def resolve_source(image_path):
+    """
+    Resolve an image path, refusing anything outside the media root and the derivatives themselves.
+
+    Returns the real path of the image, or None.
+    """
+    root = os.path.realpath(MEDIA_ROOT)
+    path = os.path.realpath(image_path)
+    if os.path.commonpath([root, path]) != root:
+        return None
+    if os.path.commonpath([os.path.realpath(DERIVATIVES_ROOT), path]) == os.path.realpath(DERIVATIVES_ROOT):
+        return None
+    return path if os.path.isfile(path) else None
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def source_digest(path):
+    """
+    Hash of an image, remembered while its size and modification time stay the same.
+    """
+    stat = await run_in_threadpool(os.stat, path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    digest = _digests.get(key)
+    if digest is None:
+        digest = await run_in_threadpool(file_digest, path)
+        if len(_digests) > 10000:
+            _digests.clear()
+        _digests[key] = digest
+    return digest
+
+
+def derivative_path(digest, size, extension):
+    return os.path.join(DERIVATIVES_ROOT, digest[:2], f"{digest}_{size}.{extension}")
+
+
+async def get_derivative(image_path, size, extension="webp"):
+    """
+    Get the path of a resized copy of an image, generating it in the process pool on first use.
+
+    Concurrent requests for the same derivative share one generation.
+
+    :return: Path of the derivative, None if the image or the size is not available.
+    """
+    if size not in THUMBNAIL_SIZES or extension not in FORMATS:
+        return None
+    source = await run_in_threadpool(resolve_source, image_path)
+    if source is None:
+        return None
+
+    target = derivative_path(await source_digest(source), size, extension)
+    if target in _failed:
+        return None
+    if await run_in_threadpool(os.path.exists, target):
+        return target
+
+    future = _pending.get(target)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(get_pool(), render_derivative, source, target, size, FORMATS[extension])
+        _pending[target] = future
+        future.add_done_callback(lambda _: _pending.pop(target, None))
+    try:
+        return await asyncio.shield(future)
+    except Exception:
+        # Not decodable by Pillow (e.g. SVG) or Pillow is not installed
+        logger.warning(f"No {size}px {extension} derivative for {image_path}", exc_info=True)
+        _failed.add(target)
+        return None
+
+
+async def generate_derivatives(image_path):
+    for size in THUMBNAIL_SIZES:
+        for extension in FORMATS:
+            await get_derivative(image_path, size, extension)
+
+
+def resolve_image(image_path):
+    """
+    Resolve an image path inside one of the IMAGE_ROOTS.
+
+    Returns the real path of the image, or None for anything outside them.
+    """
+    path = os.path.realpath(image_path)
+    for root in IMAGE_ROOTS:
+        root = os.path.realpath(root)
+        if os.path.commonpath([root, path]) == root and os.path.isfile(path):
+            return path
+    return None
+
+
+def read_head(path):
+    with open(path, "rb") as file:
+        return file.read(1024)
+
+
+async def image_info(path):
+    """
+    Stat an image and get its strong ETag and media type, computed once per file version.
+    """
+    stat = await run_in_threadpool(os.stat, path)
+    info = _image_info.get(path)
+    if info is None or info[0] != (stat.st_mtime_ns, stat.st_size):
+        media_type = sniff_image_type(await run_in_threadpool(read_head, path))
+        media_type = media_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+        etag = f'"{await source_digest(path)}"'
+        info = ((stat.st_mtime_ns, stat.st_size), etag, media_type)
+        if len(_image_info) > 10000:
+            _image_info.clear()
+        _image_info[path] = info
+    return stat, info[1], info[2]
+
+
+class ImageFileResponse(Response):
+    """
+    Response with a whole image or one byte range of it.
+
+    Whole files go through the ASGI pathsend extension and ranges through zerocopysend when
+    the server supports them, so the file is sent by the kernel without passing through Python.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path, start, end, status_code, headers, media_type):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        extensions = scope.get("extensions") or {}
+        count = self.end - self.start + 1
+
+        # An empty file still ends the response, with an empty body
+        if scope["method"] == "HEAD" or count <= 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif "http.response.pathsend" in extensions and self.status_code == 200:
+            await send({"type": "http.response.pathsend", "path": self.path})
+        elif "http.response.zerocopysend" in extensions:
+            file = await anyio.to_thread.run_sync(open, self.path, "rb")
+            try:
+                await send({"type": "http.response.zerocopysend", "file": file.fileno(),
+                            "offset": self.start, "count": count, "more_body": False})
+            finally:
+                await anyio.to_thread.run_sync(file.close)
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                await file.seek(self.start)
+                while count > 0:
+                    chunk = await file.read(min(self.chunk_size, count))
+                    count -= len(chunk)
+                    more_body = count > 0 and len(chunk) > 0
+                    await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+                    if not chunk:
+                        break
+
+
+def is_not_modified(request: Request, etag, mtime):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def parse_range(header, size):
+    """
+    Parse a single byte range.
+
+    :return: Tuple of the first and last byte, None for a range that cannot be satisfied.
+    """
+    match = RANGE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), int(last) if last else size - 1
+    elif last:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, min(end, size - 1)
+
+
+async def serve_image(request: Request, path):
+    """
+    Build the response for an image already resolved inside the image roots.
+
+    Answers If-None-Match and If-Modified-Since with 304, honours single byte ranges
+    (with If-Range) and marks content-addressed names as cacheable for IMAGE_MAX_AGE.
+    Files that are not PNG, JPEG or WebP images are sent as attachments.
+    """
+    stat, etag, media_type = await image_info(path)
+    size = stat.st_size
+    cache_control = (f"public, max-age={IMAGE_MAX_AGE}, immutable" if IMMUTABLE_NAME.match(os.path.basename(path))
+                     else "public, no-cache")
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+        **IMAGE_SECURITY_HEADERS,
+    }
+    if media_type not in INLINE_MEDIA_TYPES:
+        headers["Content-Disposition"] = "attachment"
+
+    if is_not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    start, end, status_code = 0, size - 1, 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and size and (if_range is None or if_range.strip() == etag):
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    headers["Content-Length"] = str(end - start + 1)
+    return ImageFileResponse(path, start, end, status_code, headers, media_type)
@@ -0,0 +1,369 @@
+"""
+Durable queue of background jobs run by the server processes.
+
+Jobs are rows of a SQLite file, so they survive restarts and are shared by all the workers of
+`src.upha_site.serve`. A job is claimed with a lease of JOB_LEASE_SECONDS: a process that dies
+while running one leaves it to another once the lease runs out. Failed jobs are retried with a
+growing delay and kept with their last error after JOB_MAX_ATTEMPTS attempts.
+
+The queue runs the side effects of requests once they are committed: removal of the files of
+deleted rows and of failed uploads, derivative generation of new uploads, and every GC_INTERVAL
+seconds a pass removing the uploaded files no row refers to.
+
+    python -m src.upha_site.jobs         # jobs by kind and status
+    python -m src.upha_site.jobs --run   # run the pending jobs
+    python -m src.upha_site.jobs --gc    # collect orphaned files and run the deletions
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+import orjson
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from src.db_handlers.core.models import Base
+from src.db_handlers.core.orm import file_columns, file_release_hooks
+from src.db_handlers.db_manage import AsyncSessionLocal, dispose_engine
+from src.upha_site.config import (JOBS_DB, JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_LEASE_SECONDS, JOB_POLL_INTERVAL,
+                                  UPLOAD_FOLDERS, GC_INTERVAL, GC_MIN_AGE, GC_BATCH_SIZE, THUMBNAIL_SIZES)
+from src.upha_site.images import FORMATS, derivative_path, file_digest, generate_derivatives
+
+
+logger = logging.getLogger("jobs")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL,
+    lease_until REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after);
+"""
+# Ready jobs and those whose worker lost its lease, the oldest first
+CLAIM = """
+UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = :lease_until
+WHERE id = (
+    SELECT id FROM jobs
+    WHERE (status = 'queued' AND run_after <= :now) OR (status = 'running' AND lease_until < :now)
+    ORDER BY run_after, id LIMIT 1
+)
+RETURNING id, kind, payload, attempts
+"""
+MAX_RETRY_DELAY = 3600
+
+
+class JobQueue:
+    """
+    Queue of jobs in the SQLite file at `path`, run by `workers` tasks of every process.
+
+    Handlers are coroutine functions registered per kind with `handler`, called with the
+    payload of a job as keyword arguments.
+    """
+
+    def __init__(self, path: str, workers: int, max_attempts: int, lease_seconds: float, poll_interval: float):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.handlers = {}
+        self.schedules = {}
+        self._connection = None
+        self._lock = threading.Lock()
+        self._wake = None
+        self._tasks = []
+
+    def handler(self, kind: str, every: Optional[float] = None):
+        """
+        Register the handler of a kind of job, queued every `every` seconds while the queue runs when given.
+        """
+        def register(function):
+            self.handlers[kind] = function
+            if every:
+                self.schedules[kind] = every
+            return function
+        return register
+
+    def _execute(self, statement, parameters=()):
+        # One connection per process, used from the threadpool
+        with self._lock:
+            if self._connection is None:
+                connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(SCHEMA)
+                self._connection = connection
+            return self._connection.execute(statement, parameters).fetchall()
+
+    async def execute(self, statement, parameters=()):
+        return await run_in_threadpool(self._execute, statement, parameters)
+
+    async def enqueue(self, kind: str, payload: Optional[dict] = None, delay: float = 0, unique: bool = False):
+        """
+        Queue a job.
+
+        :param delay: Seconds before the job may run.
+        :param unique: Skip the job while one of the same kind and payload is queued or running.
+        :return: Identifier of the job, None if it was skipped.
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"No handler of {kind} jobs.")
+        payload = orjson.dumps(payload or {}, option=orjson.OPT_SORT_KEYS).decode()
+        condition = ("WHERE NOT EXISTS (SELECT 1 FROM jobs WHERE kind = :kind AND payload = :payload"
+                     " AND status IN ('queued', 'running'))") if unique else ""
+        rows = await self.execute(
+            f"INSERT INTO jobs (kind, payload, run_after) SELECT :kind, :payload, :run_after {condition} RETURNING id",
+            {"kind": kind, "payload": payload, "run_after": time.time() + delay})
+        if self._wake is not None and not delay:
+            self._wake.set()
+        return rows[0][0] if rows else None
+
+    async def run_one(self) -> bool:
+        """
+        Claim and run one ready job.
+
+        :return: True if a job was run, whether it succeeded or not.
+        """
+        now = time.time()
+        rows = await self.execute(CLAIM, {"now": now, "lease_until": now + self.lease_seconds})
+        if not rows:
+            return False
+        job_id, kind, payload, attempts = rows[0]
+        try:
+            await self.handlers[kind](**orjson.loads(payload))
+        except asyncio.CancelledError:
+            # Stopped while running, the job is left to the next start
+            await self.execute("UPDATE jobs SET status = 'queued', attempts = attempts - 1, lease_until = NULL"
+                               " WHERE id = ?", (job_id,))
+            raise
+        except Exception as ex:
+            logger.exception(f"Job {job_id} ({kind}) failed on attempt {attempts}")
+            if attempts >= self.max_attempts:
+                await self.execute("UPDATE jobs SET status = 'failed', lease_until = NULL, last_error = ?"
+                                   " WHERE id = ?", (repr(ex), job_id))
+            else:
+                await self.execute("UPDATE jobs SET status = 'queued', lease_until = NULL, last_error = ?,"
+                                   " run_after = ? WHERE id = ?",
+                                   (repr(ex), time.time() + min(2 ** attempts, MAX_RETRY_DELAY), job_id))
+        else:
+            await self.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        return True
+
+    async def run_pending(self) -> int:
+        """
+        Run the ready jobs until none is left, retries waiting for their delay are not.
+
+        :return: Number of jobs run.
+        """
+        count = 0
+        while await self.run_one():
+            count += 1
+        return count
+
+    async def counts(self):
+        """
+        Get the number of jobs by kind and status.
+        """
+        rows = await self.execute("SELECT kind, status, count(*) FROM jobs GROUP BY kind, status ORDER BY kind, status")
+        counts = {}
+        for kind, status, count in rows:
+            counts.setdefault(kind, {})[status] = count
+        return counts
+
+    async def _work(self):
+        while True:
+            try:
+                ran = await self.run_one()
+            except Exception:
+                logger.exception("Claiming a job failed")
+                ran = False
+            if not ran:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _schedule(self, kind, every):
+        # The queued job is durable, so restarts do not run it early
+        while True:
+            try:
+                await self.enqueue(kind, delay=every, unique=True)
+            except Exception:
+                logger.exception(f"Scheduling {kind} jobs failed")
+            await asyncio.sleep(every)
+
+    def start(self):
+        """
+        Run the workers and the scheduled jobs in the running event loop.
+        """
+        if self._tasks or self.workers < 1:
+            return
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks += [asyncio.create_task(self._schedule(kind, every)) for kind, every in self.schedules.items()]
+
+    async def stop(self):
+        """
+        Cancel the workers, the jobs they were running are run again on the next start.
+        """
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._wake = None
+
+
+job_queue = JobQueue(JOBS_DB, JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_LEASE_SECONDS, JOB_POLL_INTERVAL)
+
+
+def upload_path(path):
+    """
+    Resolve the path of an uploaded file, None for anything outside the UPLOAD_FOLDERS.
+    """
+    path = os.path.realpath(path)
+    for folder in UPLOAD_FOLDERS:
+        folder = os.path.realpath(folder)
+        if os.path.commonpath([folder, path]) == folder and path != folder:
+            return path
+    return None
+
+
+def remove_upload(path):
+    """
+    Remove an uploaded file with its derivatives. Runs in the threadpool.
+    """
+    path = upload_path(path)
+    if path is None or not os.path.isfile(path):
+        return
+    # Derivatives are named by the hash of their source, computed before it is gone
+    digest = file_digest(path)
+    for size in THUMBNAIL_SIZES:
+        for extension in FORMATS:
+            try:
+                os.remove(derivative_path(digest, size, extension))
+            except FileNotFoundError:
+                pass
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def referenced(paths):
+    """
+    Get those of `paths` a file column still refers to, however the column spells them.
+    """
+    spellings = {}
+    for path in paths:
+        for spelling in (path, os.path.abspath(path), os.path.relpath(path)):
+            spellings[spelling] = path
+    found = set()
+    async with AsyncSessionLocal() as ss:
+        for table in Base.metadata.tables.values():
+            for column in file_columns(table):
+                result = await ss.execute(select(column).where(column.in_(list(spellings))).distinct())
+                found.update(spellings[value] for value in result.scalars())
+    return found
+
+
+@job_queue.handler("delete_files")
+async def delete_files(paths):
+    # A row created since the deletion was queued may refer to the file again
+    kept = await referenced(paths)
+    for path in paths:
+        if path not in kept:
+            await run_in_threadpool(remove_upload, path)
+
+
+@job_queue.handler("derivatives")
+async def derivatives(path):
+    await generate_derivatives(path)
+
+
+async def release_files(paths):
+    await job_queue.enqueue("delete_files", {"paths": paths})
+
+
+file_release_hooks.append(release_files)
+
+
+def list_uploads(before):
+    """
+    List the files in the UPLOAD_FOLDERS last modified before the timestamp `before`.
+    """
+    paths = []
+    for folder in UPLOAD_FOLDERS:
+        for directory, _, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    if os.stat(path).st_mtime < before:
+                        paths.append(path)
+                except FileNotFoundError:
+                    pass
+    return paths
+
+
+async def stored_paths():
+    """
+    Get the absolute paths every file column refers to, streamed from the primary database.
+    """
+    paths = set()
+    async with AsyncSessionLocal() as ss:
+        for table in Base.metadata.tables.values():
+            for column in file_columns(table):
+                result = await ss.stream_scalars(select(column).where(column.is_not(None)).distinct())
+                async for partition in result.partitions(GC_BATCH_SIZE):
+                    paths.update(os.path.abspath(path) for path in partition)
+    return paths
+
+
+@job_queue.handler("collect_orphans", every=GC_INTERVAL)
+async def collect_orphans(min_age: float = GC_MIN_AGE):
+    """
+    Queue the deletion of the uploaded files no row refers to, in batches of GC_BATCH_SIZE.
+
+    Only files older than `min_age` seconds are taken, so uploads whose row is not committed
+    yet and partial uploads still being written are left alone.
+    """
+    candidates = await run_in_threadpool(list_uploads, time.time() - min_age)
+    stored = await stored_paths()
+    orphans = [path for path in candidates if os.path.abspath(path) not in stored]
+    for start in range(0, len(orphans), GC_BATCH_SIZE):
+        await job_queue.enqueue("delete_files", {"paths": orphans[start:start + GC_BATCH_SIZE]})
+    if orphans:
+        logger.info(f"Queued the deletion of {len(orphans)} orphaned files")
+    return orphans
+
+
+async def run(args):
+    try:
+        if args.gc:
+            await collect_orphans()
+        if args.gc or args.run:
+            await job_queue.run_pending()
+        print(orjson.dumps(await job_queue.counts(), option=orjson.OPT_INDENT_2).decode())
+    finally:
+        await dispose_engine()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--run", action="store_true", help="run the pending jobs")
+    parser.add_argument("--gc", action="store_true", help="collect orphaned files and run the deletions")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(message)s")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,45 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
+from src.db_handlers.config import DB_POOL_PREWARM, DB_REPLICA_URLS, DB_READ_YOUR_WRITES_SECONDS
+from src.db_handlers.db_manage import dispose_engine, warm_pool
 from src.upha_site.routes.routes import router as base_route
 from src.upha_site.routes.ad_routes import router as ad_route
 from src.upha_site.routes.shelter_routes import router as shelter_route
 from src.upha_site.routes.animal_routes import router as animal_route
 from src.upha_site.routes.auth_routes import router as auth_route
+from src.upha_site.routes.admin_routes import router as admin_route
+from src.upha_site.images import shutdown_pool
+from src.upha_site.jobs import job_queue
+from src.upha_site.middleware import CompressionMiddleware, MetricsMiddleware, ReadYourWritesMiddleware
+from src.upha_site.config import COMPRESSION_ENABLED, MEDIA_ROOT, METRICS_ENABLED, SERVER_TIMING
 
 
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The engine is created here rather than on import, and the server accepts requests once it is connected
+    await warm_pool(DB_POOL_PREWARM)
+    job_queue.start()
+    yield
+    await job_queue.stop()
+    shutdown_pool()
+    await dispose_engine()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+# The directory is looked up on the first request, not when the application is imported
+app.mount("/static", StaticFiles(directory=MEDIA_ROOT, check_dir=False), name="static")
 app.include_router(base_route, tags=["base"])
 app.include_router(ad_route, prefix="/ads", tags=["advertisement"])
 app.include_router(shelter_route, prefix="/shelters", tags=["shelters"])
 app.include_router(animal_route, prefix="/animals", tags=["animals"])
 app.include_router(auth_route, prefix="/auth", tags=["authentication"])
+app.include_router(admin_route, prefix="/admin", tags=["admin"], include_in_schema=False)
+if DB_REPLICA_URLS and DB_READ_YOUR_WRITES_SECONDS > 0:
+    app.add_middleware(ReadYourWritesMiddleware)
+if COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware)
+# Added last, so it measures the requests the middleware above answer too
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware, server_timing_header=SERVER_TIMING)
@@ -0,0 +1,228 @@
+import time
+from typing import Optional
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import HTTPConnection
+from src.db_handlers.config import DB_READ_YOUR_WRITES_SECONDS
+from src.db_handlers.db_manage import ReadConsistency, read_consistency
+from src.db_handlers.core.cache import repository_cache
+from src.db_handlers.core.metrics import (COUNT_BUCKETS, Counter, Histogram, QueryTiming, query_timing,
+                                          registry)
+from src.upha_site.compression import ENCODERS, PayloadCache, is_compressible, negotiate
+from src.upha_site.config import COMPRESSION_MIN_SIZE, COMPRESSION_THREAD_SIZE, PAYLOAD_CACHE_MAX_BYTES
+
+
+request_duration = registry.add(Histogram(
+    "upha_http_request_duration_seconds", "Latency of HTTP requests until the last byte of the response.",
+    ("method", "route", "status")))
+request_db_duration = registry.add(Histogram(
+    "upha_http_request_db_duration_seconds", "Time spent in SQL statements per HTTP request.", ("route",)))
+request_statements = registry.add(Histogram(
+    "upha_http_request_sql_statements", "SQL statements executed per HTTP request.", ("route",),
+    buckets=COUNT_BUCKETS))
+request_exceptions = registry.add(Counter(
+    "upha_http_request_exceptions_total", "HTTP requests that raised an unhandled exception.", ("route",)))
+
+
+def route_label(scope):
+    # The path template keeps one series per route, unmatched paths share one
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def server_timing(timing: QueryTiming, elapsed: float) -> bytes:
+    return (f'db;dur={timing.seconds * 1000:.2f};desc="{timing.statements} queries", '
+            f"pool;dur={timing.checkout_seconds * 1000:.2f}, app;dur={elapsed * 1000:.2f}").encode()
+
+
+class MetricsMiddleware:
+    """
+    Record the latency and the SQL work of every HTTP request.
+
+    The database time of the request so far is sent in a `Server-Timing` header, next to
+    the pool wait and the time until the response started, so it shows in browser devtools.
+    """
+
+    def __init__(self, app, server_timing_header: bool = True):
+        self.app = app
+        self.server_timing_header = server_timing_header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = QueryTiming(origin=lambda: f"{scope['method']} {route_label(scope)}")
+        token = query_timing.set(timing)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if self.server_timing_header:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing(timing, time.perf_counter() - started)))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        except Exception:
+            request_exceptions.inc(route_label(scope))
+            raise
+        finally:
+            query_timing.reset(token)
+            route = route_label(scope)
+            request_duration.observe(time.perf_counter() - started, scope["method"], route, str(status[0]))
+            request_db_duration.observe(timing.seconds, route)
+            request_statements.observe(timing.statements, route)
+
+
+class ReadYourWritesMiddleware:
+    """
+    Keep the reads of a client on the primary database for a while after it wrote.
+
+    The time is carried in a cookie, so the following requests of the client do not read from
+    a replica that has not caught up with its write yet. Times further ahead than the window
+    are ignored.
+    """
+    cookie = "upha_primary_until"
+
+    def __init__(self, app, window: float = DB_READ_YOUR_WRITES_SECONDS):
+        self.app = app
+        self.window = window
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            primary_until = float(HTTPConnection(scope).cookies.get(self.cookie, 0))
+        except ValueError:
+            primary_until = 0.0
+        state = ReadConsistency(min(primary_until, time.time() + self.window))
+        token = read_consistency.set(state)
+
+        async def send_cookie(message):
+            # Writes are committed before the response starts
+            if message["type"] == "http.response.start" and state.written:
+                cookie = f"{self.cookie}={state.primary_until:.3f}; Max-Age={int(self.window) + 1}; Path=/; HttpOnly"
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_cookie)
+        finally:
+            read_consistency.reset(token)
+
+
+payload_cache = PayloadCache(PAYLOAD_CACHE_MAX_BYTES)
+
+
+class CompressionMiddleware:
+    """
+    Compress responses with the best content coding the client accepts.
+
+    Bodies shorter than `minimum_size`, already encoded or of incompressible types are sent as
+    they are, like bodies sent through the pathsend and zerocopysend extensions; bodies of at least
+    `thread_size` bytes are compressed in a worker thread, streamed ones chunk by chunk. The finished bodies of routes answering conditional GETs are kept in
+    `cache` per path, query and coding, and served again without running the route while the
+    ETag of their models is unchanged.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE, thread_size: int = COMPRESSION_THREAD_SIZE,
+                 cache: Optional[PayloadCache] = payload_cache):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.thread_size = thread_size
+        self.cache = cache
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoding = negotiate(request_headers.get("accept-encoding", ""))
+        key = None
+        # Disabling the repository cache disables this one too
+        if (self.cache is not None and repository_cache.enabled and scope["method"] == "GET"
+                and "range" not in request_headers):
+            key = (scope["path"], scope["query_string"], encoding)
+            # Requests with If-None-Match are left to the route, which answers them without a body
+            if "if-none-match" not in request_headers and await self.send_cached(key, scope, send):
+                return
+
+        start = {}
+        encode = None
+
+        async def send_compressed(message):
+            nonlocal start, encode
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                # Bodies sent by the server itself (pathsend, zerocopysend) go out as they are
+                if start:
+                    await send(start)
+                    start = {}
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start:
+                headers = MutableHeaders(raw=list(start.get("headers", [])))
+                compressible = is_compressible(headers.get("content-type", "")) and "content-encoding" not in headers
+                if compressible:
+                    headers.add_vary_header("Accept-Encoding")
+                if (compressible and encoding is not None and start["status"] not in (204, 206, 304)
+                        and (more_body or len(body) >= self.minimum_size)):
+                    encode = ENCODERS[encoding]()
+                    headers["Content-Encoding"] = encoding
+                    if more_body:
+                        del headers["Content-Length"]
+                if encode is not None:
+                    body = await self.encode(encode, body, not more_body)
+                    if not more_body:
+                        headers["Content-Length"] = str(len(body))
+                start = {**start, "headers": headers.raw}
+                if key is not None and not more_body:
+                    self.store(key, scope, start, body)
+                await send(start)
+                start = {}
+            elif encode is not None:
+                body = await self.encode(encode, body, not more_body)
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+    async def encode(self, encode, body, final):
+        if len(body) >= self.thread_size:
+            return await run_in_threadpool(encode, body, final)
+        return encode(body, final)
+
+    def store(self, key, scope, start, body):
+        models = scope.get("conditional_models")
+        headers = Headers(raw=start["headers"])
+        if start["status"] != 200 or models is None or "etag" not in headers or "set-cookie" in headers:
+            return
+        self.cache.set(key, headers["etag"], models, start["headers"], body, scope.get("route"))
+
+    async def send_cached(self, key, scope, send):
+        entry = self.cache.get(key)
+        if entry is None:
+            return False
+        etag, models, headers, body, route = entry
+        current, _ = await repository_cache.validators(*models)
+        if current != etag:
+            self.cache.delete(key)
+            return False
+        if route is not None:
+            # Labels the metrics of the request as if the route had answered
+            scope["route"] = route
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+        return True
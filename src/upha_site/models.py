@@ -1,5 +1,7 @@
+from datetime import datetime
 from pydantic import BaseModel
 from typing import Optional
+from src.db_handlers.core.models import SexEnum, SpeciesEnum
 
 
 class ShelterCreate(BaseModel):
@@ -10,3 +12,25 @@ class ShelterCreate(BaseModel):
     instagram: Optional[str] = None
     twitter: Optional[str] = None
     website: Optional[str] = None
+
+
+class AdvertisementCreate(BaseModel):
+    title: str
+    body: str
+    image_path: str
+    published_time: Optional[datetime] = None
+
+
+class AnimalCreate(BaseModel):
+    name: str
+    sex: SexEnum
+    age: int
+    image_path: str
+    species: SpeciesEnum
+    since_time: datetime
+    shelter_id: Optional[int] = None
+
+
+class BulkUpdate(BaseModel):
+    filter: dict
+    data: dict
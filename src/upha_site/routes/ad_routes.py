@@ -1,8 +1,14 @@
-from fastapi import APIRouter, UploadFile, File, Form
+from typing import Annotated, List, Optional
+from fastapi import APIRouter, Body, Depends, UploadFile, File, Form, Query
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.db_handlers.db_manage import get_session
 from src.db_handlers.core.orm import AdvertisementRepository
-from uuid import uuid4
-from src.upha_site.services import upload_image, delete_image, is_empty
+from src.db_handlers.core.models import Advertisement
+from src.upha_site.models import AdvertisementCreate, BulkUpdate
+from src.upha_site.services import upload_image, delete_image, is_empty, stream_response, field_list, ConditionalGet
 import logging
+from src.upha_site.config import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_BATCH_SIZE, BULK_MAX_ITEMS
 
 
 router = APIRouter()
@@ -10,34 +16,70 @@ logger = logging.getLogger("ads-route")
 
 
 @router.get("")
-async def get_all_ads():
-    data = await AdvertisementRepository().retrieve_all()
-    return data
+async def get_all_ads(
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session),
+        validators: dict = Depends(ConditionalGet(Advertisement))
+):
+    data = await AdvertisementRepository(ss).retrieve_all(limit=limit, after=after, fields=fields)
+    return ORJSONResponse(data, headers=validators)
+
+
+@router.get("/stream")
+async def stream_ads(media_format: str = Query(default="ndjson", alias="format", pattern="^(ndjson|json)$")):
+    batches = AdvertisementRepository().stream_all(batch_size=STREAM_BATCH_SIZE)
+    return stream_response(batches, media_format)
+
+
+@router.get("/search")
+async def search_ads(
+        q: str = Query(min_length=1, max_length=256),
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        ss: AsyncSession = Depends(get_session)
+):
+    data = await AdvertisementRepository(ss).search(q, limit=limit, after=after)
+    return ORJSONResponse(data)
 
 
 @router.post("/filter")
-async def filter_ads(filter_condition: dict):
-    data = await AdvertisementRepository().filter_all(filter_condition)
-    return data
+async def filter_ads(
+        filter_condition: dict,
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session)
+):
+    data = await AdvertisementRepository(ss).filter_all(filter_condition, limit=limit, after=after, fields=fields)
+    return ORJSONResponse(data)
 
 
 @router.post("/filter-by-time")
-async def filter_ads_by_time(days: int):
-    data = await AdvertisementRepository().filter_by_time(days)
-    return data
+async def filter_ads_by_time(
+        days: int,
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session)
+):
+    data = await AdvertisementRepository(ss).filter_by_time(days, limit=limit, after=after, fields=fields)
+    return ORJSONResponse(data)
 
 
 @router.post("/create")
-async def create_ad(title: str = Form(), body: str = Form(), file: UploadFile = File(...)):
+async def create_ad(
+        title: str = Form(),
+        body: str = Form(),
+        file: UploadFile = File(...),
+        ss: AsyncSession = Depends(get_session)
+):
     try:
-        # Generate a unique filename for the uploaded image
-        generated_filename = f"{uuid4()}{file.filename}"
-
         # Prepare data for validation and creation
         data = {
             "title": title,
-            "body": body,
-            "image_path": f"static/ads-images/{generated_filename}"
+            "body": body
         }
 
         # Validate input data
@@ -46,28 +88,27 @@ async def create_ad(title: str = Form(), body: str = Form(), file: UploadFile =
         if "error" in validation_result:
             return validation_result
         else:
+            image_path = None
             try:
-                # Upload the image
-                image_upload_result = await upload_image(
-                    file=file,
-                    folder="ads-images",
-                    generated_filename=generated_filename
-                )
+                # Upload the image under a generated name, the client's file name is never used
+                image_upload_result = await upload_image(file=file, folder="ads-images")
 
                 if "error" in image_upload_result:
                     return image_upload_result
                 else:
+                    image_path = data["image_path"] = image_upload_result["path"]
                     # Create a new advertisement in the repository
-                    adv = await AdvertisementRepository().create(**data)
+                    adv = await AdvertisementRepository(ss).create(**data)
 
                     if "error" in adv:
                         # If there's an error in advertisement creation, delete the uploaded image
-                        await delete_image(f"static/ads-images/{generated_filename}")
+                        await delete_image(image_path)
                         return adv
                     else:
                         return adv
             except Exception as ex:
-                await delete_image(f"static/ads-images/{generated_filename}")
+                if image_path is not None:
+                    await delete_image(image_path)
                 logger.exception(f"{ex.add_note('An error occurred during ad creation')}")
                 return {"error": "An error occurred while uploading the image."}
     except Exception as ex:
@@ -75,19 +116,45 @@ async def create_ad(title: str = Form(), body: str = Form(), file: UploadFile =
         return {"error": "Internal error."}
 
 
-@router.get("/{pk}")
-async def get_one_ad(pk: int):
-    data = await AdvertisementRepository().retrieve_one(pk=pk)
+@router.post("/bulk")
+async def bulk_create_ads(
+        new_ads: Annotated[List[AdvertisementCreate], Body(max_length=BULK_MAX_ITEMS)],
+        ss: AsyncSession = Depends(get_session)
+):
+    data = await AdvertisementRepository(ss).create_many([item.model_dump(exclude_unset=True) for item in new_ads])
+    return data
+
+
+@router.patch("/bulk-update")
+async def bulk_update_ads(bulk_update: BulkUpdate, ss: AsyncSession = Depends(get_session)):
+    data = await AdvertisementRepository(ss).update_many(bulk_update.filter, bulk_update.data)
+    return data
+
+
+@router.delete("/bulk-delete")
+async def bulk_delete_ads(filter_condition: dict, ss: AsyncSession = Depends(get_session)):
+    data = await AdvertisementRepository(ss).delete_many(filter_condition)
     return data
 
 
+@router.get("/{pk}")
+async def get_one_ad(
+        pk: int,
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session),
+        validators: dict = Depends(ConditionalGet(Advertisement))
+):
+    data = await AdvertisementRepository(ss).retrieve_one(pk=pk, fields=fields)
+    return ORJSONResponse(data, headers=validators)
+
+
 @router.delete("/{pk}/delete")
-async def delete_ad(pk: int):
-    data = await AdvertisementRepository().delete(pk=pk)
+async def delete_ad(pk: int, ss: AsyncSession = Depends(get_session)):
+    data = await AdvertisementRepository(ss).delete(pk=pk)
     return data
 
 
 @router.patch("/{pk}/update")
-async def update_ad(pk: int, new_data: dict):
-    data = await AdvertisementRepository().update(pk=pk, new_data=new_data)
+async def update_ad(pk: int, new_data: dict, ss: AsyncSession = Depends(get_session)):
+    data = await AdvertisementRepository(ss).update(pk=pk, new_data=new_data)
     return data
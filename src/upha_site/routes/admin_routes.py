@@ -0,0 +1,30 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, Query
+from src.db_handlers.core.slowlog import slow_query_log
+from src.upha_site.jobs import job_queue
+from src.upha_site.services import require_admin
+
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get("/slow-queries")
+async def slow_queries(limit: Optional[int] = Query(default=None, ge=1)):
+    # Statements of this worker process, the slowest first
+    return {
+        "threshold_ms": slow_query_log.threshold * 1000,
+        "explain": slow_query_log.explain,
+        "items": slow_query_log.recent(limit),
+    }
+
+
+@router.delete("/slow-queries")
+async def clear_slow_queries():
+    slow_query_log.entries.clear()
+    return {"message": "Slow query log cleared."}
+
+
+@router.get("/jobs")
+async def jobs():
+    # Shared by all the worker processes, done jobs are removed
+    return {"counts": await job_queue.counts()}
@@ -1,10 +1,15 @@
 from datetime import datetime
-from fastapi import APIRouter, Form, File, UploadFile
+from typing import Annotated, List, Optional
+from fastapi import APIRouter, Body, Depends, Form, File, UploadFile, Query
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.db_handlers.db_manage import get_session
 from src.db_handlers.core.orm import AnimalRepository
-from uuid import uuid4
-from src.upha_site.services import is_empty, upload_image, delete_image
+from src.upha_site.services import is_empty, upload_image, delete_image, stream_response, field_list, ConditionalGet
 import logging
-from src.db_handlers.core.models import SexEnum, SpeciesEnum
+from src.db_handlers.core.models import Animal, SexEnum, SpeciesEnum
+from src.upha_site.models import AnimalCreate, BulkUpdate
+from src.upha_site.config import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_BATCH_SIZE, BULK_MAX_ITEMS
 
 
 router = APIRouter()
@@ -12,15 +17,44 @@ logger = logging.getLogger("animals-route")
 
 
 @router.get("")
-async def get_all_animals():
-    data = await AnimalRepository().retrieve_all()
-    return data
+async def get_all_animals(
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session),
+        validators: dict = Depends(ConditionalGet(Animal))
+):
+    data = await AnimalRepository(ss).retrieve_all(limit=limit, after=after, fields=fields)
+    return ORJSONResponse(data, headers=validators)
+
+
+@router.get("/stream")
+async def stream_animals(media_format: str = Query(default="ndjson", alias="format", pattern="^(ndjson|json)$")):
+    batches = AnimalRepository().stream_all(batch_size=STREAM_BATCH_SIZE)
+    return stream_response(batches, media_format)
+
+
+@router.get("/search")
+async def search_animals(
+        q: str = Query(min_length=1, max_length=256),
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        ss: AsyncSession = Depends(get_session)
+):
+    data = await AnimalRepository(ss).search(q, limit=limit, after=after)
+    return ORJSONResponse(data)
 
 
 @router.post("/filter")
-async def filter_animals(filter_condition: dict):
-    data = await AnimalRepository().filter_all(filter_condition)
-    return data
+async def filter_animals(
+        filter_condition: dict,
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session)
+):
+    data = await AnimalRepository(ss).filter_all(filter_condition, limit=limit, after=after, fields=fields)
+    return ORJSONResponse(data)
 
 
 @router.post("/create")
@@ -31,17 +65,14 @@ async def create_animal(
         species: SpeciesEnum = Form(),
         since_time: datetime = Form(),
         shelter_id: int = Form(),
-        file: UploadFile = File(...)
+        file: UploadFile = File(...),
+        ss: AsyncSession = Depends(get_session)
 ):
     try:
-        # Generate a unique filename for the uploaded image
-        generated_filename = f"{uuid4()}{file.filename}"
-
         # Prepare data for validation and creation
         data = {
             "name": name,
             "sex": sex,
-            "image_path": f"static/animals-images/{generated_filename}",
             "age": age,
             "species": species,
             "since_time": since_time,
@@ -54,28 +85,27 @@ async def create_animal(
         if "error" in validation_result:
             return validation_result
         else:
+            image_path = None
             try:
-                # Upload the image
-                image_upload_result = await upload_image(
-                    file=file,
-                    folder="animals-images",
-                    generated_filename=generated_filename
-                )
+                # Upload the image under a generated name, the client's file name is never used
+                image_upload_result = await upload_image(file=file, folder="animals-images")
 
                 if "error" in image_upload_result:
                     return image_upload_result
                 else:
+                    image_path = data["image_path"] = image_upload_result["path"]
                     # Create a new animal in the repository
-                    adv = await AnimalRepository().create(**data)
+                    adv = await AnimalRepository(ss).create(**data)
 
                     if "error" in adv:
                         # If there's an error in animal creation, delete the uploaded image
-                        await delete_image(f"static/animals-images/{generated_filename}")
+                        await delete_image(image_path)
                         return adv
                     else:
                         return adv
             except Exception as ex:
-                await delete_image(f"static/animals-images/{generated_filename}")
+                if image_path is not None:
+                    await delete_image(image_path)
                 logger.exception(f"{ex.add_note('An error occurred during animal creation')}")
                 return {"error": "An error occurred while uploading the image."}
     except Exception as ex:
@@ -83,19 +113,45 @@ async def create_animal(
         return {"error": "Internal error."}
 
 
-@router.get("/{pk}")
-async def get_one_animal(pk: int):
-    data = await AnimalRepository().retrieve_one(pk=pk)
+@router.post("/bulk")
+async def bulk_create_animals(
+        new_animals: Annotated[List[AnimalCreate], Body(max_length=BULK_MAX_ITEMS)],
+        ss: AsyncSession = Depends(get_session)
+):
+    data = await AnimalRepository(ss).create_many([item.model_dump(exclude_unset=True) for item in new_animals])
+    return data
+
+
+@router.patch("/bulk-update")
+async def bulk_update_animals(bulk_update: BulkUpdate, ss: AsyncSession = Depends(get_session)):
+    data = await AnimalRepository(ss).update_many(bulk_update.filter, bulk_update.data)
     return data
 
 
+@router.delete("/bulk-delete")
+async def bulk_delete_animals(filter_condition: dict, ss: AsyncSession = Depends(get_session)):
+    data = await AnimalRepository(ss).delete_many(filter_condition)
+    return data
+
+
+@router.get("/{pk}")
+async def get_one_animal(
+        pk: int,
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session),
+        validators: dict = Depends(ConditionalGet(Animal))
+):
+    data = await AnimalRepository(ss).retrieve_one(pk=pk, fields=fields)
+    return ORJSONResponse(data, headers=validators)
+
+
 @router.delete("/{pk}/delete")
-async def delete_animal(pk: int):
-    data = await AnimalRepository().delete(pk=pk)
+async def delete_animal(pk: int, ss: AsyncSession = Depends(get_session)):
+    data = await AnimalRepository(ss).delete(pk=pk)
     return data
 
 
 @router.patch("/{pk}/update")
-async def update_animal(pk: int, new_data: dict):
-    data = await AnimalRepository().update(pk=pk, new_data=new_data)
+async def update_animal(pk: int, new_data: dict, ss: AsyncSession = Depends(get_session)):
+    data = await AnimalRepository(ss).update(pk=pk, new_data=new_data)
     return data
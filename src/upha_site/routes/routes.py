@@ -1,5 +1,13 @@
-from fastapi import APIRouter
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.db_handlers.db_manage import get_session
+from src.db_handlers.core.cache import repository_cache
+from src.db_handlers.core.metrics import registry
+from src.db_handlers.core.orm import AdvertisementRepository, AnimalRepository, StatisticRepository
+from src.upha_site.config import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from src.upha_site.images import get_derivative, resolve_image, resolve_source, serve_image
 
 
 router = APIRouter()
@@ -17,7 +25,57 @@ async def get_info():
     return {"message": text}
 
 
-@router.get("/img")
-async def img(image_path: str):
-    image_path = f"{image_path}"
-    return FileResponse(image_path, media_type="image/jpeg")
+@router.api_route("/img", methods=["GET", "HEAD"])
+async def img(request: Request, image_path: str):
+    path = await run_in_threadpool(resolve_image, image_path)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found.")
+    return await serve_image(request, path)
+
+
+@router.get("/search")
+async def search(
+        q: str = Query(min_length=1, max_length=256),
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        ss: AsyncSession = Depends(get_session)
+):
+    # First pages only, the next ones come from /ads/search and /animals/search with their cursors
+    return {
+        "advertisements": await AdvertisementRepository(ss).search(q, limit=limit),
+        "animals": await AnimalRepository(ss).search(q, limit=limit),
+    }
+
+
+@router.get("/stats")
+async def stats(ss: AsyncSession = Depends(get_session)):
+    return await StatisticRepository(ss).summary()
+
+
+@router.get("/cache-stats")
+async def cache_stats():
+    if not repository_cache.enabled:
+        return {"message": "Cache is disabled."}
+    return repository_cache.stats()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Prometheus text exposition format, counted per worker process
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.api_route("/thumbnails/{size}/{image_path:path}", methods=["GET", "HEAD"])
+async def thumbnail(
+        request: Request,
+        size: int,
+        image_path: str,
+        extension: str = Query(default="webp", alias="format", pattern="^(webp|jpeg)$")
+):
+    path = await get_derivative(image_path, size, extension)
+    if path is None:
+        # Fall back to the original when no derivative can be made from it
+        source = await run_in_threadpool(resolve_source, image_path)
+        if source is None:
+            raise HTTPException(status_code=404, detail="Image not found.")
+        return await serve_image(request, source)
+    return await serve_image(request, path)
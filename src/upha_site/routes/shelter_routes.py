@@ -1,42 +1,117 @@
-from fastapi import APIRouter
-from src.db_handlers.core.orm import ShelterRepository
-from src.upha_site.models import ShelterCreate
+from typing import Annotated, List, Optional
+from fastapi import APIRouter, Body, Depends, Query
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.db_handlers.db_manage import get_session
+from src.db_handlers.core.orm import ShelterRepository, AnimalRepository
+from src.db_handlers.core.models import Shelter, Animal
+from src.upha_site.models import ShelterCreate, BulkUpdate
+from src.upha_site.services import stream_response, field_list, ConditionalGet
+from src.upha_site.config import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_BATCH_SIZE, BULK_MAX_ITEMS, INCLUDE_PAGE_SIZE
 
 
 router = APIRouter()
+conditional_get = ConditionalGet(Shelter, includes={"animals": Animal})
 
 
 @router.get("")
-async def get_all_shelters():
-    data = await ShelterRepository().retrieve_all()
-    return data
+async def get_all_shelters(
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        include: Optional[str] = Query(default=None, pattern="^animals$"),
+        animals_limit: int = Query(default=INCLUDE_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session),
+        validators: dict = Depends(conditional_get)
+):
+    repository = ShelterRepository(ss)
+    data = await repository.retrieve_all(limit=limit, after=after, fields=fields)
+    if include and "items" in data:
+        data = {**data, "items": await repository.include_animals(data["items"], animals_limit)}
+    return ORJSONResponse(data, headers=validators)
+
+
+@router.get("/stream")
+async def stream_shelters(media_format: str = Query(default="ndjson", alias="format", pattern="^(ndjson|json)$")):
+    batches = ShelterRepository().stream_all(batch_size=STREAM_BATCH_SIZE)
+    return stream_response(batches, media_format)
 
 
 @router.post("/filter")
-async def filter_shelter(filter_condition: dict):
-    data = await ShelterRepository().filter_all(filter_condition)
-    return data
+async def filter_shelter(
+        filter_condition: dict,
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session)
+):
+    data = await ShelterRepository(ss).filter_all(filter_condition, limit=limit, after=after, fields=fields)
+    return ORJSONResponse(data)
 
 
 @router.post("/create")
-async def create_shelter(new_shelter: ShelterCreate):
-    data = await ShelterRepository().create(**new_shelter.dict())
+async def create_shelter(new_shelter: ShelterCreate, ss: AsyncSession = Depends(get_session)):
+    data = await ShelterRepository(ss).create(**new_shelter.dict())
     return data
 
 
-@router.get("/{pk}")
-async def get_one_shelter(pk: int):
-    data = await ShelterRepository().retrieve_one(pk=pk)
+@router.post("/bulk")
+async def bulk_create_shelters(
+        new_shelters: Annotated[List[ShelterCreate], Body(max_length=BULK_MAX_ITEMS)],
+        ss: AsyncSession = Depends(get_session)
+):
+    data = await ShelterRepository(ss).create_many([item.model_dump(exclude_unset=True) for item in new_shelters])
+    return data
+
+
+@router.patch("/bulk-update")
+async def bulk_update_shelters(bulk_update: BulkUpdate, ss: AsyncSession = Depends(get_session)):
+    data = await ShelterRepository(ss).update_many(bulk_update.filter, bulk_update.data)
     return data
 
 
+@router.delete("/bulk-delete")
+async def bulk_delete_shelters(filter_condition: dict, ss: AsyncSession = Depends(get_session)):
+    data = await ShelterRepository(ss).delete_many(filter_condition)
+    return data
+
+
+@router.get("/{pk}")
+async def get_one_shelter(
+        pk: int,
+        include: Optional[str] = Query(default=None, pattern="^animals$"),
+        animals_limit: int = Query(default=INCLUDE_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session),
+        validators: dict = Depends(conditional_get)
+):
+    repository = ShelterRepository(ss)
+    data = await repository.retrieve_one(pk=pk, fields=fields)
+    if include and "pk" in data:
+        data = (await repository.include_animals([data], animals_limit))[0]
+    return ORJSONResponse(data, headers=validators)
+
+
+@router.get("/{pk}/animals")
+async def get_shelter_animals(
+        pk: int,
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[str] = None,
+        fields: Optional[List[str]] = Depends(field_list),
+        ss: AsyncSession = Depends(get_session),
+        validators: dict = Depends(ConditionalGet(Animal))
+):
+    data = await AnimalRepository(ss).filter_all({"shelter_id": pk}, limit=limit, after=after, fields=fields)
+    return ORJSONResponse(data, headers=validators)
+
+
 @router.delete("/{pk}/delete")
-async def delete_shelter(pk: int):
-    data = await ShelterRepository().delete(pk=pk)
+async def delete_shelter(pk: int, ss: AsyncSession = Depends(get_session)):
+    data = await ShelterRepository(ss).delete(pk=pk)
     return data
 
 
 @router.patch("/{pk}/update")
-async def update_shelter(pk: int, new_data: dict):
-    data = await ShelterRepository().update(pk=pk, new_data=new_data)
+async def update_shelter(pk: int, new_data: dict, ss: AsyncSession = Depends(get_session)):
+    data = await ShelterRepository(ss).update(pk=pk, new_data=new_data)
     return data
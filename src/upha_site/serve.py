@@ -0,0 +1,106 @@
+"""
+Multi-process server of the application.
+
+Every worker is a fresh interpreter that builds its own engine after it starts, so no pooled
+connection is shared between processes. The pools of the workers are sized so that together
+they stay within the connections the database allows. On SIGTERM or SIGINT the workers stop
+accepting connections, let in-flight requests finish for GRACEFUL_SHUTDOWN_TIMEOUT seconds
+and dispose their pools. Several workers share the repository cache and its change counters
+through the SQLite backend, a per-process cache would keep serving data other workers changed.
+
+    python -m src.upha_site.serve --workers 4 --host 0.0.0.0 --port 8000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import uvicorn
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from src.db_handlers.config import (DB_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_MAX_CONNECTIONS,
+                                    DB_RESERVED_CONNECTIONS, DB_POOL_PREWARM, CACHE_BACKEND)
+from src.db_handlers.core.cache import make_backend
+from src.upha_site.config import HOST, PORT, WORKERS, GRACEFUL_SHUTDOWN_TIMEOUT
+
+
+logger = logging.getLogger("serve")
+
+
+async def server_max_connections(url):
+    # One short-lived connection, the server process keeps none
+    engine = create_async_engine(url, poolclass=NullPool)
+    try:
+        async with engine.connect() as connection:
+            return int((await connection.execute(text("SHOW max_connections"))).scalar())
+    finally:
+        await engine.dispose()
+
+
+def connection_budget(url=DB_URL):
+    """
+    Connections all workers may open together, None when the database is not pooled.
+    """
+    if url is None or make_url(url).get_backend_name() == "sqlite":
+        return None
+    if DB_MAX_CONNECTIONS:
+        return DB_MAX_CONNECTIONS
+    return asyncio.run(server_max_connections(url)) - DB_RESERVED_CONNECTIONS
+
+
+def pool_share(budget, workers, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW):
+    """
+    Size the pool of every worker so that all of them stay within `budget` connections.
+
+    Configured sizes that fit are kept, otherwise the share of every worker is split between
+    the pool and its overflow in the configured proportion.
+
+    :return: Tuple of the pool size and the overflow of one worker.
+    :raises ValueError: If the budget leaves no connection for some worker.
+    """
+    if budget is None or workers * (pool_size + max_overflow) <= budget:
+        return pool_size, max_overflow
+    share = budget // workers
+    if share < 1:
+        raise ValueError(f"{budget} connections can not serve {workers} workers.")
+    size = max(1, share * pool_size // (pool_size + max_overflow))
+    return size, share - size
+
+
+def cache_backend(workers, backend=CACHE_BACKEND):
+    """
+    Cache backend of the workers, a shared one as soon as there are several of them.
+    """
+    if workers > 1 and not make_backend(backend).shared:
+        return "sqlite"
+    return backend
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--graceful-timeout", type=int, default=GRACEFUL_SHUTDOWN_TIMEOUT)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(message)s")
+
+    pool_size, max_overflow = pool_share(connection_budget(), args.workers)
+    # Workers are spawned and read their configuration from the environment
+    os.environ["DB_POOL_SIZE"] = str(pool_size)
+    os.environ["DB_MAX_OVERFLOW"] = str(max_overflow)
+    os.environ["DB_POOL_PREWARM"] = str(min(DB_POOL_PREWARM, pool_size))
+    backend = cache_backend(args.workers)
+    if backend != CACHE_BACKEND:
+        logger.info("Sharing the repository cache of the workers through the %s backend", backend)
+    os.environ["CACHE_BACKEND"] = backend
+    logger.info("Serving with %d workers, database pools of %d + %d overflow connections each",
+                args.workers, pool_size, max_overflow)
+
+    uvicorn.run("src.upha_site.main:app", host=args.host, port=args.port, workers=args.workers,
+                timeout_graceful_shutdown=args.graceful_timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,75 @@
 import os
+import secrets
+from typing import List, Optional
+from uuid import uuid4
+import orjson
+from fastapi import Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from src.db_handlers.core.cache import repository_cache
+from src.upha_site.config import ADMIN_TOKEN, MEDIA_ROOT, UPLOAD_MAX_BYTES, UPLOAD_CHUNK_SIZE
+from src.upha_site.images import sniff_image_type
+from src.upha_site.jobs import job_queue
 
 
-async def upload_image(file, folder, generated_filename):
-    allowed_image_types = ["image/png", "image/jpeg", "image/jpg", "image/svg"]
-    if file.content_type in allowed_image_types:
-        with open(str(f"static/{folder}/{generated_filename}"), "wb") as image:
-            image.write(file.file.read())
-            return {"message": "File uploaded successfully."}
-    else:
+# File extensions of the accepted upload types
+UPLOAD_MEDIA_TYPES = {"image/png": ".png", "image/jpeg": ".jpg"}
+
+
+async def upload_image(file, folder, root=MEDIA_ROOT):
+    """
+    Store an uploaded image in fixed-size chunks without blocking the event loop.
+
+    The upload is rejected when it is larger than UPLOAD_MAX_BYTES or when its first bytes
+    are not a PNG or JPEG image. It is written to a temporary file first, so a failed
+    upload never leaves a partial image behind. The file is named by a UUID and the extension
+    of its sniffed type, the name sent by the client is never used.
+
+    :return: Dictionary with the media type and the path to store, or an error.
+    """
+    if file.size is not None and file.size > UPLOAD_MAX_BYTES:
+        return {"error": f"File must not be larger than {UPLOAD_MAX_BYTES} bytes."}
+
+    chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    media_type = sniff_image_type(chunk)
+    if media_type not in UPLOAD_MEDIA_TYPES:
         return {"error": "File must be an image instance."}
 
+    directory = os.path.join(root, folder)
+    path = os.path.join(directory, f"{uuid4()}{UPLOAD_MEDIA_TYPES[media_type]}")
+    real_root, real_path = os.path.realpath(root), os.path.realpath(path)
+    if (os.path.commonpath([real_root, real_path]) != real_root
+            or os.path.dirname(real_path) != os.path.realpath(directory)):
+        return {"error": "Invalid upload folder."}
+    partial_path = f"{path}.part"
+    # Only the server-side upload folder is created, never a directory named by the client
+    await run_in_threadpool(os.makedirs, directory, exist_ok=True)
+    image = await run_in_threadpool(open, partial_path, "wb")
+    size = 0
+    completed = False
+    try:
+        while chunk:
+            size += len(chunk)
+            if size > UPLOAD_MAX_BYTES:
+                break
+            await run_in_threadpool(image.write, chunk)
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        completed = size <= UPLOAD_MAX_BYTES
+    finally:
+        await run_in_threadpool(image.close)
+        if not completed:
+            await run_in_threadpool(os.remove, partial_path)
+
+    if not completed:
+        return {"error": f"File must not be larger than {UPLOAD_MAX_BYTES} bytes."}
+    await run_in_threadpool(os.replace, partial_path, path)
+    await job_queue.enqueue("derivatives", {"path": path})
+    return {"message": "File uploaded successfully.", "media_type": media_type, "path": path}
+
 
 async def delete_image(file_path: str):
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    else:
-        print(f"The file {file_path} does not exist.")
+    # Removed by a background job, unless a row refers to the file by then
+    await job_queue.enqueue("delete_files", {"paths": [file_path]})
 
 
 async def is_empty(**kwargs):
@@ -25,3 +79,74 @@ async def is_empty(**kwargs):
 
     return {"message": "status 200"}
 
+
+async def encode_stream(batches, media_format):
+    """
+    Encode batches of records as NDJSON lines or as one chunked JSON array.
+    """
+    if media_format == "ndjson":
+        async for batch in batches:
+            yield b"".join(orjson.dumps(record) + b"\n" for record in batch)
+    else:
+        separator = b"["
+        async for batch in batches:
+            if batch:
+                yield separator + b",".join(orjson.dumps(record) for record in batch)
+                separator = b","
+        yield b"[]" if separator == b"[" else b"]"
+
+
+def stream_response(batches, media_format):
+    media_type = "application/x-ndjson" if media_format == "ndjson" else "application/json"
+    return StreamingResponse(encode_stream(batches, media_format), media_type=media_type)
+
+
+def field_list(fields: Optional[str] = Query(default=None, pattern=r"^\w+(,\w+)*$")) -> Optional[List[str]]:
+    """
+    Route dependency reading the comma separated column names of the `fields` query parameter.
+    """
+    return fields.split(",") if fields else None
+
+
+def require_admin(x_admin_token: Optional[str] = Header(default=None)):
+    """
+    Route dependency admitting requests with the ADMIN_TOKEN, the route does not exist for others.
+    """
+    if not ADMIN_TOKEN or x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+class ConditionalGet:
+    """
+    Route dependency answering conditional GETs from the change token of a model.
+
+    Resolves to the ETag and Last-Modified headers the route adds to its response and, when
+    If-None-Match holds the current ETag, ends the request with 304 before the route queries
+    or serializes anything. Models of relations expanded with the `include` query parameter
+    are part of the token too. Within the read-your-writes window of a write to the models the
+    body may come from a lagging replica, so it is sent without validators.
+    """
+
+    def __init__(self, model_type, includes: Optional[dict] = None):
+        self.model_name = model_type.__name__
+        self.includes = {name: model.__name__ for name, model in (includes or {}).items()}
+
+    async def __call__(self, request: Request):
+        included = request.query_params.get("include")
+        models = [self.model_name] + ([self.includes[included]] if included in self.includes else [])
+        etag, last_modified = await repository_cache.validators(*models)
+        # The payload cache of CompressionMiddleware checks the same models before serving a body again
+        request.scope["conditional_models"] = tuple(models)
+        headers = {"ETag": etag, "Last-Modified": last_modified, "Cache-Control": "no-cache"}
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            # Weak comparison, as recommended for If-None-Match
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or etag.removeprefix("W/") in tags:
+                raise HTTPException(status_code=304, headers=headers)
+
+        # Without an ETag, neither the client nor the payload cache of CompressionMiddleware keeps the body
+        if await repository_cache.recently_written(*models):
+            return {"Cache-Control": "no-cache"}
+        return headers
@@ -0,0 +1,607 @@
+import io
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+from urllib.parse import urlencode
+from fastapi.concurrency import run_in_threadpool
+import httpx
+import pytest
+from fastapi import Request, UploadFile
+from sqlalchemy import event
+from src.db_handlers.db_manage import AsyncSessionLocal
+from src.db_handlers.core.orm import AdvertisementRepository, ShelterRepository
+from src.db_handlers.core.metrics import Metric
+from src.db_handlers.core.services import encode_cursor
+from src.upha_site.main import app
+from src.upha_site.services import upload_image
+from src.upha_site.middleware import ReadYourWritesMiddleware
+from src.upha_site.compression import AVAILABLE, negotiate
+from src.upha_site.serve import cache_backend, pool_share
+from src.upha_site.images import render_derivative, resolve_source, serve_image
+from src.upha_site.jobs import JobQueue, collect_orphans, job_queue
+from src.benchmarks.startup import LAZY_MODULES, IMPORT_BUDGET_MS, import_profile
+from src.upha_site.config import UPLOAD_MAX_BYTES
+
+
+def client():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+
+@pytest.mark.asyncio_cooperative
+@pytest.mark.serial
+async def test_conditional_get():
+    async with client() as c:
+        # Unchanged list is answered with 304 and no body
+        response = await c.get("/shelters")
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        assert response.headers["last-modified"]
+        response = await c.get("/shelters", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+
+        # A write changes the token of the model
+        response = await c.post("/shelters/create", json={
+            "title": "Conditional Shelter", "address": "Test Location", "phone_number": "+77005004455"
+        })
+        assert "error" not in response.json()
+        response = await c.get("/shelters", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+
+        created = (await c.post("/shelters/filter", json={"title": "Conditional Shelter"})).json()["items"]
+        for shelter in created:
+            await c.delete(f"/shelters/{shelter['pk']}/delete")
+
+
+@pytest.mark.asyncio_cooperative
+async def test_bulk_create():
+    animals = [
+        {"name": f"Bulk Animal {i}", "sex": "male", "age": i, "image_path": "static/free_image.jpg",
+         "species": "dog", "since_time": "2024-01-01T10:00:00"}
+        for i in range(3)
+    ]
+    async with client() as c:
+        response = await c.post("/animals/bulk", json=animals)
+        pks = response.json()["pks"]
+        assert len(pks) == 3
+
+        response = await c.get(f"/animals/{pks[2]}")
+        assert response.json()["name"] == "Bulk Animal 2"
+        assert response.json()["species"] == "dog"
+
+        # The whole batch is validated before anything is inserted
+        response = await c.post("/animals/bulk", json=animals + [{"name": "Invalid Animal"}])
+        assert response.status_code == 422
+
+        for pk in pks:
+            await c.delete(f"/animals/{pk}/delete")
+
+
+@pytest.mark.asyncio_cooperative
+async def test_upload_image():
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 1000
+    with tempfile.TemporaryDirectory() as root:
+        # The type is sniffed from the content, the declared content type is ignored
+        upload = UploadFile(io.BytesIO(png), filename="image.png", headers={"content-type": "text/plain"})
+        result = await upload_image(upload, "ads-images", root=root)
+        assert result["media_type"] == "image/png"
+        assert os.path.dirname(result["path"]) == os.path.join(root, "ads-images")
+        assert result["path"].endswith(".png")
+        with open(result["path"], "rb") as image:
+            assert image.read() == png
+
+        upload = UploadFile(io.BytesIO(b"#!/bin/sh"), filename="image.jpg", headers={"content-type": "image/jpeg"})
+        assert "error" in await upload_image(upload, "ads-images", root=root)
+
+        # Markup is rejected even when it holds an SVG element, it can carry scripts
+        for markup in (b'<svg xmlns="http://www.w3.org/2000/svg" onload="alert(1)"/>',
+                       b"<html><body><svg></svg><script>alert(document.cookie)</script></body></html>"):
+            upload = UploadFile(io.BytesIO(markup), filename="image.svg", headers={"content-type": "image/svg+xml"})
+            assert "error" in await upload_image(upload, "ads-images", root=root)
+
+        # Oversized uploads leave no file behind
+        big = b"\xff\xd8\xff" + b"\x00" * UPLOAD_MAX_BYTES
+        upload = UploadFile(io.BytesIO(big), filename="big.jpg")
+        assert "error" in await upload_image(upload, "ads-images", root=root)
+        assert os.listdir(os.path.join(root, "ads-images")) == [os.path.basename(result["path"])]
+
+
+@pytest.mark.asyncio_cooperative
+async def test_upload_path_traversal():
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+    with tempfile.TemporaryDirectory() as parent:
+        root = os.path.join(parent, "media")
+        os.mkdir(root)
+
+        # A client file name with .. is ignored, the image lands in the upload folder under a generated name
+        upload = UploadFile(io.BytesIO(png), filename="/../../../pwned.png")
+        result = await upload_image(upload, "animals-images", root=root)
+        assert os.listdir(os.path.join(root, "animals-images")) == [os.path.basename(result["path"])]
+        assert "pwned" not in result["path"] and sorted(os.listdir(parent)) == ["media"]
+
+        # Folders outside the media root are rejected
+        upload = UploadFile(io.BytesIO(png), filename="image.png")
+        assert "error" in await upload_image(upload, "../outside", root=root)
+        assert sorted(os.listdir(parent)) == ["media"]
+
+
+@pytest.mark.asyncio_cooperative
+async def test_render_derivative():
+    from PIL import Image
+
+    source = os.path.join(os.path.dirname(__file__), "static", "test_images", "295.jpg")
+    with tempfile.TemporaryDirectory() as root:
+        target = render_derivative(source, os.path.join(root, "ab", "thumbnail.webp"), 200, "WEBP")
+        with Image.open(target) as thumbnail:
+            assert thumbnail.format == "WEBP"
+            assert max(thumbnail.size) == 200
+
+    # Paths outside the media root are never served
+    assert resolve_source("/etc/passwd") is None
+    assert resolve_source("static/../../etc/passwd") is None
+
+
+@pytest.mark.asyncio_cooperative
+async def test_serve_image():
+    png = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "0f8fad5b-d9cb-469f-a165-70867728950e.png")
+        with open(path, "wb") as image:
+            image.write(png)
+
+        with mock.patch("src.upha_site.images.IMAGE_ROOTS", [root]):
+            async with client() as c:
+                response = await c.get("/img", params={"image_path": path})
+                assert response.status_code == 200
+                assert response.content == png
+                assert response.headers["content-type"] == "image/png"
+                assert response.headers["accept-ranges"] == "bytes"
+                assert "immutable" in response.headers["cache-control"]
+                assert response.headers["x-content-type-options"] == "nosniff"
+                assert "sandbox" in response.headers["content-security-policy"]
+                assert "content-disposition" not in response.headers
+                etag = response.headers["etag"]
+                assert not etag.startswith("W/")
+
+                response = await c.get("/img", params={"image_path": path}, headers={"If-None-Match": etag})
+                assert response.status_code == 304
+                assert response.content == b""
+
+                response = await c.get("/img", params={"image_path": path}, headers={"Range": "bytes=8-15"})
+                assert response.status_code == 206
+                assert response.content == png[8:16]
+                assert response.headers["content-range"] == f"bytes 8-15/{len(png)}"
+
+                response = await c.get("/img", params={"image_path": path}, headers={"Range": "bytes=-4"})
+                assert response.content == png[-4:]
+
+                response = await c.get("/img", params={"image_path": path}, headers={"Range": "bytes=5000-"})
+                assert response.status_code == 416
+                assert response.headers["content-range"] == f"bytes */{len(png)}"
+
+                # A stale If-Range sends the whole image
+                response = await c.get("/img", params={"image_path": path},
+                                       headers={"Range": "bytes=0-3", "If-Range": '"stale"'})
+                assert response.status_code == 200
+                assert response.content == png
+
+                # An empty file still ends its response
+                empty = os.path.join(root, "empty.png")
+                open(empty, "wb").close()
+                messages = []
+
+                async def collect(message):
+                    messages.append(message)
+                response = await serve_image(Request({"type": "http", "method": "GET", "headers": []}), empty)
+                await response({"type": "http", "method": "GET"}, None, collect)
+                assert [message["type"] for message in messages] == ["http.response.start", "http.response.body"]
+                assert messages[-1]["more_body"] is False
+
+                # Servers sending the file themselves get the start of the response first, uncompressed
+                async def receive():
+                    return {"type": "http.request", "body": b"", "more_body": False}
+
+                for extension in ("http.response.pathsend", "http.response.zerocopysend"):
+                    messages.clear()
+                    await app({"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http",
+                               "path": "/img", "raw_path": b"/img", "root_path": "",
+                               "query_string": urlencode({"image_path": path}).encode(),
+                               "headers": [(b"host", b"test"), (b"accept-encoding", b"gzip")],
+                               "server": ("test", 80), "client": ("127.0.0.1", 1024), "extensions": {extension: {}}},
+                              receive, collect)
+                    assert [message["type"] for message in messages] == ["http.response.start", extension]
+                    assert (b"content-encoding", b"gzip") not in messages[0]["headers"]
+
+                # Markup in the image roots is never shown inline
+                markup = os.path.join(root, "drawing.svg")
+                with open(markup, "wb") as image:
+                    image.write(b"<html><svg></svg><script>alert(document.cookie)</script></html>")
+                response = await c.get("/img", params={"image_path": markup})
+                assert response.headers["content-disposition"] == "attachment"
+                assert response.headers["x-content-type-options"] == "nosniff"
+                assert "sandbox" in response.headers["content-security-policy"]
+
+                # Nothing outside the image roots is served
+                response = await c.get("/img", params={"image_path": os.path.join(root, "..", "etc", "passwd")})
+                assert response.status_code == 404
+                response = await c.get("/img", params={"image_path": "/etc/passwd"})
+                assert response.status_code == 404
+
+
+@pytest.mark.asyncio_cooperative
+@pytest.mark.serial
+async def test_search():
+    async with client() as c:
+        response = await c.post("/ads/bulk", json=[
+            {"title": "Searchable kitten", "body": "A calm kitten needs a home.", "image_path": "/images/a.jpg"},
+            {"title": "Searchable puppy", "body": "Kitten friendly puppy, kitten kitten.", "image_path": "/images/b.jpg"},
+            {"title": "Searchable parrot", "body": "Talks a lot.", "image_path": "/images/c.jpg"},
+        ])
+        pks = response.json()["pks"]
+
+        # Ranks depend on the whole table, which no other test writes meanwhile
+        page = (await c.get("/ads/search", params={"q": "searchable kitten", "limit": 1})).json()
+        assert len(page["items"]) == 1 and page["items"][0]["pk"] in pks[:2]
+        first = page["items"][0]
+        page = (await c.get("/ads/search", params={"q": "searchable kitten", "after": page["next_cursor"]})).json()
+        assert [ad["pk"] for ad in page["items"]] == [pk for pk in pks[:2] if pk != first["pk"]]
+        assert page["items"][0]["rank"] <= first["rank"]
+
+        # Updated rows are reindexed, deleted ones disappear
+        await c.patch(f"/ads/{pks[2]}/update", json={"title": "Searchable kitten parrot"})
+        results = (await c.get("/search", params={"q": "kitten parrot"})).json()
+        assert [ad["pk"] for ad in results["advertisements"]["items"]] == [pks[2]]
+        assert results["animals"]["items"] == []
+
+        # Query syntax of the database is not interpreted
+        assert (await c.get("/ads/search", params={"q": '"kitten* OR'})).status_code == 200
+        assert (await c.get("/ads/search", params={"q": "!!!"})).json() == {"items": [], "next_cursor": None}
+
+        for pk in pks:
+            await c.delete(f"/ads/{pk}/delete")
+        assert (await c.get("/ads/search", params={"q": "searchable"})).json()["items"] == []
+
+
+@pytest.mark.asyncio_cooperative
+async def test_include_animals():
+    async with client() as c:
+        shelters = (await c.post("/shelters/bulk", json=[
+            {"title": f"Nested Shelter {i}", "address": "Test Location", "phone_number": "+77005004455"}
+            for i in range(3)
+        ])).json()["pks"]
+        animals = (await c.post("/animals/bulk", json=[
+            {"name": f"Nested {i}", "sex": "male", "age": 2, "image_path": "/images/n.jpg", "species": "cat",
+             "since_time": "2024-01-01T10:00:00", "shelter_id": shelters[i % 2]}
+            for i in range(5)
+        ])).json()["pks"]
+
+        shelter = (await c.get(f"/shelters/{shelters[0]}", params={"include": "animals", "animals_limit": 2})).json()
+        assert [animal["pk"] for animal in shelter["animals"]["items"]] == [animals[0], animals[2]]
+        page = (await c.get(f"/shelters/{shelters[0]}/animals",
+                            params={"after": shelter["animals"]["next_cursor"]})).json()
+        assert [animal["pk"] for animal in page["items"]] == [animals[4]]
+
+        response = await c.get("/shelters", params={"include": "animals", "animals_limit": 2,
+                                                    "after": encode_cursor([shelters[0] - 1]), "limit": 3})
+        items = response.json()["items"]
+        assert [len(item["animals"]["items"]) for item in items] == [2, 2, 0]
+        assert items[1]["animals"]["next_cursor"] is None
+
+        # Animal writes change the token of expanded responses
+        etag = response.headers["etag"]
+        await c.delete(f"/animals/{animals[1]}/delete")
+        assert (await c.get("/shelters", params={"include": "animals"})).headers["etag"] != etag
+
+        for pk in animals:
+            await c.delete(f"/animals/{pk}/delete")
+        for pk in shelters:
+            await c.delete(f"/shelters/{pk}/delete")
+
+
+@pytest.mark.asyncio_cooperative
+async def test_include_animals_queries():
+    async with AsyncSessionLocal() as ss:
+        statements = []
+        event.listen(ss.sync_session, "do_orm_execute", statements.append)
+        repository = ShelterRepository(ss)
+        shelters = (await repository.retrieve_all(limit=20))["items"]
+        await repository.include_animals(shelters, 5)
+        # One query for the shelters and one for their animals, whatever their number
+        assert len(statements) <= 2
+
+
+@pytest.mark.asyncio_cooperative
+async def test_bulk_update_delete():
+    async with client() as c:
+        shelters = (await c.post("/shelters/bulk", json=[
+            {"title": f"Moving Shelter {i}", "address": "Test Location", "phone_number": "+77005004455"}
+            for i in range(2)
+        ])).json()["pks"]
+        pks = (await c.post("/animals/bulk", json=[
+            {"name": f"Moving {i}", "sex": "male", "age": i, "image_path": "/images/m.jpg", "species": "dog",
+             "since_time": "2024-01-01T10:00:00", "shelter_id": shelters[0]}
+            for i in range(4)
+        ])).json()["pks"]
+
+        # Move every animal of one shelter to the other
+        response = await c.patch("/animals/bulk-update", json={
+            "filter": {"shelter_id": shelters[0]}, "data": {"shelter_id": shelters[1], "since_time": "2024-02-01T10:00:00"}
+        })
+        assert response.json()["count"] == 4
+        animal = (await c.get(f"/animals/{pks[0]}")).json()
+        assert animal["shelter_id"] == shelters[1] and animal["since_time"] == "2024-02-01 10:00 AM"
+        stats = (await c.get("/stats")).json()["animals"]
+        assert stats["shelter"][str(shelters[1])] == 4 and str(shelters[0]) not in stats["shelter"]
+
+        assert "error" in (await c.patch("/animals/bulk-update", json={"filter": {}, "data": {"age": 1}})).json()
+        assert "error" in (await c.patch("/animals/bulk-update", json={"filter": {"pk": pks[0]}, "data": {"pk": 1}})).json()
+        assert "error" in (await c.patch(f"/animals/{pks[0]}/update", json={"unknown": 1})).json()
+
+        response = await c.request("DELETE", "/animals/bulk-delete", json={"pk": {"in": pks[:2]}})
+        assert response.json()["count"] == 2
+        assert "not found" in (await c.get(f"/animals/{pks[0]}")).json()["message"]
+
+        # The database clears the shelter of animals left behind by a deleted shelter
+        response = await c.request("DELETE", "/shelters/bulk-delete", json={"pk": {"in": shelters}})
+        assert response.json()["count"] == 2
+        assert (await c.get(f"/animals/{pks[2]}")).json()["shelter_id"] is None
+        assert str(shelters[1]) not in (await c.get("/stats")).json()["animals"]["shelter"]
+
+        response = await c.request("DELETE", "/animals/bulk-delete", json={"pk": {"in": pks}})
+        assert response.json()["count"] == 2
+
+
+@pytest.mark.asyncio_cooperative
+async def test_fields():
+    async with client() as c:
+        pks = (await c.post("/ads/bulk", json=[
+            {"title": "Projected", "body": "Long body " * 100, "image_path": "/images/p.jpg"}
+        ])).json()["pks"]
+
+        page = (await c.get("/ads", params={"fields": "title,image_path", "limit": 500})).json()
+        assert set(page["items"][0]) == {"pk", "title", "image_path", "thumbnail_url"}
+
+        ad = (await c.get(f"/ads/{pks[0]}", params={"fields": "title"})).json()
+        assert ad == {"pk": pks[0], "title": "Projected"}
+        await c.patch(f"/ads/{pks[0]}/update", json={"title": "Projected again"})
+        assert (await c.get(f"/ads/{pks[0]}", params={"fields": "title"})).json()["title"] == "Projected again"
+
+        # The keyset columns are selected for the cursor even when not requested
+        page = (await c.post("/ads/filter", params={"fields": "title", "limit": 1},
+                             json={"title": "Projected again", "order_by": "-published_time"})).json()
+        assert set(page["items"][0]) == {"pk", "title", "published_time"}
+
+        assert "error" in (await c.get("/ads", params={"fields": "title,secret"})).json()
+        assert (await c.get("/ads", params={"fields": "title;drop"})).status_code == 422
+
+        await c.delete(f"/ads/{pks[0]}/delete")
+
+
+@pytest.mark.asyncio_cooperative
+async def test_metrics():
+    # Every kind of metric renders its own samples
+    with pytest.raises(TypeError):
+        Metric("upha_untyped", "Metric without samples.")
+
+    async with client() as c:
+        response = await c.get("/shelters/1/animals", params={"limit": 5})
+        timing = response.headers["server-timing"]
+        assert timing.startswith("db;dur=") and "pool;dur=" in timing and "app;dur=" in timing
+        assert 'desc="0 queries"' not in timing
+
+        text = (await c.get("/metrics")).text
+        assert 'upha_http_request_duration_seconds_bucket{method="GET",route="/shelters/{pk}/animals",' in text
+        assert 'upha_http_request_sql_statements_count{route="/shelters/{pk}/animals"}' in text
+        assert 'upha_sql_statement_duration_seconds_bucket{operation="SELECT",le="+Inf"}' in text
+        assert "# TYPE upha_db_pool_connections gauge" in text
+        await c.get("/no-such-route")
+        assert 'route="unmatched",status="404"' in (await c.get("/metrics")).text
+
+
+@pytest.mark.asyncio_cooperative
+async def test_slow_queries_admin():
+    async with client() as c:
+        # Hidden without a configured token, and from requests without it
+        assert (await c.get("/admin/slow-queries")).status_code == 404
+        with mock.patch("src.upha_site.services.ADMIN_TOKEN", "secret"):
+            assert (await c.get("/admin/slow-queries", headers={"X-Admin-Token": "wrong"})).status_code == 404
+            response = await c.get("/admin/slow-queries", params={"limit": 5}, headers={"X-Admin-Token": "secret"})
+            assert response.status_code == 200
+            assert len(response.json()["items"]) <= 5
+
+
+def test_import_budget():
+    # The application imports without a database and leaves drivers and image processing for later.
+    # A plain test, timed after the cooperative ones instead of competing with them for the CPU
+    profile = import_profile()
+    assert not [name for name in LAZY_MODULES if name in profile["modules"]]
+    assert profile["total_ms"] < IMPORT_BUDGET_MS
+
+
+@pytest.mark.asyncio_cooperative
+async def test_pool_share():
+    # Configured pools that fit are kept, others shrink in proportion
+    assert pool_share(None, 8, 10, 10) == (10, 10)
+    assert pool_share(200, 4, 10, 10) == (10, 10)
+    assert pool_share(90, 8, 10, 10) == (5, 6)
+    assert pool_share(8, 8, 10, 5) == (1, 0)
+    with pytest.raises(ValueError):
+        pool_share(3, 4, 10, 10)
+
+    # Several workers never keep a cache of their own
+    assert cache_backend(1, "memory") == "memory"
+    assert cache_backend(4, "memory") == "sqlite"
+    assert cache_backend(4, "sqlite") == "sqlite"
+
+
+@pytest.mark.asyncio_cooperative
+async def test_read_your_writes_cookie():
+    transport = httpx.ASGITransport(app=ReadYourWritesMiddleware(app, window=5))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        assert "set-cookie" not in (await c.get("/shelters")).headers
+        response = await c.post("/shelters/create", json={
+            "title": "Sticky Shelter", "address": "Test Location", "phone_number": "+77005004466"
+        })
+        assert response.headers["set-cookie"].startswith("upha_primary_until=")
+        assert "set-cookie" not in (await c.get("/shelters")).headers
+        response = await c.request("DELETE", "/shelters/bulk-delete", json={"title": "Sticky Shelter"})
+        assert response.json()["count"] == 1
+
+
+@pytest.mark.asyncio_cooperative
+@pytest.mark.serial
+async def test_compression():
+    assert negotiate("") is None and negotiate("identity") is None
+    assert negotiate("gzip;q=0, deflate") is None
+    assert negotiate("deflate, gzip;q=0.5") == "gzip"
+    assert negotiate("*") in AVAILABLE
+
+    async with client() as c:
+        pks = (await c.post("/ads/bulk", json=[
+            {"title": f"Compressed {i}", "body": "Long body " * 200, "image_path": "/images/z.jpg"} for i in range(5)
+        ])).json()["pks"]
+
+        # Large JSON is compressed with a coding the client accepts, small or unaccepted is not
+        response = await c.get("/ads", params={"limit": 500}, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["vary"]
+        assert int(response.headers["content-length"]) < len(response.content)
+        assert "content-encoding" not in (await c.get("/info", headers={"Accept-Encoding": "gzip"})).headers
+        response = await c.get("/ads", params={"limit": 500}, headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in response.headers
+
+        # Unchanged lists are served from the payload cache without a query
+        first = await c.get("/ads", params={"limit": 500}, headers={"Accept-Encoding": "gzip"})
+        second = await c.get("/ads", params={"limit": 500}, headers={"Accept-Encoding": "gzip"})
+        assert second.headers["etag"] == first.headers["etag"]
+        assert second.content == first.content
+        assert 'desc="0 queries"' in second.headers["server-timing"]
+
+        # Streams are compressed chunk by chunk
+        response = await c.get("/ads/stream", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert all(line.startswith("{") for line in response.text.splitlines())
+
+        await c.request("DELETE", "/ads/bulk-delete", json={"pk": {"in": pks}})
+        response = await c.get("/ads", params={"limit": 500}, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["etag"] != first.headers["etag"]
+
+
+@pytest.mark.asyncio_cooperative
+async def test_job_queue():
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "jobs.sqlite3")
+        queue = JobQueue(path, workers=0, max_attempts=2, lease_seconds=60, poll_interval=1)
+        calls = []
+
+        @queue.handler("flaky")
+        async def flaky(name):
+            calls.append(name)
+            if name == "bad":
+                raise RuntimeError(name)
+
+        assert await queue.enqueue("flaky", {"name": "good"}, unique=True)
+        assert await queue.enqueue("flaky", {"name": "good"}, unique=True) is None
+        await queue.enqueue("flaky", {"name": "bad"})
+        with pytest.raises(ValueError):
+            await queue.enqueue("unknown")
+
+        # Jobs are kept in the file, a new queue on it runs them
+        queue = JobQueue(path, workers=0, max_attempts=2, lease_seconds=60, poll_interval=1)
+        queue.handlers["flaky"] = flaky
+        assert await queue.run_pending() == 2
+        assert calls == ["good", "bad"]
+        assert await queue.counts() == {"flaky": {"queued": 1}}
+
+        # Failed jobs are retried after their delay, and kept once out of attempts
+        await queue.execute("UPDATE jobs SET run_after = 0")
+        assert await queue.run_pending() == 1
+        assert await queue.counts() == {"flaky": {"failed": 1}}
+        with sqlite3.connect(path) as connection:
+            assert connection.execute("SELECT last_error FROM jobs").fetchone() == ("RuntimeError('bad')",)
+
+
+@pytest.mark.asyncio_cooperative
+async def test_file_jobs():
+    with tempfile.TemporaryDirectory() as directory:
+        root = os.path.join(directory, "uploads")
+        os.mkdir(root)
+        queue = JobQueue(os.path.join(directory, "jobs.sqlite3"), workers=0, max_attempts=2, lease_seconds=60,
+                         poll_interval=1)
+        queue.handlers = job_queue.handlers
+        with mock.patch("src.upha_site.jobs.UPLOAD_FOLDERS", [root]), mock.patch("src.upha_site.jobs.job_queue", queue):
+            kept, deleted, orphan, partial = (os.path.join(root, name) for name in ("kept.png", "deleted.png",
+                                                                                      "orphan.png", "upload.png.part"))
+            for path in (kept, deleted, orphan, partial):
+                with open(path, "wb") as file:
+                    file.write(b"\x89PNG\r\n\x1a\n")
+                os.utime(path, (time.time() - 3600, time.time() - 3600))
+            ads = AdvertisementRepository()
+            pks = (await ads.create_many([{"title": "File", "body": "File body.", "image_path": path}
+                                          for path in (kept, deleted)]))["pks"]
+
+            # The file of a deleted row is removed once the deletion is committed
+            await ads.delete(pks[1])
+            await queue.run_pending()
+            assert not os.path.exists(deleted) and os.path.exists(kept)
+
+            # Files no row refers to are collected, recent ones are left to their upload
+            with open(os.path.join(root, "new.png"), "wb"):
+                pass
+            assert sorted(await collect_orphans(min_age=60)) == [orphan, partial]
+            await queue.run_pending()
+            assert sorted(os.listdir(root)) == ["kept.png", "new.png"]
+
+            await ads.delete(pks[0])
+            await queue.run_pending()
+            assert not os.path.exists(kept)
+
+
+MEDIA_ROOT_SCRIPT = """
+import asyncio, os, sys
+import httpx
+from src.db_handlers.core.orm import AdvertisementRepository
+from src.upha_site.config import MEDIA_ROOT
+from src.upha_site.jobs import collect_orphans, job_queue
+from src.upha_site.main import app
+
+async def main():
+    with open(sys.argv[1], "rb") as image:
+        content = image.read()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as c:
+        response = await c.post("/ads/create", data={"title": "Media root ad", "body": "Stored under MEDIA_ROOT."},
+                                files={"file": ("image.jpg", content, "image/jpeg")})
+        assert "error" not in response.json(), response.json()
+    folder = os.path.join(MEDIA_ROOT, "ads-images")
+    upload = os.listdir(folder)
+    with open(os.path.join(folder, "orphan.jpg"), "wb") as orphan:
+        orphan.write(content)
+
+    # The stored path of the upload is the file under MEDIA_ROOT, only the orphan is collected
+    assert await collect_orphans(min_age=-1) == [os.path.join(folder, "orphan.jpg")]
+    await job_queue.run_pending()
+    assert os.listdir(folder) == upload
+
+    ads = AdvertisementRepository()
+    await ads.delete_many({"pk": {"in": [ad["pk"] for ad in await ads.filter_all({"title": "Media root ad"})]}})
+    await job_queue.run_pending()
+    assert os.listdir(folder) == []
+
+asyncio.run(main())
+"""
+
+
+@pytest.mark.asyncio_cooperative
+async def test_collect_orphans_media_root():
+    image = os.path.join(os.path.dirname(__file__), "static", "test_images", "295.jpg")
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, MEDIA_ROOT=os.path.join(directory, "media"), JOBS_DB=os.path.join(directory, "jobs.db"))
+        process = await run_in_threadpool(subprocess.run, [sys.executable, "-c", MEDIA_ROOT_SCRIPT, image], env=env,
+                                          capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr